@@ -0,0 +1,207 @@
+import bisect
+import collections
+import datetime
+import queue
+import threading
+import time
+
+import metrics
+
+# monotonic: time.monotonic() when the reading arrived, used for alignment
+# wall: datetime of the same instant, used for the stored record
+Reading = collections.namedtuple('Reading', ['monotonic', 'wall', 'value'])
+
+
+def stamped_reader(read_row, timeout=1.0):
+    """
+    Read function for a source that stamps rows when they arrive, such as
+    Exo2.read_stream_row, so a row is paired by its arrival time and not by
+    the time the producer thread got to it.
+    """
+    def read():
+        row = read_row(timeout)
+        if row is None:
+            return None
+        return Reading(row.monotonic, row.host_time, row.row)
+    return read
+
+
+class InstrumentProducer(threading.Thread):
+    """
+    Thread that calls read() in a loop and stamps every result with a monotonic clock.
+
+    Parameters:
+        name: Thread name, also used in error messages.
+        read: Blocking function returning one reading, or None/empty if there is nothing to report.
+              A Reading is passed on with its own stamps (see stamped_reader).
+        sink: Function called with each Reading.
+        interval: Minimum number of seconds between two reads.
+    """
+
+    def __init__(self, name, read, sink, interval=0.0):
+        super().__init__(name=name, daemon=True)
+        self.read = read
+        self.sink = sink
+        self.interval = interval
+        self.count = 0
+        self.errors = 0
+        self.read_time = metrics.histogram('instrument_read_seconds', 'Time spent in one read of an instrument',
+                                           instrument=name)
+        self.error_count = metrics.counter('instrument_errors_total', 'Reads of an instrument that raised',
+                                           instrument=name)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            try:
+                value = self.read()
+            except Exception as e:
+                self.errors += 1
+                self.error_count.inc()
+                print(f"{self.name} read failed - {e}")
+                value = None
+            self.read_time.since(start)
+            if value:
+                if not isinstance(value, Reading):
+                    value = Reading(time.monotonic(), datetime.datetime.now(), value)
+                self.sink(value)
+                self.count += 1
+            wait = self.interval - (time.monotonic() - start)
+            if wait > 0:
+                self._stop_event.wait(wait)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class FixHistory():
+    """Recent GPS fixes ordered by arrival time, searchable by time."""
+
+    def __init__(self, size=200):
+        self._fixes = collections.deque(maxlen=size)
+        self._cond = threading.Condition()
+
+    def add(self, reading):
+        with self._cond:
+            self._fixes.append(reading)
+            self._cond.notify_all()
+
+    def latest(self):
+        with self._cond:
+            return self._fixes[-1] if self._fixes else None
+
+    def wait_after(self, t, timeout):
+        """Wait until a fix that arrived at or after t is known, or until timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._fixes or self._fixes[-1].monotonic < t:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def closest(self, t):
+        """Return the fix whose arrival time is closest to t."""
+        with self._cond:
+            if not self._fixes:
+                return None
+            times = [fix.monotonic for fix in self._fixes]
+            i = bisect.bisect_left(times, t)
+            candidates = [self._fixes[j] for j in (i - 1, i) if 0 <= j < len(self._fixes)]
+            return min(candidates, key=lambda fix: abs(fix.monotonic - t))
+
+
+class AcquisitionPipeline():
+    """
+    Runs GPS and EXO2 acquisition on separate threads and pairs their readings.
+
+    Each EXO2 row is matched with the GPS fix closest to it in time. The joiner
+    waits at most max_wait seconds for a fix newer than the row, so the pair
+    can use a fix that arrived right after the row when that one is closer.
+    Pairs whose fix is further than max_skew seconds away are discarded.
+
+    Parameters:
+        read_gps: Blocking function returning (latitude, longitude).
+        read_exo: Blocking function returning one raw EXO2 row.
+        gps_interval: Minimum seconds between GPS reads.
+        exo_interval: Minimum seconds between EXO2 reads.
+        max_wait: Seconds the joiner waits for a newer fix.
+        max_skew: Largest accepted time difference between a row and its fix.
+    """
+
+    def __init__(self, read_gps, read_exo, gps_interval=0.0, exo_interval=0.0,
+                 max_wait=0.5, max_skew=2.0, max_pending=100):
+        self.max_wait = max_wait
+        self.max_skew = max_skew
+        self.fixes = FixHistory()
+        self.discarded = 0
+        self.fix_wait = metrics.histogram('acquisition_fix_wait_seconds', 'Time a row waits for a newer GPS fix')
+        self.overflows = metrics.counter('acquisition_discarded_total', 'Rows discarded by the pipeline',
+                                         reason='queue_full')
+        self.skewed = metrics.counter('acquisition_discarded_total', 'Rows discarded by the pipeline', reason='skew')
+        self._rows = queue.Queue(maxsize=max_pending)
+        self._pairs = queue.Queue(maxsize=max_pending)
+        self._stop_event = threading.Event()
+        self.gps = InstrumentProducer('gps', read_gps, self.fixes.add, gps_interval)
+        self.exo = InstrumentProducer('exo2', read_exo, self._put_row, exo_interval)
+        self._joiner = threading.Thread(target=self._join, name='joiner', daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.gps.start()
+        self.exo.start()
+        self._joiner.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self.gps.stop()
+        self.exo.stop()
+
+    def _put_row(self, reading):
+        try:
+            self._rows.put_nowait(reading)
+        except queue.Full:
+            # The consumer is behind: keep the newest data
+            try:
+                self._rows.get_nowait()
+            except queue.Empty:
+                pass
+            self._rows.put_nowait(reading)
+            self.discarded += 1
+            self.overflows.inc()
+
+    def _join(self):
+        while not self._stop_event.is_set():
+            try:
+                row = self._rows.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self.fix_wait.time():
+                self.fixes.wait_after(row.monotonic, self.max_wait)
+            fix = self.fixes.closest(row.monotonic)
+            if fix is None or abs(fix.monotonic - row.monotonic) > self.max_skew:
+                self.discarded += 1
+                self.skewed.inc()
+                continue
+            self._pairs.put((row, fix))
+
+    def pairs(self, timeout=None):
+        """
+        Yield (row, fix) Readings as they are joined.
+
+        Stops when the pipeline is stopped, or when no pair arrives within timeout seconds.
+        """
+        while not self._stop_event.is_set():
+            try:
+                yield self._pairs.get(timeout=timeout if timeout is not None else 0.5)
+            except queue.Empty:
+                if timeout is not None:
+                    return
@@ -0,0 +1,652 @@
+"""
+Shore-side aggregator for the telemetry of several ASVs.
+
+The boats keep writing their records to the local Spool (spool.py). Instead
+of each one uploading to the cluster over the radio link, an
+AggregatorUploader streams the spool over TCP to one Aggregator on shore,
+which batches the records of every boat into the database.
+
+Protocol: every message is a frame of FRAME_HEADER (type, payload length,
+crc32 of the payload, sequence number) followed by a BSON payload.
+    HELLO    boat -> shore  payload {'stream': spool name, 'spool_id': Spool.spool_id,
+                                    'mission': register_mission() fields or absent}
+    WELCOME  shore -> boat  seq = next sequence number the aggregator wants from this stream
+    RECORD   boat -> shore  seq = spool sequence number, payload = the record
+    ACK      shore -> boat  seq = next sequence number wanted, everything before it is in the database
+A boat only acknowledges its spool on ACK, so after a dropped connection or
+a restart on either side it resumes from the WELCOME offset. A stream is
+known by its name and spool id, so a spool started over under the same name
+is a new stream. Records get the
+same deterministic _id as with SpoolUploader, so nothing is stored twice:
+a regular collection refuses the duplicate _id, and for the time-series
+collection TimeSeriesStore.insert_many leaves out the records already stored.
+
+python aggregator.py serve [port] [collection]
+python aggregator.py simulate [boats] [records]
+"""
+import asyncio
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import bson
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from dbwriter import DUPLICATE_KEY_ERROR
+from spool import record_id
+
+FRAME_HEADER = struct.Struct('<BIIQ')
+MAX_PAYLOAD = 1024 * 1024
+HELLO = 1
+WELCOME = 2
+RECORD = 3
+ACK = 4
+DEFAULT_PORT = 8765
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(kind, seq=0, payload=b''):
+    return FRAME_HEADER.pack(kind, len(payload), zlib.crc32(payload), seq) + payload
+
+
+def decode_frames(buffer):
+    """
+    Split complete frames off the front of buffer.
+
+    Returns:
+        ([(kind, seq, payload), ...], rest of the buffer)
+    """
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER.size:
+        kind, length, crc, seq = FRAME_HEADER.unpack_from(buffer, offset)
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Frame of {length} bytes")
+        end = offset + FRAME_HEADER.size + length
+        if len(buffer) < end:
+            break
+        payload = bytes(buffer[offset + FRAME_HEADER.size:end])
+        if zlib.crc32(payload) != crc:
+            raise ProtocolError("Frame checksum mismatch")
+        frames.append((kind, seq, payload))
+        offset = end
+    return frames, buffer[offset:]
+
+
+async def read_frame(reader):
+    kind, length, crc, seq = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame of {length} bytes")
+    payload = await reader.readexactly(length)
+    if zlib.crc32(payload) != crc:
+        raise ProtocolError("Frame checksum mismatch")
+    return kind, seq, payload
+
+
+class StreamState():
+    """What the aggregator knows about one boat's spool."""
+
+    __slots__ = ('name', 'acked', 'received', 'records', 'duplicates', 'gaps', 'bytes', 'connects',
+                 'writer', 'last_seen', '_reported_records', '_reported_at')
+
+    def __init__(self, name, acked=-1):
+        self.name = name
+        # Highest sequence number in the database / handed to the batcher
+        self.acked = acked
+        self.received = acked
+        self.records = 0
+        self.duplicates = 0
+        self.gaps = 0
+        self.bytes = 0
+        self.connects = 0
+        self.writer = None
+        self.last_seen = None
+        self._reported_records = 0
+        self._reported_at = time.monotonic()
+
+    def rate(self):
+        """Records per second since the last call."""
+        now = time.monotonic()
+        rate = (self.records - self._reported_records) / max(now - self._reported_at, 1e-9)
+        self._reported_records = self.records
+        self._reported_at = now
+        return rate
+
+
+class Aggregator():
+    """
+    TCP server batching the records of many boats into one collection.
+
+    Every stream is deduplicated by sequence number, records are inserted
+    with insert_many in batches of up to batch_size, and a boat is sent an ACK
+    only once its records are in the database. The acknowledged offset of
+    every stream is kept in state_file, written after each batch. When the
+    queue is full the connections stop being read, which pushes back on the
+    boats through TCP. Records refused for another reason than the database
+    connection are appended to rejected_file and acknowledged, so one bad
+    record does not stall every boat.
+
+    Parameters:
+        collection: pymongo Collection for the records, or a TimeSeriesStore.
+        state_file: JSON file with the acknowledged offset of every stream.
+        ts_store: tsstore.TimeSeriesStore used to register the missions announced in HELLO, or None.
+        rejected_file: JSON lines file for the records that could not be inserted.
+    """
+
+    def __init__(self, collection, state_file='aggregator_offsets.json', ts_store=None, batch_size=500,
+                 flush_interval=1.0, max_queue=20000, retry_interval=5.0, rejected_file='aggregator_rejected.jsonl'):
+        self.collection = collection
+        self.state_file = state_file
+        self.rejected_file = rejected_file
+        self.ts_store = ts_store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.retry_interval = retry_interval
+        self.streams = {}
+        for name, acked in self._read_state().items():
+            self.streams[name] = StreamState(name, acked)
+        self.inserted = 0
+        self.batches = 0
+        self.errors = 0
+        self.rejected = 0
+        self.port = None
+        self._queue = None
+        self._server = None
+        self._tasks = []
+        self._closing = False
+
+    def _read_state(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Could not read {self.state_file}, streams start over - {e}")
+            return {}
+
+    def _write_state(self, offsets):
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(offsets, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_file)
+
+    async def start(self, host='0.0.0.0', port=DEFAULT_PORT):
+        self._queue = asyncio.Queue(self.max_queue)
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._tasks = [asyncio.create_task(self._batcher(), name='aggregator-batcher')]
+        print(f"Aggregator listening on {host}:{self.port}")
+
+    async def serve(self, host='0.0.0.0', port=DEFAULT_PORT, report_interval=None):
+        """Start and run until cancelled."""
+        await self.start(host, port)
+        if report_interval:
+            self._tasks.append(asyncio.create_task(self._report(report_interval), name='aggregator-report'))
+        try:
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            if not self._closing:
+                raise
+        finally:
+            if not self._closing:
+                await self.close()
+
+    async def close(self):
+        """Stop accepting boats, write what is queued and stop."""
+        self._closing = True
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for state in self.streams.values():
+            if state.writer is not None:
+                state.writer.close()
+        if self._queue is not None:
+            # Let the batcher write what was received, then stop it
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _register(self, mission):
+        if self.ts_store is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, lambda: self.ts_store.register_mission(**mission))
+        except (PyMongoError, TypeError) as e:
+            print(f"Could not register mission {mission.get('mission')} - {e}")
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        state = None
+        try:
+            kind, _, payload = await read_frame(reader)
+            if kind != HELLO:
+                raise ProtocolError(f"Expected HELLO, got frame type {kind}")
+            hello = bson.decode(payload)
+            name = hello['stream']
+            spool_id = hello.get('spool_id', '')
+            key = f"{name}/{spool_id}" if spool_id else name
+            state = self.streams.get(key)
+            if state is None:
+                state = self.streams[key] = StreamState(key)
+            if state.writer is not None:
+                # The boat reconnected before we noticed the old connection was gone
+                state.writer.close()
+                state.writer = None
+            state.connects += 1
+            state.last_seen = time.time()
+            if hello.get('mission'):
+                await self._register(hello['mission'])
+            welcome = state.acked + 1
+            writer.write(encode_frame(WELCOME, welcome))
+            await writer.drain()
+            # The batcher only sends ACKs once WELCOME is out, as the boat expects it first
+            state.writer = writer
+            if state.acked + 1 > welcome:
+                writer.write(encode_frame(ACK, state.acked + 1))
+            print(f"Stream {key} connected from {peer}, resuming at {welcome}")
+            while True:
+                kind, seq, payload = await read_frame(reader)
+                if kind != RECORD:
+                    raise ProtocolError(f"Expected RECORD, got frame type {kind}")
+                state.last_seen = time.time()
+                state.bytes += FRAME_HEADER.size + len(payload)
+                if seq <= state.received:
+                    state.duplicates += 1
+                    continue
+                if seq != state.received + 1:
+                    state.gaps += 1
+                state.received = seq
+                state.records += 1
+                record = bson.decode(payload)
+                record['_id'] = record_id(name, seq, spool_id)
+                await self._queue.put((state, seq, record))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ProtocolError, bson.errors.BSONError, KeyError) as e:
+            print(f"Dropping connection from {peer} - {e}")
+        finally:
+            if state is not None and state.writer is writer:
+                state.writer = None
+            writer.close()
+
+    def _insert(self, documents):
+        try:
+            self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Records sent again after a lost ACK are already stored
+            errors = e.details.get('writeErrors', [])
+            if any(err.get('code') != DUPLICATE_KEY_ERROR for err in errors):
+                raise
+
+    def _write(self, documents):
+        """Insert a batch; if it fails for another reason than the connection, insert it record by record."""
+        try:
+            self._insert(documents)
+        except PyMongoError:
+            raise
+        except Exception as e:
+            print(f"Aggregator insert failed, retrying record by record - {e!r}")
+            for document in documents:
+                try:
+                    self._insert([document])
+                except PyMongoError:
+                    raise
+                except Exception as e:
+                    self._reject(document, e)
+
+    def _reject(self, document, error):
+        """Set aside a record the database refuses, so it is kept but not retried."""
+        print(f"Rejected record {document.get('_id')} written to {self.rejected_file} - {error!r}")
+        with open(self.rejected_file, 'a') as f:
+            f.write(json.dumps(document, default=str) + "\n")
+        self.rejected += 1
+
+    async def _take_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._queue.empty():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._take_batch()
+            try:
+                await self._store(loop, batch)
+            except Exception as e:
+                # Keep serving the other boats; a later ACK of the stream covers what was stored
+                self.errors += 1
+                print(f"Aggregator could not store a batch of {len(batch)} records - {e!r}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _store(self, loop, batch):
+        """Insert a batch, save the offsets and acknowledge it to the boats."""
+        documents = [record for _, _, record in batch]
+        rejected = self.rejected
+        while True:
+            try:
+                await loop.run_in_executor(None, self._write, documents)
+                break
+            except PyMongoError as e:
+                self.errors += 1
+                print(f"Aggregator insert failed, {self._queue.qsize() + len(batch)} records waiting - {e}")
+                await asyncio.sleep(self.retry_interval)
+        self.inserted += len(documents) - (self.rejected - rejected)
+        self.batches += 1
+        acked = {}
+        for state, seq, _ in batch:
+            acked[state] = max(seq, acked.get(state, -1))
+        for state, seq in acked.items():
+            state.acked = max(state.acked, seq)
+        offsets = {state.name: state.acked for state in self.streams.values()}
+        await loop.run_in_executor(None, self._write_state, offsets)
+        for state in acked:
+            if state.writer is not None:
+                try:
+                    state.writer.write(encode_frame(ACK, state.acked + 1))
+                except (ConnectionError, RuntimeError):
+                    pass
+
+    def stats(self):
+        """Totals and per-stream counters; 'rate' is records per second since the previous call."""
+        return {
+            'inserted': self.inserted,
+            'batches': self.batches,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'streams': {name: {'connected': state.writer is not None, 'acked': state.acked,
+                               'records': state.records, 'duplicates': state.duplicates, 'gaps': state.gaps,
+                               'bytes': state.bytes, 'connects': state.connects, 'rate': state.rate()}
+                        for name, state in self.streams.items()},
+        }
+
+    async def _report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.stats()
+            print(f"{time.strftime('%H:%M:%S')} inserted {stats['inserted']} in {stats['batches']} batches, "
+                  f"{stats['queued']} queued, {stats['errors']} errors, {stats['rejected']} rejected")
+            for name, stream in stats['streams'].items():
+                print(f"  {name}: {'up' if stream['connected'] else 'down'}, {stream['rate']:.1f} rec/s, "
+                      f"acked {stream['acked']}, duplicates {stream['duplicates']}, gaps {stream['gaps']}")
+
+
+class AggregatorUploader():
+    """
+    Background thread that streams a Spool to an Aggregator.
+
+    Drop-in alternative to spool.SpoolUploader: records stay in the spool
+    until the aggregator acknowledges them, and after a lost connection the
+    thread reconnects and resumes from the offset the aggregator asks for.
+    At most window records are sent ahead of the last ACK. A link that dies
+    without a reset (e.g. the radio drops out) is detected by TCP keepalive
+    and by the ACK deadline: with records in flight and no ACK for
+    ack_timeout seconds, the thread reconnects.
+
+    Parameters:
+        spool: spool.Spool to send.
+        host, port: Address of the aggregator.
+        mission: register_mission() fields sent with HELLO, or None.
+        ack_timeout: Seconds to wait for an ACK while records are in flight, also the send timeout.
+    """
+
+    def __init__(self, spool, host, port=DEFAULT_PORT, mission=None, window=1000, batch_size=100,
+                 poll_interval=0.2, retry_interval=5.0, connect_timeout=10.0, ack_timeout=30.0):
+        self.spool = spool
+        self.host = host
+        self.port = port
+        self.mission = mission
+        self.window = window
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.connect_timeout = connect_timeout
+        self.ack_timeout = ack_timeout
+        self.uploaded = 0
+        self.errors = 0
+        self.connects = 0
+        self._sock = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='aggregator-uploader', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Probe an idle link after 10 s, give up after 3 unanswered probes 5 s apart (where the OS allows it)
+        for option, value in (('TCP_KEEPIDLE', 10), ('TCP_KEEPINTVL', 5), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        hello = {'stream': self.spool.name, 'spool_id': self.spool.spool_id}
+        if self.mission:
+            hello['mission'] = self.mission
+        sock.sendall(encode_frame(HELLO, 0, bson.encode(hello)))
+        buffer = b''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("Aggregator closed the connection")
+            frames, buffer = decode_frames(buffer + data)
+            if frames:
+                break
+        kind, next_seq, _ = frames[0]
+        if kind != WELCOME:
+            raise ProtocolError(f"Expected WELCOME, got frame type {kind}")
+        # sendall() on a dead link fails instead of blocking once the send buffer is full
+        sock.settimeout(self.ack_timeout)
+        self._sock = sock
+        self.connects += 1
+        # The aggregator may already have records whose ACK we never saw
+        self._ack(next_seq - 1)
+        return buffer
+
+    def _ack(self, seq):
+        acked = self.spool.acked_seq
+        # Never acknowledge past the end of the spool, e.g. when the aggregator knew an older spool of that name
+        seq = min(seq, self.spool.next_seq - 1)
+        if seq > acked:
+            self.spool.ack(seq)
+            self.uploaded += seq - acked
+
+    def _stream(self, buffer):
+        sock = self._sock
+        sent = self.spool.acked_seq
+        last_ack = time.monotonic()
+        while not self._stop.is_set():
+            batch = []
+            in_flight = sent - self.spool.acked_seq
+            if in_flight < self.window:
+                batch = self.spool.read(sent, min(self.batch_size, self.window - in_flight))
+                if batch:
+                    if in_flight == 0:
+                        # The deadline runs from the first record sent after an idle period
+                        last_ack = time.monotonic()
+                    sock.sendall(b''.join(encode_frame(RECORD, seq, bson.encode(record)) for seq, record in batch))
+                    sent = batch[-1][0]
+            readable, _, _ = select.select([sock], [], [], 0 if batch else self.poll_interval)
+            if readable:
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionError("Aggregator closed the connection")
+                frames, buffer = decode_frames(buffer + data)
+                for kind, next_seq, _ in frames:
+                    if kind == ACK:
+                        self._ack(next_seq - 1)
+                        last_ack = time.monotonic()
+            if sent > self.spool.acked_seq and time.monotonic() - last_ack > self.ack_timeout:
+                raise TimeoutError(f"No ACK for {self.ack_timeout} s with {sent - self.spool.acked_seq} "
+                                   f"records in flight")
+
+    def _close_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._stream(self._connect())
+            except (OSError, ProtocolError) as e:
+                self.errors += 1
+                print(f"Aggregator link to {self.host}:{self.port} lost, {self.spool.pending()} records waiting - {e}")
+                self._close_socket()
+                if self._stop.wait(self.retry_interval):
+                    return
+        self._close_socket()
+
+    def close(self, timeout=None):
+        """Stop the uploader; unacknowledged records stay in the spool."""
+        self._stop.set()
+        self._thread.join(timeout)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('serve', 'simulate'):
+        print("python aggregator.py serve [port] [collection]")
+        print("python aggregator.py simulate [boats] [records]")
+        sys.exit(1)
+
+    if sys.argv[1] == 'serve':
+        import certifi
+        from pymongo import MongoClient
+
+        from tsstore import TimeSeriesStore
+
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT
+        client = MongoClient(os.environ['COSMODB_STRING'], tlsCAFile=certifi.where())
+        ts_store = TimeSeriesStore(client.missions, create=False)
+        try:
+            ts_store.ensure_collections()
+        except PyMongoError as e:
+            print(f"Could not prepare the collections - {e}")
+        collection = client.missions[sys.argv[3]] if len(sys.argv) > 3 else ts_store
+        aggregator = Aggregator(collection, ts_store=ts_store)
+        try:
+            asyncio.run(aggregator.serve(port=port, report_interval=30.0))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.close()
+        sys.exit(0)
+
+    # Loopback test: many boats spool records and stream them to one aggregator
+    # over flaky connections, then every record must be stored exactly once.
+    import random
+    import shutil
+    import tempfile
+
+    from spool import Spool
+
+    class MemoryCollection():
+        """Stands in for the database, with the duplicate key behaviour of insert_many."""
+
+        def __init__(self):
+            self.documents = {}
+            self.lock = threading.Lock()
+
+        def insert_many(self, documents, ordered=True):
+            errors = []
+            with self.lock:
+                for index, document in enumerate(documents):
+                    if document['_id'] in self.documents:
+                        errors.append({'index': index, 'code': DUPLICATE_KEY_ERROR})
+                    else:
+                        self.documents[document['_id']] = document
+            if errors:
+                raise BulkWriteError({'writeErrors': errors})
+
+    boats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    records = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    directory = tempfile.mkdtemp(prefix='aggregator-')
+    collection = MemoryCollection()
+    aggregator = Aggregator(collection, state_file=os.path.join(directory, 'offsets.json'), batch_size=200,
+                            flush_interval=0.1)
+    loop = asyncio.new_event_loop()
+    server = threading.Thread(target=loop.run_until_complete, args=(aggregator.serve('127.0.0.1', 0),), daemon=True)
+    server.start()
+    while aggregator.port is None:
+        time.sleep(0.01)
+
+    def boat(asvid):
+        with Spool(os.path.join(directory, f'boat-{asvid}'), f'sim-{asvid}', fsync_interval=60) as spool:
+            uploader = AggregatorUploader(spool, '127.0.0.1', aggregator.port, retry_interval=0.2,
+                                          mission={'mission': 'sim', 'asvid': asvid})
+            for i in range(records):
+                spool.append({'meta': {'asvid': asvid, 'mission': 'sim'}, 'i': i, 'timestamp': time.time()})
+                time.sleep(random.uniform(0, 0.004))
+                if random.random() < 0.005 and uploader._sock is not None:
+                    # Drop the link in the middle of the stream
+                    try:
+                        uploader._sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            deadline = time.monotonic() + 30
+            while spool.pending() and time.monotonic() < deadline:
+                time.sleep(0.05)
+            uploader.close()
+            results[asvid] = (spool.pending(), uploader.connects)
+
+    results = {}
+    start = time.perf_counter()
+    threads = [threading.Thread(target=boat, args=(asvid,)) for asvid in range(boats)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    asyncio.run_coroutine_threadsafe(aggregator.close(), loop).result(10)
+
+    stats = aggregator.stats()
+    stored = len(collection.documents)
+    per_boat = {}
+    for document in collection.documents.values():
+        per_boat.setdefault(document['meta']['asvid'], set()).add(document['i'])
+    complete = all(per_boat.get(asvid) == set(range(records)) for asvid in range(boats))
+    print(f"{boats} boats x {records} records in {elapsed:.1f} s: {stored} stored, "
+          f"{stats['inserted']} inserted in {stats['batches']} batches")
+    print(f"reconnects: {sum(connects - 1 for _, connects in results.values())}, "
+          f"duplicates dropped: {sum(s['duplicates'] for s in stats['streams'].values())}, "
+          f"left in spools: {sum(pending for pending, _ in results.values())}")
+    print("every record stored once" if complete and stored == boats * records else "MISSING OR EXTRA RECORDS")
+    shutil.rmtree(directory)
@@ -0,0 +1,628 @@
+"""
+Asyncio runtime for the Surveyor, the EXO2 sonde and the data sinks.
+
+Everything runs as tasks on one event loop: the Surveyor is read with
+asyncio.open_connection, the sonde's serial port is watched with
+loop.add_reader (or read from an executor where the loop cannot watch file
+descriptors), and blocking sinks (spool, files, pymongo) run their batches on
+their own single worker thread. One process can drive several instruments
+this way, and every wait has a timeout and can be cancelled.
+"""
+import asyncio
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+import helper as hlp
+from acquisition import FixHistory, Reading
+from exo2 import Exo2, Exo2CommandEngine, Exo2CommandError, Exo2Framing, StreamRow
+from exo2codec import Exo2Codec
+
+
+class AsyncSurveyor():
+    """
+    Surveyor client built on asyncio streams.
+
+    A reader task decodes the NMEA stream into a cache of the latest values
+    (same keys as Surveyor.get_latest) and a FixHistory, and reconnects when
+    the connection drops.
+
+    Parameters:
+        host, port: Surveyor address.
+        reconnect_interval: Seconds between connection attempts.
+        connect_timeout: Seconds to wait for the connection.
+    """
+
+    def __init__(self, host='192.168.0.50', port=8003, reconnect_interval=2.0, connect_timeout=5.0):
+        self.host = host
+        self.port = port
+        self.reconnect_interval = reconnect_interval
+        self.connect_timeout = connect_timeout
+        self.decoder = hlp.NmeaDecoder()
+        self.fixes = FixHistory()
+        self.connected = False
+        self._cache = {}
+        self._cond = None
+        self._writer = None
+        self._task = None
+        self._last_fix_time = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def start(self):
+        self._cond = asyncio.Condition()
+        self._task = asyncio.create_task(self._run(), name='surveyor-reader')
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"Error connecting to {self.host}:{self.port} - {e}")
+                await asyncio.sleep(self.reconnect_interval)
+                continue
+            self.connected = True
+            try:
+                while True:
+                    data = await reader.read(4096)
+                    if not data:
+                        print("Connection closed by the server.")
+                        break
+                    await self._update(self.decoder.feed(data))
+            except OSError as e:
+                print(f"Error receiving data - {e}")
+            finally:
+                self.connected = False
+                self._writer.close()
+                self._writer = None
+            await asyncio.sleep(self.reconnect_interval)
+
+    async def _update(self, messages):
+        if not messages:
+            return
+        now = time.monotonic()
+        async with self._cond:
+            for message in messages:
+                self._cache['$' + message.address] = (now, message)
+                if isinstance(message, hlp.GgaMessage):
+                    coordinates = (message.latitude, message.longitude)
+                    self._cache['coordinates'] = (now, coordinates)
+                    self.fixes.add(Reading(now, datetime.datetime.now(), coordinates))
+                    if message.timestamp:
+                        self._cache['timestamp'] = (now, message.timestamp)
+                elif isinstance(message, hlp.AttitudeMessage):
+                    if message.heading is not None:
+                        self._cache['heading'] = (now, message.heading)
+                elif isinstance(message, hlp.ControlModeMessage):
+                    self._cache['control_mode'] = (now, message.control_mode)
+            self._cond.notify_all()
+
+    async def get_latest(self, key, newer_than=None, timeout=None):
+        """
+        Latest value for key, see Surveyor.get_latest().
+
+        Returns:
+            (monotonic arrival time, value), or None on timeout.
+        """
+        def ready():
+            entry = self._cache.get(key)
+            return entry is not None and (newer_than is None or entry[0] > newer_than)
+
+        async with self._cond:
+            try:
+                await asyncio.wait_for(self._cond.wait_for(ready), timeout)
+            except asyncio.TimeoutError:
+                return None
+            return self._cache[key]
+
+    async def get_next_gps_coordinates(self, timeout=1.0):
+        """First fix newer than the one this method returned last, None on timeout."""
+        entry = await self.get_latest('coordinates', self._last_fix_time, timeout)
+        if entry is None:
+            return None
+        self._last_fix_time = entry[0]
+        return entry[1]
+
+    async def send(self, msg):
+        """Send a message (without $ and checksum). Returns False when not connected."""
+        if self._writer is None:
+            print("Surveyor not connected, message not sent")
+            return False
+        self._writer.write(hlp.create_nmea_message(msg).encode())
+        await self._writer.drain()
+        return True
+
+    async def set_standby_mode(self):
+        return await self.send("PSEAC,L,0,0,0,")
+
+    async def set_station_keep_mode(self):
+        return await self.send("PSEAC,R,,,,")
+
+    async def set_waypoint_mode(self):
+        return await self.send("PSEAC,W,0,0,0,")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class AsyncExo2():
+    """
+    EXO2 sonde on a serial port, driven from the event loop.
+
+    Speaks the same protocol as Exo2CommandEngine through the same
+    Exo2Framing: answers end with the '#' prompt, echo is detected per
+    command, '?Command' raises Exo2CommandError, and the command after a
+    timeout first resyncs so a late answer is not taken for its own. Lines
+    that do not answer a command are rows of run mode.
+
+    Parameters:
+        port: Serial device, or a pyserial URL such as 'socket://host:port' for a sonde behind a
+            serial-to-TCP bridge.
+        baudrate: Serial speed.
+        max_pending: Streamed rows kept before the oldest are dropped.
+    """
+
+    PROMPT = Exo2Framing.PROMPT
+    DEFAULT_TIMEOUT = Exo2CommandEngine.DEFAULT_TIMEOUT
+    TIMEOUTS = Exo2CommandEngine.TIMEOUTS
+
+    def __init__(self, port='/dev/ttyUSB0', baudrate=9600, max_pending=1000):
+        self.port = port
+        self.baudrate = baudrate
+        self.max_pending = max_pending
+        self.serial = None
+        self.sn = ""
+        self.ssn = ""
+        self.stream_rows = 0
+        self.stream_skipped = 0
+        self.stream_mismatched = 0
+        self.stream_dropped = 0
+        self._framing = Exo2Framing()
+        self._answer = None
+        self._prompt_waiters = []
+        self._rows = None
+        self._stream_fields = None
+        self._command_lock = None
+        self._loop = None
+        self._reader_task = None
+
+    @property
+    def is_echoing(self):
+        return self._framing.is_echoing
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._command_lock = asyncio.Lock()
+        self._rows = asyncio.Queue(maxsize=self.max_pending)
+        self.serial = serial.serial_for_url(self.port, baudrate=self.baudrate, bytesize=serial.EIGHTBITS,
+                                            parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
+                                            xonxoff=False, rtscts=False, timeout=0)
+        try:
+            self._loop.add_reader(self.serial.fileno(), self._on_readable)
+        except (NotImplementedError, AttributeError):
+            # No fd watching (e.g. Windows): read from a worker thread instead
+            self.serial.timeout = 0.1
+            self._reader_task = asyncio.create_task(self._read_in_executor(), name='exo2-reader')
+
+    def _on_readable(self):
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            print(f"Error reading from the sonde - {e}")
+            self._loop.remove_reader(self.serial.fileno())
+            return
+        self._feed(data)
+
+    async def _read_in_executor(self):
+        while True:
+            data = await self._loop.run_in_executor(None, self.serial.read, 256)
+            self._feed(data)
+
+    def _feed(self, data):
+        if not data:
+            return
+        for text in self._framing.lines(data):
+            prompts = self._framing.prompts
+            unsolicited = self._framing.handle_line(text)
+            if unsolicited is not None:
+                self._on_stream_line(unsolicited)
+            elif self._framing.prompts != prompts:
+                if self._answer is not None and not self._answer.done():
+                    self._answer.set_result(None)
+                for waiter in self._prompt_waiters:
+                    if not waiter.done():
+                        waiter.set_result(True)
+                self._prompt_waiters = []
+
+    def _on_stream_line(self, text):
+        if self._stream_fields is None:
+            return
+        values = text.split()
+        if len(values) < 2:
+            self.stream_skipped += 1
+            return
+        if len(values) != self._stream_fields:
+            # Passed on: the para list changed and acquire() re-reads it
+            self.stream_mismatched += 1
+        row = StreamRow(datetime.datetime.now(), time.monotonic(), text)
+        self.stream_rows += 1
+        if self._rows.full():
+            self._rows.get_nowait()
+            self.stream_dropped += 1
+        self._rows.put_nowait(row)
+
+    async def command(self, command, timeout=None):
+        """
+        Send a command and wait for the prompt.
+
+        Returns:
+            list: The answer lines, without echo and prompt.
+        """
+        if timeout is None:
+            timeout = self.TIMEOUTS.get(command.split(' ', 1)[0], self.DEFAULT_TIMEOUT)
+        async with self._command_lock:
+            if self._framing.stale:
+                await self._resync(self.DEFAULT_TIMEOUT)
+            self._framing.begin(command)
+            self._answer = self._loop.create_future()
+            self.serial.write(f"{command}\r".encode('utf-8'))
+            try:
+                await asyncio.wait_for(self._answer, timeout)
+            except asyncio.TimeoutError:
+                self._framing.timed_out()
+                raise TimeoutError(f"No prompt after '{command}' within {timeout} s")
+            except BaseException:
+                # Cancelled: the answer may still come, like after a timeout
+                self._framing.timed_out()
+                raise
+            finally:
+                self._answer = None
+            pending = self._framing.finish()
+            if pending['error']:
+                raise Exo2CommandError(f"'{command}' answered {pending['error']}")
+            return pending['lines']
+
+    async def _resync(self, timeout):
+        # See Exo2CommandEngine._resync. Returns False if the sonde did not answer the line end.
+        target, owed = self._framing.resync_target()
+        self.serial.write(b'\r')
+        deadline = time.monotonic() + timeout
+        while self._framing.prompts < target:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await self._wait_prompt(self._prompt_future(), remaining):
+                break
+        return self._framing.resynced(target, owed)
+
+    async def command_line(self, command, timeout=None):
+        lines = await self.command(command, timeout)
+        return lines[0] if lines else ""
+
+    async def wait_prompt(self, timeout=DEFAULT_TIMEOUT):
+        """Wait for the next '#' prompt. Returns True if it arrived before the timeout."""
+        return await self._wait_prompt(self._prompt_future(), timeout)
+
+    def _prompt_future(self):
+        waiter = self._loop.create_future()
+        self._prompt_waiters.append(waiter)
+        return waiter
+
+    async def _wait_prompt(self, waiter, timeout):
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def get_exo2_params(self):
+        """Parameter codes and names, like Exo2.get_exo2_params(); pauses a stream for the query."""
+        num_fields = self._stream_fields
+        param_list = []
+        if num_fields is not None:
+            await self.stop_stream()
+        try:
+            param_list = (await self.command_line('para')).split()
+        finally:
+            if num_fields is not None:
+                await self.start_stream(len(param_list) or num_fields)
+        return param_list, [Exo2.PARAMS_DICT[int(code)] for code in param_list]
+
+    async def get_sn(self):
+        if not self.sn:
+            self.sn = await self.command_line('sn')
+        return self.sn
+
+    async def get_ssn(self):
+        if not self.ssn:
+            self.ssn = await self.command_line('ssn')
+        return self.ssn
+
+    async def read_data(self):
+        return await self.command_line('data')
+
+    async def start_stream(self, num_fields):
+        """Put the sonde in run mode; rows are read with read_stream_row()."""
+        self._stream_fields = num_fields
+        async with self._command_lock:
+            self.serial.write(Exo2.RUN_COMMAND)
+
+    async def stop_stream(self, timeout=3.0):
+        """Leave run mode. Returns True if the prompt came back."""
+        self._stream_fields = None
+        async with self._command_lock:
+            waiter = self._prompt_future()
+            self.serial.write(Exo2.STOP_COMMAND)
+            return await self._wait_prompt(waiter, timeout)
+
+    async def read_stream_row(self, timeout=None):
+        """Next StreamRow, or None if none arrives within timeout seconds."""
+        try:
+            return await asyncio.wait_for(self._rows.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        if self.serial is None:
+            return
+        if self._stream_fields is not None:
+            await self.stop_stream()
+        if self._reader_task:
+            self._reader_task.cancel()
+        else:
+            self._loop.remove_reader(self.serial.fileno())
+        self.serial.close()
+        self.serial = None
+
+
+# Put on a sink's queue by close() to wake up a task waiting for records
+_CLOSE = object()
+
+
+class AsyncSink():
+    """
+    Runs a blocking batch writer off the event loop.
+
+    put() never waits: records go on a bounded queue (oldest dropped when
+    full) and a task hands batches to write_batch on the sink's own worker
+    thread, so batches are written in order and a slow sink does not hold up
+    the others. A failed batch is retried after retry_interval seconds.
+    close() lets the task write the batch it is collecting and the rest of
+    the queue before it stops.
+
+    Parameters:
+        write_batch: Blocking function taking a list of records.
+        name: Used in messages.
+        batch_size: Most records per call.
+        flush_interval: Seconds to wait for a full batch.
+        max_queue: Records queued before the oldest are dropped.
+    """
+
+    def __init__(self, write_batch, name='sink', batch_size=50, flush_interval=1.0, max_queue=10000,
+                 retry_interval=5.0):
+        self.write_batch = write_batch
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.retry_interval = retry_interval
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = None
+        self._task = None
+        self._closing = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run(), name=self.name)
+
+    def put(self, record):
+        """Queue a record. Returns False if the oldest one had to be dropped."""
+        if self._closing:
+            raise RuntimeError(f"{self.name} is closed")
+        dropped = False
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+            dropped = True
+        self._queue.put_nowait(record)
+        return not dropped
+
+    async def _next_batch(self):
+        # Up to batch_size records; once closing, only what is queued, without waiting
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if self._closing:
+                if self._queue.empty():
+                    break
+                record = self._queue.get_nowait()
+            elif deadline is None:
+                record = await self._queue.get()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if record is _CLOSE:
+                continue
+            batch.append(record)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return batch
+
+    async def _write(self, batch):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(self._executor, self.write_batch, batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                self.errors += 1
+                print(f"{self.name} failed, retrying {len(batch)} records - {e}")
+                await asyncio.sleep(self.retry_interval)
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            if batch:
+                await self._write(batch)
+            elif self._closing:
+                return
+
+    async def close(self, timeout=10.0):
+        """Write what is still queued (for at most timeout seconds) and stop."""
+        if self._task is None:
+            return
+        self._closing = True
+        # The queue is empty when the task waits for a record, so there is room
+        if not self._queue.full():
+            self._queue.put_nowait(_CLOSE)
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.name}: stopped after {timeout} s, the batch being written and "
+                  f"{self._queue.qsize()} queued records are lost")
+        self._task = None
+        self._executor.shutdown(wait=True)
+
+
+def collection_sink(collection, **options):
+    """AsyncSink that stores documents with insert_many."""
+    return AsyncSink(lambda batch: collection.insert_many(batch, ordered=False), name='mongo', **options)
+
+
+def spool_sink(spool, **options):
+    """AsyncSink that appends documents to a spool.Spool."""
+    def write(batch):
+        for record in batch:
+            spool.append(record)
+    return AsyncSink(write, name='spool', **options)
+
+
+def writer_sink(writer, **options):
+    """AsyncSink for textlog writers (anything with write_record())."""
+    def write(batch):
+        for record in batch:
+            writer.write_record(record)
+    return AsyncSink(write, name='text-log', **options)
+
+
+async def acquire(surveyor, exo, codec, sinks, asvid=0, max_rows=None, max_wait=0.5, max_skew=2.0,
+                  row_timeout=5.0, max_silence=None):
+    """
+    Pair every streamed EXO2 row with the closest GPS fix and hand the document to the sinks.
+
+    Rows are stamped when they arrive; the fix is looked up in the
+    Surveyor's FixHistory after waiting at most max_wait seconds for a newer
+    one. Pairs further apart than max_skew seconds are skipped.
+
+    Parameters:
+        surveyor: Started AsyncSurveyor.
+        exo: Open AsyncExo2, streaming.
+        codec: exo2codec.Exo2Codec for the sonde's parameters; replaced if the para list changes.
+        sinks: Started AsyncSinks.
+        max_rows: Stop after this many documents, None to run until cancelled.
+        row_timeout: Seconds without a row after which a warning is printed.
+        max_silence: Seconds without a row after which TimeoutError is raised, None to wait forever.
+
+    Returns:
+        Number of documents produced.
+    """
+    count = 0
+    metadata = {'asvid': asvid, 'sn': exo.sn, 'ssn': exo.ssn}
+    last_row = time.monotonic()
+    while max_rows is None or count < max_rows:
+        row = await exo.read_stream_row(row_timeout)
+        if row is None:
+            silence = time.monotonic() - last_row
+            if max_silence is not None and silence >= max_silence:
+                raise TimeoutError(f"No EXO2 row for {silence:.0f} s")
+            print(f"No EXO2 row for {row_timeout} s")
+            continue
+        last_row = row.monotonic
+        if surveyor.fixes.latest() is None or surveyor.fixes.latest().monotonic < row.monotonic:
+            await surveyor.get_latest('coordinates', newer_than=row.monotonic, timeout=max_wait)
+        fix = surveyor.fixes.closest(row.monotonic)
+        if fix is None or abs(fix.monotonic - row.monotonic) > max_skew:
+            continue
+        if len(row.row.split()) != codec.num_fields:
+            # The para list changed on the sonde, compile a new codec
+            keys, _ = await exo.get_exo2_params()
+            print(f"EXO2 parameters changed to {keys}")
+            codec = Exo2Codec(keys)
+        record = codec.parse(row.row, row.host_time)
+        if record is None:
+            continue
+        document = record.to_document(fix.value[0], fix.value[1], dict(metadata))
+        # Every sink gets its own dict: insert_many adds _id on the sink's
+        # thread while another sink may be serialising the document
+        for sink in sinks:
+            sink.put(dict(document))
+        count += 1
+    return count
+
+
+async def run_mission(surveyor, exo, sinks, asvid=0, max_rows=None, **options):
+    """
+    Open the instruments and sinks, run acquire() until max_rows or cancellation, then close everything.
+    """
+    async with surveyor, exo:
+        keys, _ = await exo.get_exo2_params()
+        await exo.get_sn()
+        await exo.get_ssn()
+        codec = Exo2Codec(keys)
+        for sink in sinks:
+            sink.start()
+        await exo.start_stream(num_fields=codec.num_fields)
+        try:
+            return await acquire(surveyor, exo, codec, sinks, asvid, max_rows, **options)
+        finally:
+            await exo.stop_stream()
+            for sink in sinks:
+                await sink.close()
+            print(f"EXO2 rows: {exo.stream_rows}, skipped: {exo.stream_skipped}, dropped: {exo.stream_dropped}, "
+                  f"NMEA sentences: {surveyor.decoder.sentences}, bad: {surveyor.decoder.dropped}")
+
+
+if __name__ == "__main__":
+    # python aioruntime.py [id] [mission_name] [surveyor_host] [serial_port]
+    import sys
+
+    from textlog import NdjsonWriter
+
+    asvid = sys.argv[1] if len(sys.argv) > 1 else 0
+    mission_name = sys.argv[2] if len(sys.argv) > 2 else datetime.datetime.now().strftime("%Y%m%d%H%M")
+    host = sys.argv[3] if len(sys.argv) > 3 else '192.168.0.50'
+    port = sys.argv[4] if len(sys.argv) > 4 else '/dev/ttyUSB0'
+    log = NdjsonWriter(mission_name + ".ndjson")
+    try:
+        asyncio.run(run_mission(AsyncSurveyor(host), AsyncExo2(port), [writer_sink(log)], asvid))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.close()
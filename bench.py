@@ -0,0 +1,288 @@
+"""
+Micro-benchmarks of the logger's hot paths.
+
+python bench.py [filter]
+    Run the benchmarks whose name contains filter (all by default) and compare
+    them with the baseline of this machine in bench_baseline.json. Exits with
+    status 1 if one is slower than its baseline times the tolerance, or if a
+    benchmark of the baseline did not run.
+python bench.py save [filter]
+    Run and store the results as the baseline of this machine.
+
+Baselines are kept per machine, named by BENCH_MACHINE (e.g. BENCH_MACHINE=pi4)
+or else by CPU architecture and Python version, so a change can be proven on
+the Pi it is deployed on. Record the baseline on the Pi before the change,
+then run the comparison there after it.
+"""
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+TOLERANCE = 1.25  # More than 25% slower than the baseline is a regression
+REPEAT = 5
+
+SONDE_KEYS = ['1', '5', '12', '20', '22', '53', '54', '211', '212']
+SONDE_ROW = '28.108 38.109 0.020 14.740 10.400 261018 161038 104.816 8.197'
+CENTRE = (25.912642, -80.13755)
+
+
+def machine_name():
+    return os.environ.get('BENCH_MACHINE') or \
+        f"{platform.machine()}-py{sys.version_info[0]}.{sys.version_info[1]}"
+
+
+def measure(func, repeat=REPEAT):
+    """Best and median seconds per call over repeat runs of about 0.2 s each."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [total / number for total in timer.repeat(repeat, number)]
+    return min(times), statistics.median(times)
+
+
+def _nmea_buffer():
+    """What one Surveyor receive() returns: a few GGA/PSEAA/PSEAD sets and a cut sentence."""
+    import helper as hlp
+
+    sentences = []
+    for i in range(5):
+        sentences.append(hlp.create_nmea_message(
+            f"GPGGA,1612{i:02d}.00,2554.758520,N,08008.253000,W,1,12,0.8,0.0,M,0.0,M,,"))
+        sentences.append(hlp.create_nmea_message("PSEAA,0.0,0.0,13.2,,0.0,0.00,0.00,-1.00,0.00,"))
+        sentences.append(hlp.create_nmea_message("PSEAD,W,0.0,0.0,0.0,LIDAR_OFF,,1,1"))
+    buffer = ''.join(sentences)
+    return buffer + buffer[:40]
+
+
+def _points(count, seed=1):
+    """count points within about 500 m of CENTRE."""
+    rng = random.Random(seed)
+    return [(CENTRE[0] + rng.uniform(-0.0045, 0.0045), CENTRE[1] + rng.uniform(-0.005, 0.005))
+            for _ in range(count)]
+
+
+def _near_miss(points, threshold_m):
+    """A point inside the cloud about 2 * threshold_m from its nearest point, so nothing is removed."""
+    import geodesy
+
+    offset = 2 * threshold_m / 111320.0  # Meters to degrees of latitude
+    for latitude, longitude in points:
+        candidate = (latitude + offset, longitude)
+        if geodesy.haversine(points, candidate).min() > threshold_m:
+            return candidate
+    raise ValueError("No point of the cloud is isolated enough")
+
+
+def _document():
+    from exo2codec import Exo2Codec
+
+    record = Exo2Codec(SONDE_KEYS).parse(SONDE_ROW)
+    return record.to_document(CENTRE[0], CENTRE[1], {'asvid': 1, 'sn': '23C105965', 'ssn': '23C105965'})
+
+
+class _Sonde():
+    """Answers what read_sensor_data asks the sonde, without a serial port."""
+
+    def get_exo2_params(self):
+        return SONDE_KEYS, None
+
+    def get_sn(self):
+        return '23C105965'
+
+    def get_ssn(self):
+        return '23C105965'
+
+
+def checksum_benchmarks(workdir, cleanup):
+    import helper as hlp
+
+    waypoint = "OIWPL,2554.7585,N,08008.2530,W,12"
+    gga = "GPGGA,161203.00,2554.758520,N,08008.253000,W,1,12,0.8,0.0,M,0.0,M,,"
+    return [('helper.compute_nmea_checksum[waypoint]', lambda: hlp.compute_nmea_checksum(waypoint)),
+            ('helper.compute_nmea_checksum[gga]', lambda: hlp.compute_nmea_checksum(gga))]
+
+
+def nmea_benchmarks(workdir, cleanup):
+    import helper as hlp
+
+    buffer = _nmea_buffer()
+    gga = hlp.get_gga(buffer)
+    return [('helper.get_gga', lambda: hlp.get_gga(buffer)),
+            ('helper.get_coordinates', lambda: hlp.get_coordinates(gga)),
+            ('helper.get_gga+get_coordinates', lambda: hlp.get_coordinates(hlp.get_gga(buffer)))]
+
+
+def sampler_benchmarks(workdir, cleanup):
+    from samplepoints import SamplePointIndex
+    from watersampler import WaterSamplerController
+
+    # Only the geometry is measured, so skip __init__ and its I2C bus
+    sampler = WaterSamplerController.__new__(WaterSamplerController)
+    sampler.threshold_meters = 5
+    a, b = _points(2)
+    benchmarks = [('WaterSamplerController.haversine', lambda: sampler.haversine(a, b))]
+    for count in (10, 100, 1000):
+        points = _points(count)
+        index = SamplePointIndex(points)
+        # Inside the cloud but out of reach of every point: the index has
+        # candidates to check and nothing is removed between calls
+        query = _near_miss(points, sampler.threshold_meters)
+        benchmarks.append((f"WaterSamplerController.check_and_remove_closest[list,{count}]",
+                           lambda points=points, query=query: sampler.check_and_remove_closest(query, points)))
+        benchmarks.append((f"WaterSamplerController.check_and_remove_closest[index,{count}]",
+                           lambda index=index, query=query: sampler.check_and_remove_closest(query, index)))
+    return benchmarks
+
+
+def sensor_benchmarks(workdir, cleanup):
+    # run.py connects lazily, any connection string will do
+    os.environ.setdefault('COSMODB_STRING', 'mongodb://localhost:27017')
+    import run
+    from textlog import NdjsonWriter
+
+    sonde = _Sonde()
+    writer = NdjsonWriter(os.path.join(workdir, 'bench.ndjson'))
+    cleanup.append(writer.close)
+    document = _document()
+    return [('run.read_sensor_data',
+             lambda: run.read_sensor_data(sonde, CENTRE, 1, data_string=SONDE_ROW)),
+            ('run.save_data_to_file[ndjson]', lambda: run.save_data_to_file([writer], document))]
+
+
+def serialisation_benchmarks(workdir, cleanup):
+    document = _document()
+    return [('json.dumps[document]', lambda: json.dumps(document, default=str))]
+
+
+def waypoint_benchmarks(workdir, cleanup):
+    import helper as hlp
+
+    erp_file = os.path.join(workdir, 'erp.csv')
+    with open(erp_file, 'w') as f:
+        f.write(f"latitude,longitude\n{CENTRE[0]},{CENTRE[1]}\n")
+    benchmarks = []
+    for count in (10, 100, 1000, 10000):
+        filename = os.path.join(workdir, f"waypoints-{count}.csv")
+        with open(filename, 'w') as f:
+            f.write("latitude,longitude\n")
+            f.writelines(f"{lat},{lon}\n" for lat, lon in _points(count))
+        benchmarks.append((f"helper.create_way_point_messages_df[{count}]",
+                           lambda filename=filename: hlp.create_way_point_messages_df(filename, erp_file)))
+    mission_file = os.path.join(workdir, 'mission.sea')
+    for count in (1000, 10000, 100000):
+        points = _points(count)
+        benchmarks.append((f"helper.write_waypoint_mission[{count}]",
+                           lambda points=points: hlp.write_waypoint_mission(mission_file, points, CENTRE)))
+    return benchmarks
+
+
+GROUPS = [checksum_benchmarks, nmea_benchmarks, sampler_benchmarks, sensor_benchmarks,
+          serialisation_benchmarks, waypoint_benchmarks]
+
+
+def run_benchmarks(name_filter=''):
+    """Run the benchmarks whose name contains name_filter; returns {name: {'best': s, 'median': s}}."""
+    results = {}
+    cleanup = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            for group in GROUPS:
+                try:
+                    benchmarks = group(workdir, cleanup)
+                except ImportError as e:
+                    print(f"Skipping {group.__name__} - {e}")
+                    continue
+                for name, func in benchmarks:
+                    if name_filter not in name:
+                        continue
+                    best, median = measure(func)
+                    results[name] = {'best': best, 'median': median}
+                    print(f"{name:<58} {best * 1e6:12.2f} us {median * 1e6:12.2f} us")
+        finally:
+            for close in cleanup:
+                close()
+    return results
+
+
+def load_baselines(filename=BASELINE_FILE):
+    if not os.path.exists(filename):
+        return {'tolerance': TOLERANCE, 'tolerances': {}, 'machines': {}}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_baseline(results, machine, filename=BASELINE_FILE):
+    baselines = load_baselines(filename)
+    entry = baselines['machines'].setdefault(machine, {'results': {}})
+    entry['recorded'] = datetime.date.today().isoformat()
+    entry['platform'] = platform.platform()
+    entry['results'].update(results)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(filename + '.tmp', filename)
+
+
+def compare(results, machine, filename=BASELINE_FILE, name_filter=''):
+    """
+    Compare best times with the machine's baseline.
+
+    Baseline entries without a result (e.g. a group skipped for a missing
+    module) are listed as missing, so a benchmark that did not run is not
+    taken for a pass.
+
+    Returns:
+        (names slower than baseline times their tolerance, names in the baseline that did not run)
+    """
+    baselines = load_baselines(filename)
+    baseline = baselines['machines'].get(machine)
+    if baseline is None:
+        print(f"No baseline for {machine} in {filename}, record one with: python bench.py save")
+        return [], []
+    regressions = []
+    print(f"\nCompared with the {machine} baseline of {baseline.get('recorded')}")
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            print(f"{name:<58} no baseline")
+            continue
+        ratio = result['best'] / previous['best']
+        tolerance = baselines.get('tolerances', {}).get(name, baselines.get('tolerance', TOLERANCE))
+        status = 'ok'
+        if ratio > tolerance:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / tolerance:
+            status = 'faster'
+        print(f"{name:<58} {previous['best'] * 1e6:12.2f} us -> {result['best'] * 1e6:12.2f} us "
+              f"x{ratio:5.2f} {status}")
+    missing = sorted(name for name in baseline['results'] if name_filter in name and name not in results)
+    for name in missing:
+        print(f"{name:<58} {baseline['results'][name]['best'] * 1e6:12.2f} us -> not run MISSING")
+    return regressions, missing
+
+
+if __name__ == "__main__":
+    save = len(sys.argv) > 1 and sys.argv[1] == 'save'
+    args = sys.argv[2:] if save else sys.argv[1:]
+    name_filter = args[0] if args else ''
+    machine = machine_name()
+    print(f"{'benchmark':<58} {'best':>15} {'median':>15}   ({machine}, {platform.python_implementation()})")
+    results = run_benchmarks(name_filter)
+    if save:
+        save_baseline(results, machine)
+        print(f"Saved {len(results)} results as the {machine} baseline in {BASELINE_FILE}")
+        sys.exit(0)
+    regressions, missing = compare(results, machine, name_filter=name_filter)
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+    if missing:
+        print(f"{len(missing)} benchmarks did not run: {', '.join(missing)}")
+    if regressions or missing:
+        sys.exit(1)
@@ -0,0 +1,267 @@
+import collections
+import json
+import os
+import threading
+import time
+
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, PyMongoError
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class BatchedDBWriter():
+    """
+    Background MongoDB writer.
+
+    Records are put on a bounded in-memory queue by the acquisition loop and
+    a worker thread flushes them with insert_many once batch_size records are
+    waiting or flush_interval seconds have passed since the last flush.
+
+    When the queue is full the policy decides what happens to a new record:
+        BLOCK: the caller waits until the worker makes room.
+        DROP_OLDEST: the oldest queued record is discarded.
+        SPILL: the record is appended to spill_file and uploaded once the
+               queue has drained.
+
+    A batch that fails for another reason than the connection (e.g. an
+    InvalidDocument) is retried record by record, and the records that still
+    fail are appended to rejected_file instead of being retried forever.
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    SPILL = 'spill'
+
+    def __init__(self, collection, batch_size=50, flush_interval=1.0, max_queue=1000,
+                 policy=BLOCK, spill_file='db_spill.jsonl', retry_interval=5.0,
+                 rejected_file='db_rejected.jsonl'):
+        if policy not in (self.BLOCK, self.DROP_OLDEST, self.SPILL):
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.policy = policy
+        self.spill_file = spill_file
+        self.retry_interval = retry_interval
+        self.rejected_file = rejected_file
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._spilled_pending = os.path.isfile(spill_file) or os.path.isfile(spill_file + '.replay')
+
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.flush_count = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def put(self, record):
+        """
+        Queue a record for insertion. Returns False if a record was dropped.
+
+        The record is stored as given, so callers that keep using the dict
+        afterwards should pass a copy (insert_many adds an _id field).
+        """
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError("Writer is closed")
+            if len(self._queue) >= self.max_queue:
+                if self.policy == self.BLOCK:
+                    while len(self._queue) >= self.max_queue and not self._stopping:
+                        self._cond.wait()
+                    if self._stopping:
+                        raise RuntimeError("Writer is closed")
+                elif self.policy == self.DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                    self._queue.append(record)
+                    self.queued += 1
+                    self._cond.notify_all()
+                    return False
+                else:
+                    self._spill(record)
+                    return True
+            self._queue.append(record)
+            self.queued += 1
+            if len(self._queue) > self.max_depth:
+                self.max_depth = len(self._queue)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def stats(self):
+        """Return a snapshot of the queue and flush counters."""
+        with self._cond:
+            return {
+                'depth': len(self._queue),
+                'max_depth': self.max_depth,
+                'queued': self.queued,
+                'flushed': self.flushed,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'flushes': self.flush_count,
+                'last_flush_latency': self.last_flush_latency,
+                'max_flush_latency': self.max_flush_latency,
+                'mean_flush_latency': (self.total_flush_latency / self.flush_count) if self.flush_count else 0.0,
+            }
+
+    def close(self, timeout=None):
+        """Flush everything still queued and stop the worker thread."""
+        with self._cond:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _spill(self, record):
+        # Called with the lock held; spilling is rare so the write stays simple.
+        # The _id is fixed here so a replay that fails half way can be retried.
+        record.setdefault('_id', ObjectId())
+        with open(self.spill_file, 'a') as f:
+            f.write(json_util.dumps(record) + "\n")
+        self.spilled += 1
+        self._spilled_pending = True
+
+    def _spill_remaining(self):
+        with self._cond:
+            if self.policy != self.SPILL:
+                if self._queue:
+                    print(f"Discarding {len(self._queue)} records that could not be written")
+                return
+            while self._queue:
+                self._spill(self._queue.popleft())
+
+    def _take_batch(self):
+        with self._cond:
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._queue) < self.batch_size and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            self._cond.notify_all()
+            return batch
+
+    def _requeue(self, batch):
+        with self._cond:
+            self._queue.extendleft(reversed(batch))
+
+    def _insert(self, batch):
+        start = time.monotonic()
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # A retried batch may already be partly stored; duplicates are fine.
+            errors = e.details.get('writeErrors', [])
+            if any(err.get('code') != DUPLICATE_KEY_ERROR for err in errors):
+                raise
+        latency = time.monotonic() - start
+        with self._cond:
+            self.flushed += len(batch)
+            self.flush_count += 1
+            self.last_flush_latency = latency
+            self.total_flush_latency += latency
+            if latency > self.max_flush_latency:
+                self.max_flush_latency = latency
+
+    def _write(self, batch):
+        """Insert a batch; if it fails for another reason than the connection, insert it record by record."""
+        try:
+            self._insert(batch)
+        except PyMongoError:
+            raise
+        except Exception as e:
+            print(f"Error writing batch to DB, retrying record by record - {e!r}")
+            # insert_many has already given every record its _id, so a record
+            # stored before a connection error is only a duplicate on retry
+            for record in batch:
+                try:
+                    self._insert([record])
+                except PyMongoError:
+                    raise
+                except Exception as e:
+                    self._reject(record, e)
+
+    def _reject(self, record, error):
+        """Set aside a record the server or the encoder refuses, so it is kept but not retried."""
+        print(f"Rejected record written to {self.rejected_file} - {error!r}")
+        try:
+            line = json_util.dumps(record)
+        except Exception:
+            line = json.dumps(record, default=str)
+        with open(self.rejected_file, 'a') as f:
+            f.write(line + "\n")
+        with self._cond:
+            self.rejected += 1
+
+    def _replay_spill(self):
+        replay_file = self.spill_file + '.replay'
+        with self._cond:
+            if not os.path.isfile(replay_file):
+                os.replace(self.spill_file, replay_file)
+            self._spilled_pending = os.path.isfile(self.spill_file)
+        records = []
+        with open(replay_file, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json_util.loads(line))
+                except ValueError as e:
+                    print(f"Skipping unreadable line in {replay_file} - {e}")
+        for i in range(0, len(records), self.batch_size):
+            self._write(records[i:i + self.batch_size])
+        os.remove(replay_file)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                if batch:
+                    self._write(batch)
+                elif self._spilled_pending and not self._stopping:
+                    self._replay_spill()
+            except Exception as e:
+                # Connection problems, and anything else that would otherwise
+                # end this thread and leave BLOCK callers waiting forever
+                print(f"Error writing batch to DB - {e!r}")
+                with self._cond:
+                    self.errors += 1
+                    if not batch:
+                        self._spilled_pending = True
+                if batch:
+                    self._requeue(batch)
+                if self._stopping:
+                    self._spill_remaining()
+                    return
+                time.sleep(self.retry_interval)
+                continue
+            with self._cond:
+                if self._stopping and not self._queue:
+                    return
@@ -0,0 +1,547 @@
+"""
+Protocol-level emulators of the EXO2 sonde and the Surveyor, for load and
+soak tests without hardware.
+
+Exo2Emulator answers the sonde's terminal commands on a pseudo-terminal,
+SurveyorEmulator serves the Surveyor's NMEA stream on a TCP port. Both send
+through a FaultInjector, which can delay, fragment, corrupt or drop what they
+write.
+
+python emulators.py [vessels] [fleet_config] [fault options]
+    Start one sonde and one Surveyor per vessel and write a fleet.py config
+    for them, e.g. python emulators.py 4 fleet-emu.yaml latency=0.05 corrupt=0.01
+"""
+import datetime
+import os
+import pty
+import random
+import select
+import socket
+import threading
+import time
+import tty
+
+import helper as hlp
+from exo2 import Exo2
+from exo2codec import DATE_FORMATS, TIME_CODE
+from geodesy import destination_sphere, haversine, initial_bearing
+
+DEFAULT_PARAMS = (1, 5, 12, 20, 22, 53, 54, 211, 212)
+# Typical readings (value, random walk step) for the synthetic rows
+TYPICAL_VALUES = {
+    1: (28.1, 0.01),     # Temperature (C)
+    5: (38.1, 0.05),     # Conductivity (uS/cm)
+    12: (0.02, 0.001),   # Salinity (PPT)
+    20: (14.74, 0.001),  # Pressure (psi a)
+    22: (10.4, 0.001),   # Depth (m)
+    211: (104.9, 0.1),   # ODO (% sat)
+    212: (8.2, 0.01),    # ODO (mg/l)
+}
+
+
+class FaultInjector():
+    """
+    Faults applied to the bytes an emulator writes.
+
+    Parameters:
+        latency: Seconds added before every write.
+        jitter: Up to this many seconds added on top of latency, uniformly distributed.
+        fragment: Probability that a write is split into pieces of 1 .. max_fragment bytes.
+        corrupt: Probability that one bit of a write is flipped.
+        drop: Probability that a write is lost.
+        fragment_gap: Seconds between the pieces of a fragmented write.
+        seed: Seed of the random generator, for repeatable runs.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, fragment=0.0, corrupt=0.0, drop=0.0, max_fragment=8,
+                 fragment_gap=0.001, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.fragment = fragment
+        self.corrupt = corrupt
+        self.drop = drop
+        self.max_fragment = max_fragment
+        self.fragment_gap = fragment_gap
+        self.random = random.Random(seed)
+        self.writes = 0
+        self.fragmented = 0
+        self.corrupted = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_options(cls, options):
+        """FaultInjector from 'name=value' strings, e.g. ['latency=0.1', 'corrupt=0.01']."""
+        kwargs = {}
+        for option in options:
+            name, _, value = option.partition('=')
+            kwargs[name] = int(value) if name in ('max_fragment', 'seed') else float(value)
+        return cls(**kwargs)
+
+    def delay(self):
+        return self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def write(self, write, data):
+        """Send data with write(bytes) after applying the faults. Returns False if the write was dropped."""
+        self.writes += 1
+        delay = self.delay()
+        if delay > 0:
+            time.sleep(delay)
+        if self.drop and self.random.random() < self.drop:
+            self.dropped += 1
+            return False
+        if self.corrupt and data and self.random.random() < self.corrupt:
+            data = bytearray(data)
+            position = self.random.randrange(len(data))
+            data[position] ^= 1 << self.random.randrange(8)
+            data = bytes(data)
+            self.corrupted += 1
+        if self.fragment and len(data) > 1 and self.random.random() < self.fragment:
+            self.fragmented += 1
+            position = 0
+            while position < len(data):
+                size = self.random.randint(1, self.max_fragment)
+                write(data[position:position + size])
+                position += size
+                if position < len(data) and self.fragment_gap:
+                    time.sleep(self.fragment_gap)
+        else:
+            write(data)
+        return True
+
+    def stats(self):
+        return {'writes': self.writes, 'fragmented': self.fragmented, 'corrupted': self.corrupted,
+                'dropped': self.dropped}
+
+
+class Exo2Emulator():
+    """
+    EXO2 sonde on a pseudo-terminal; open self.port like the sonde's serial port.
+
+    Commands end with '\\r'. Every answer is the echoed command (while echo is
+    on), the answer lines and the '#' prompt, each line ending in '\\r\\n'.
+    Supported: para [codes], data, run, sn, ssn, setecho [0|1], time [hh:mm:ss],
+    date [yy/mm/dd]; anything else gets '?Command'. In run mode a row is sent
+    every sample_interval seconds until any byte arrives, which stops the run
+    and brings back the prompt.
+
+    Parameters:
+        params: Parameter codes of the para list.
+        sample_interval: Seconds between rows in run mode, None to only send the rows given to emit().
+        faults: FaultInjector for everything written, None for a clean line.
+    """
+
+    def __init__(self, params=DEFAULT_PARAMS, sn='23C105965', ssn=None, echo=True, sample_interval=1.0,
+                 faults=None, seed=None):
+        self.params = [int(code) for code in params]
+        self.sn = sn
+        self.ssn = ssn if ssn is not None else sn
+        self.echo = echo
+        self.sample_interval = sample_interval
+        self.faults = faults or FaultInjector()
+        self.random = random.Random(seed)
+        self.clock_offset = datetime.timedelta(0)
+        self.master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.running = threading.Event()
+        self.commands = []
+        self.rows = 0
+        self.lost = 0
+        self._values = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve, name='exo2-emulator', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def now(self):
+        """The sonde's clock."""
+        return datetime.datetime.now() + self.clock_offset
+
+    def _write(self, data):
+        with self._lock:
+            self.faults.write(lambda chunk: os.write(self.master, chunk), data)
+
+    def make_row(self):
+        """One synthetic row for the current para list."""
+        now = self.now()
+        fields = []
+        for code in self.params:
+            if code in DATE_FORMATS:
+                fields.append(now.strftime(DATE_FORMATS[code]))
+            elif code == TIME_CODE:
+                fields.append(now.strftime('%H%M%S'))
+            else:
+                value, step = TYPICAL_VALUES.get(code, (1.0, 0.01))
+                value = self._values.get(code, value) + self.random.uniform(-step, step)
+                self._values[code] = value
+                fields.append(f"{value:.3f}")
+        return ' '.join(fields)
+
+    def _set_params(self, codes):
+        try:
+            params = [int(code) for code in codes]
+        except ValueError:
+            return '?Parameter'
+        if not params or any(code not in Exo2.PARAMS_DICT for code in params):
+            return '?Parameter'
+        self.params = params
+        self._values = {}
+        return 'OK'
+
+    def _set_clock(self, value, parse):
+        try:
+            target = parse(value)
+        except ValueError:
+            return '?Parameter'
+        self.clock_offset += target - self.now()
+        return 'OK'
+
+    def answer(self, command):
+        """Answer lines for a command, None for 'run'."""
+        name, _, argument = command.partition(' ')
+        argument = argument.strip()
+        if name == 'para':
+            return [self._set_params(argument.split())] if argument else [' '.join(map(str, self.params))]
+        if name == 'data':
+            self.rows += 1
+            return [self.make_row()]
+        if name == 'sn':
+            return [self.sn]
+        if name == 'ssn':
+            return [self.ssn]
+        if name == 'setecho':
+            if not argument:
+                return ['1' if self.echo else '0']
+            if argument not in ('0', '1'):
+                return ['?Parameter']
+            self.echo = argument == '1'
+            return ['OK']
+        if name == 'time':
+            if not argument:
+                return [self.now().strftime('%H:%M:%S')]
+            now = self.now()
+            return [self._set_clock(argument, lambda value: datetime.datetime.combine(
+                now.date(), datetime.datetime.strptime(value, '%H:%M:%S').time()))]
+        if name == 'date':
+            if not argument:
+                return [self.now().strftime('%y/%m/%d')]
+            now = self.now()
+            return [self._set_clock(argument, lambda value: datetime.datetime.combine(
+                datetime.datetime.strptime(value, '%y/%m/%d').date(), now.time()))]
+        if name == 'run':
+            return None
+        if not name:
+            return []
+        return ['?Command']
+
+    def _command(self, command):
+        self.commands.append(command)
+        # The echo is sent before the sonde looks at the command
+        lines = [command] if self.echo else []
+        answer = self.answer(command)
+        if answer is None:
+            self._write(('\r\n'.join(lines) + '\r\n').encode('ascii'))
+            self.running.set()
+            return
+        self._write(('\r\n'.join(lines + answer) + '\r\n#').encode('ascii'))
+
+    def _serve(self):
+        buffer = b''
+        next_row = None
+        while not self._closed:
+            timeout = 0.2
+            if self.running.is_set() and self.sample_interval:
+                if next_row is None:
+                    next_row = time.monotonic() + self.sample_interval
+                timeout = max(0.0, next_row - time.monotonic())
+            try:
+                readable, _, _ = select.select([self.master], [], [], timeout)
+                data = os.read(self.master, 1024) if readable else b''
+            except (OSError, ValueError):
+                return
+            if self.running.is_set():
+                if data:
+                    # Any byte ends run mode
+                    self.running.clear()
+                    next_row = None
+                    buffer = b''
+                    self._write(b'\r\n#')
+                elif next_row is not None and time.monotonic() >= next_row:
+                    self.emit((self.make_row() + '\r\n').encode('ascii'))
+                    next_row += self.sample_interval
+                continue
+            buffer += data
+            while b'\r' in buffer:
+                command, buffer = buffer.split(b'\r', 1)
+                self._command(command.decode('ascii', 'replace').strip())
+
+    def emit(self, data):
+        """Send a row (bytes with line end) while in run mode, e.g. from a replay."""
+        if self.running.is_set():
+            self._write(data)
+            self.rows += 1
+        else:
+            self.lost += 1
+
+    def close(self):
+        self._closed = True
+        self._thread.join(1)
+        os.close(self.master)
+        os.close(self._slave)
+
+
+class SurveyorEmulator():
+    """
+    Surveyor on a TCP port; clients get its NMEA stream and may send commands.
+
+    Every 1 / rate seconds a GPGGA, PSEAA and PSEAD sentence (see sentences)
+    is sent to every client. Commands are decoded like the real vessel does:
+    PSEAC changes the control mode (thruster, heading, waypoint, go to ERP,
+    standby, station keep, file download), PSEAR sets the waypoint throttle,
+    and the OIWPL sentences of a file download become the waypoint list. In
+    waypoint mode the vessel moves at throttle percent of max_speed towards
+    the next waypoint.
+
+    Parameters:
+        rate: Sentences per second, None to only send what is given to send().
+        position: Start (latitude, longitude).
+        faults: FaultInjector for everything sent, one generator shared by all clients.
+    """
+
+    SENTENCES = ('GPGGA', 'PSEAA', 'PSEAD')
+
+    def __init__(self, host='127.0.0.1', port=0, rate=5.0, position=(25.912642, -80.13755), heading=0.0,
+                 max_speed=2.0, sentences=SENTENCES, faults=None, arrival_radius=2.0):
+        self.rate = rate
+        self.position = tuple(position)
+        self.heading = heading
+        self.max_speed = max_speed
+        self.sentences = sentences
+        self.faults = faults or FaultInjector()
+        self.arrival_radius = arrival_radius
+        self.mode = 'L'
+        self.thrust = 0
+        self.throttle = 0
+        self.erp = self.position
+        self.waypoints = []
+        self.commands = []
+        self.received = bytearray()
+        self.sent = 0
+        self.lost = 0
+        self.server = socket.create_server((host, port))
+        self.host = host
+        self.port = self.server.getsockname()[1]
+        self._clients = []
+        self._clients_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._stop = threading.Event()
+        self._downloading = False
+        self._threads = [threading.Thread(target=self._accept, name='surveyor-emulator', daemon=True)]
+        if rate:
+            self._threads.append(threading.Thread(target=self._tick, name='surveyor-emulator-tick', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._clients_lock:
+                self._clients.append(client)
+            self._connected.set()
+            threading.Thread(target=self._read, args=(client,), name='surveyor-emulator-client', daemon=True).start()
+
+    def _read(self, client):
+        buffer = b''
+        while not self._stop.is_set():
+            try:
+                data = client.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            self.received += data
+            buffer += data
+            *lines, buffer = buffer.split(b'\r\n')
+            for line in lines:
+                # Surveyor.send() wraps prepared sentences a second time ('$$...*cs\r\n*cs'),
+                # which the vessel accepts: drop the extra '$' and the stray checksum line
+                message = hlp.parse_nmea_sentence(line[1:] if line.startswith(b'$$') else line)
+                if message is not None:
+                    self.command(message)
+        with self._clients_lock:
+            if client in self._clients:
+                self._clients.remove(client)
+            if not self._clients:
+                self._connected.clear()
+        client.close()
+
+    def command(self, message):
+        """Apply a decoded command sentence."""
+        self.commands.append(message)
+        fields = message.data
+        if message.address == 'PSEAC' and fields:
+            mode = fields[0]
+            if mode == 'F':
+                # 'F,<lines>,...' starts a waypoint file, 'F,000,...' ends it
+                count = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else 0
+                self._downloading = count > 0
+                if self._downloading:
+                    self.waypoints = []
+                return
+            if mode == 'T' and len(fields) > 2:
+                self.thrust = _to_int(fields[2])
+            elif mode == 'C' and len(fields) > 2:
+                self.heading = float(_to_int(fields[1]) % 360)
+                self.thrust = _to_int(fields[2])
+            elif mode in ('L', 'R'):
+                self.thrust = 0
+            self.mode = mode
+        elif message.address == 'PSEAR' and len(fields) > 2:
+            self.throttle = _to_int(fields[2])
+        elif message.address == 'OIWPL' and len(fields) > 3:
+            try:
+                point = (hlp.nmea_degrees_to_decimal(fields[0], fields[1]),
+                         hlp.nmea_degrees_to_decimal(fields[2], fields[3]))
+            except ValueError:
+                return
+            self.waypoints.append(point)
+
+    def wait_client(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def send(self, data):
+        """Send bytes to every client."""
+        with self._clients_lock:
+            clients = list(self._clients)
+        if not clients:
+            self.lost += 1
+            return
+        with self._send_lock:
+            for client in clients:
+                try:
+                    self.faults.write(client.sendall, data)
+                except OSError:
+                    self.lost += 1
+        self.sent += 1
+
+    def _move(self, dt):
+        speed = 0.0
+        if self.mode == 'W' and self.waypoints:
+            target = self.waypoints[0]
+            if float(haversine(self.position, target)) <= self.arrival_radius:
+                self.waypoints.pop(0)
+                return
+            self.heading = float(initial_bearing(self.position, target))
+            speed = self.max_speed * self.throttle / 100
+        elif self.mode == 'H':
+            if float(haversine(self.position, self.erp)) > self.arrival_radius:
+                self.heading = float(initial_bearing(self.position, self.erp))
+                speed = self.max_speed * max(self.throttle, 20) / 100
+        elif self.mode in ('T', 'C'):
+            speed = self.max_speed * self.thrust / 100
+        if speed:
+            self.position = tuple(float(v) for v in destination_sphere(self.position, speed * dt, self.heading))
+
+    def nmea(self, address):
+        """One sentence (bytes) of the current state."""
+        lat, lon = self.position
+        if address == 'GPGGA':
+            utc = datetime.datetime.now(datetime.timezone.utc)
+            body = (f"GPGGA,{utc:%H%M%S}.{utc.microsecond // 10000:02d},"
+                    f"{_nmea_degrees(lat, 2)},{hlp.get_hemisphere_lat(lat)},"
+                    f"{_nmea_degrees(lon, 3)},{hlp.get_hemisphere_lon(lon)},1,12,0.8,0.0,M,0.0,M,,")
+        elif address == 'PSEAA':
+            body = f"PSEAA,0.0,0.0,{self.heading:.1f},,0.0,0.00,0.00,-1.00,0.00,"
+        elif address == 'PSEAD':
+            body = f"PSEAD,{self.mode},0.0,0.0,0.0,LIDAR_OFF,,1,1"
+        else:
+            body = address
+        return hlp.create_nmea_message(body).encode('ascii')
+
+    def _tick(self):
+        interval = 1.0 / self.rate
+        next_tick = time.monotonic()
+        while not self._stop.wait(max(0.0, next_tick - time.monotonic())):
+            self._move(interval)
+            if self._connected.is_set():
+                self.send(b''.join(self.nmea(address) for address in self.sentences))
+            next_tick += interval
+
+    def close(self):
+        self._stop.set()
+        self.server.close()
+        with self._clients_lock:
+            for client in self._clients:
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                client.close()
+            self._clients = []
+
+
+def _to_int(value):
+    try:
+        return int(float(value))
+    except ValueError:
+        return 0
+
+
+def _nmea_degrees(value, width):
+    # Six decimals of minutes, finer than the four of helper.convert_*_to_nmea_degrees_minutes
+    degrees = int(abs(value))
+    minutes = (abs(value) - degrees) * 60
+    return f"{degrees:0{width}d}{minutes:09.6f}"
+
+
+if __name__ == "__main__":
+    import sys
+
+    import yaml
+
+    vessels = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    config_file = sys.argv[2] if len(sys.argv) > 2 else 'fleet-emu.yaml'
+    options = sys.argv[3:]
+    emulators = []
+    config = {'mission': 'emulated', 'vessels': []}
+    for asvid in range(1, vessels + 1):
+        position = destination_sphere((25.912642, -80.13755), 50.0 * asvid, 90.0)
+        exo = Exo2Emulator(sn=f"EMU{asvid:06d}", faults=FaultInjector.from_options(options))
+        surveyor = SurveyorEmulator(position=tuple(float(v) for v in position),
+                                    faults=FaultInjector.from_options(options))
+        emulators.append((exo, surveyor))
+        config['vessels'].append({'asvid': asvid, 'surveyor': f"127.0.0.1:{surveyor.port}", 'sonde': exo.port})
+        print(f"ASV {asvid}: sonde {exo.port}, Surveyor 127.0.0.1:{surveyor.port}")
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    print(f"Wrote {config_file}, run: python fleet.py {config_file}")
+    try:
+        while True:
+            time.sleep(30)
+            for exo, surveyor in emulators:
+                print(f"{exo.port}: {exo.rows} rows, faults {exo.faults.stats()} | "
+                      f"Surveyor :{surveyor.port} mode {surveyor.mode}, {surveyor.sent} sends, "
+                      f"faults {surveyor.faults.stats()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for exo, surveyor in emulators:
+            exo.close()
+            surveyor.close()
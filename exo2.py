@@ -4,6 +4,261 @@ from serial.tools import list_ports
 import requests
 import time
 import datetime
+import collections
+import queue
+import threading
+
+import metrics
+
+# A row received while the sonde is in run mode, stamped when it arrived on the host
+StreamRow = collections.namedtuple('StreamRow', ['host_time', 'monotonic', 'row'])
+
+TIMEOUTS = metrics.counter('exo2_timeouts_total', 'Sonde commands without an answer in time')
+ERRORS = metrics.counter('exo2_errors_total', "Sonde commands answered with '?'")
+STREAM_ROWS = metrics.counter('exo2_stream_rows_total', 'Rows received in run mode')
+STREAM_SKIPPED = metrics.counter('exo2_stream_skipped_total', 'Run mode lines that were not a valid row')
+STREAM_MISMATCHED = metrics.counter('exo2_stream_mismatched_total',
+	'Run mode rows whose number of values differs from the para list')
+STREAM_DROPPED = metrics.counter('exo2_stream_dropped_total', 'Run mode rows dropped because nobody read them')
+
+class Exo2CommandError(Exception):
+	"""Raised when the sonde answers a command with '?Command'."""
+
+
+class Exo2Framing():
+	"""
+	The sonde's side of the protocol without any I/O, shared by
+	Exo2CommandEngine and aioruntime.AsyncExo2.
+
+	Frames the received bytes into lines, counts the '#' prompts that end
+	every answer and hands the lines in between to the pending command. If
+	the first line is the command itself the sonde is echoing. After a
+	timeout the framing is stale: the timed out command may still owe its
+	answer and prompt, so the next command first resyncs with a bare line
+	end (see resync_target).
+	"""
+
+	PROMPT = '#'
+
+	def __init__(self):
+		self.buffer = b''
+		self.pending = None
+		self.prompts = 0
+		self.is_echoing = None  # Unknown until the first command is answered
+		self.stale = False
+		self.stale_prompts = 0
+
+	def lines(self, data):
+		"""Split received bytes into lines; a trailing prompt counts as one although no line end follows it."""
+		self.buffer += data
+		*lines, self.buffer = self.buffer.split(b'\n')
+		texts = [line.decode('utf-8', 'replace').strip() for line in lines]
+		if self.buffer.strip() == self.PROMPT.encode():
+			self.buffer = b''
+			texts.append(self.PROMPT)
+		return [text for text in texts if text]
+
+	def handle_line(self, text):
+		"""Account one line. Returns the line if no command is waiting for it, else None."""
+		pending = self.pending
+		if text == self.PROMPT:
+			self.prompts += 1
+			if pending is not None:
+				pending['done'] = True
+			return None
+		if pending is not None and not pending['done']:
+			if not pending['lines'] and not pending['echo'] and text == pending['command']:
+				pending['echo'] = True
+			elif text.startswith('?'):
+				pending['error'] = text
+			else:
+				pending['lines'].append(text)
+			return None
+		return text
+
+	def begin(self, command):
+		"""Start waiting for the answer to command; returns its pending state."""
+		self.pending = {'command': command, 'lines': [], 'echo': False, 'error': None, 'done': False}
+		return self.pending
+
+	def finish(self):
+		"""The pending command got its prompt; returns its pending state."""
+		pending = self.pending
+		self.pending = None
+		self.is_echoing = pending['echo']
+		return pending
+
+	def timed_out(self):
+		"""The pending command got no prompt in time: its answer may still come."""
+		self.pending = None
+		self.stale = True
+		self.stale_prompts = self.prompts
+
+	def resync_target(self):
+		"""
+		Prompt count to wait for after sending a bare line end.
+
+		The timed out command may still owe a prompt and the line end asks for
+		one more: wait for both, so neither ends the next answer.
+
+		Returns:
+			(target, owed): owed is 1 if the timed out prompt had not come yet.
+		"""
+		owed = 1 if self.prompts == self.stale_prompts else 0
+		return self.prompts + owed + 1, owed
+
+	def resynced(self, target, owed):
+		"""Whether the resync worked: every prompt came, or only the line end went unanswered while one was owed."""
+		ok = self.prompts >= target or (self.prompts == target - 1 and owed == 1)
+		if ok:
+			self.stale = False
+		return ok
+
+
+class Exo2CommandEngine():
+	"""
+	Serial command/response engine for the EXO2 sonde.
+
+	A background thread owns the reading side of the port and feeds it to an
+	Exo2Framing, which recognises the '#' prompt that ends every answer and
+	hands the lines in between to the command that is waiting for them. Echo
+	is detected on every command, so the engine works with echo on or off.
+	Lines that arrive while no command is waiting (e.g. rows in run mode) go
+	to on_line. After a timeout the next command first waits for a fresh
+	prompt, so a late answer is not taken for its own.
+
+	Args:
+		serial_port: An open serial.Serial.
+		on_line: Optional function called with every unsolicited line.
+	"""
+
+	PROMPT = Exo2Framing.PROMPT
+	DEFAULT_TIMEOUT = 3.0
+	# Commands the sonde answers from memory get less than the default, so a
+	# lost answer is noticed sooner
+	TIMEOUTS = {
+		'data': 2.0,
+		'para': 2.0,
+		'sn': 2.0,
+		'ssn': 2.0,
+	}
+
+	def __init__(self, serial_port, on_line=None):
+		self.serial = serial_port
+		self.on_line = on_line
+		self.commands = 0
+		self.timeouts = 0
+		self.errors = 0
+		self._command_lock = threading.Lock()
+		self._cond = threading.Condition()
+		self._framing = Exo2Framing()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._read, name='exo2-reader', daemon=True)
+		self._thread.start()
+
+	@property
+	def is_echoing(self):
+		"""Whether the sonde echoed the last answered command, None before the first."""
+		return self._framing.is_echoing
+
+	def _read(self):
+		while not self._stop.is_set():
+			try:
+				data = self.serial.read(self.serial.in_waiting or 1)
+			except (serial.SerialException, TypeError, OSError) as e:
+				if not self._stop.is_set():
+					print(f"Error reading from the sonde - {e}")
+				return
+			if not data:
+				continue
+			for text in self._framing.lines(data):
+				with self._cond:
+					unsolicited = self._framing.handle_line(text)
+					if unsolicited is None:
+						self._cond.notify_all()
+				if unsolicited is not None and self.on_line:
+					self.on_line(unsolicited)
+
+	def command(self, command, timeout=None):
+		"""
+		Send a command and wait until the sonde answers with the prompt.
+
+		Args:
+			command (str): Command without line end, e.g. 'para' or 'setecho 0'.
+			timeout (float): Seconds to wait; TIMEOUTS or DEFAULT_TIMEOUT when None.
+
+		Returns:
+			list: The answer lines, without echo and prompt.
+		"""
+		name = command.split(' ', 1)[0]
+		if timeout is None:
+			timeout = self.TIMEOUTS.get(name, self.DEFAULT_TIMEOUT)
+		round_trip = metrics.histogram('exo2_command_seconds', 'Serial round trip of a sonde command', command=name)
+		with self._command_lock:
+			if self._framing.stale:
+				self._resync(self.DEFAULT_TIMEOUT)
+			with self._cond:
+				pending = self._framing.begin(command)
+			start = time.monotonic()
+			self.serial.write(f"{command}\r".encode('utf-8'))
+			self.commands += 1
+			deadline = start + timeout
+			with self._cond:
+				while not pending['done']:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						self._framing.timed_out()
+						self.timeouts += 1
+						TIMEOUTS.inc()
+						raise TimeoutError(f"No answer to '{command}' after {timeout} s")
+					self._cond.wait(remaining)
+				self._framing.finish()
+			round_trip.since(start)
+			if pending['error']:
+				self.errors += 1
+				ERRORS.inc()
+				raise Exo2CommandError(f"{command}: {pending['error']}")
+			return pending['lines']
+
+	def _resync(self, timeout):
+		# Returns False if the sonde did not answer the line end
+		with self._cond:
+			target, owed = self._framing.resync_target()
+			self.serial.write(b'\r')
+			deadline = time.monotonic() + timeout
+			while self._framing.prompts < target:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				self._cond.wait(remaining)
+			return self._framing.resynced(target, owed)
+
+	def command_line(self, command, timeout=None):
+		"""Send a command and return the first line of the answer ('' if there is none)."""
+		lines = self.command(command, timeout)
+		return lines[0] if lines else ""
+
+	def send_raw(self, data):
+		"""Write bytes that are not answered like a command (e.g. '0' to leave run mode)."""
+		with self._command_lock:
+			self.serial.write(data)
+
+	def wait_prompt(self, timeout=DEFAULT_TIMEOUT):
+		"""Wait for the next '#' prompt. Returns True if it arrived before the timeout."""
+		deadline = time.monotonic() + timeout
+		with self._cond:
+			prompts = self._framing.prompts
+			while self._framing.prompts == prompts:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				self._cond.wait(remaining)
+			return True
+
+	def close(self):
+		self._stop.set()
+		self._thread.join(1)
+
 
 class Exo2():
 
@@ -11,6 +266,7 @@ class Exo2():
 	command2 = b'data\r'
 	PARAM_COMMAND = b'para\r'
 	RUN_COMMAND = b'run\r'
+	STOP_COMMAND = b'0'
 	GET_DATA_COMMAND = b'ssn\r'
 
 	DUMMY = 'dummy'
@@ -95,9 +351,18 @@ class Exo2():
 		self.baudrate=baudrate
 		self.timeout = timeout
 		self.conn_type = conn_type
-		self.is_echoing = True
 		self.sn = "" 
 		self.ssn = ""
+		self.engine = None
+		self._streaming = False
+		self._stream_queue = None
+		self._stream_callback = None
+		self._stream_fields = 0
+		self._mismatched_fields = None
+		self.stream_rows = 0
+		self.stream_skipped = 0
+		self.stream_mismatched = 0
+		self.stream_dropped = 0
 		if (test): self.conn_type = self.DUMMY
 		print('conn type: ', self.conn_type)
 
@@ -115,6 +380,7 @@ class Exo2():
 				rtscts=False,  # Disable hardware (RTS/CTS) flow control
 				timeout=self.timeout  # Read timeout
 				)
+			self.engine = Exo2CommandEngine(self.serial, on_line=self._on_stream_line)
 		elif (self.conn_type == self.API):
 			print(self.get_data_from_command(b'init'))
 		elif (self.conn_type == self.DUMMY):
@@ -123,63 +389,46 @@ class Exo2():
 	def __enter__ (self):
 		return self
 
+	@property
+	def is_echoing(self):
+		return bool(self.engine and self.engine.is_echoing)
+
 	def get_sn(self):
 		if (not self.sn or self.sn == ""):
-			self.serial.write(b'sn\r')
-			res = self.get_response()
-			self.sn = str(res).strip()
+			self.sn = self.engine.command_line('sn')
 		return self.sn
 		
 	def get_ssn(self):
 		if (not self.ssn or self.ssn == ""):
-			self.serial.write(b'ssn\r')
-			res = self.get_response()
-			self.ssn = str(res).strip()
+			self.ssn = self.engine.command_line('ssn')
 		return self.ssn
-	def get_response(self):
-		if self.is_echoing:
-			command = self.serial.readline()
-		res = self.serial.readline()
-		return res
+
 	def initial_setup(self, params):
 		print("initial setup")
 		if (self.conn_type == self.DUMMY):
 			return
-		time.sleep(0.5)
-		self.serial.write(b'0')
-		self.serial.readline()
+		# Wake the sonde up (and leave run mode) before the first command
+		self.engine.send_raw(self.STOP_COMMAND)
+		self.engine.wait_prompt(2.0)
 		print("zero sent")
-		#self.get_response()
-		time.sleep(0.5)
-		self.serial.write(b'setecho 0\r')
-		#self.is_echoing = False
-		print("echo off")
-		data = self.get_response()
-		self.serial.readline()
-		self.is_echoing = False
+		data = self.engine.command_line('setecho 0')
 		print("Echo Off: ",data)
-		#self.serial.write(b'pwruptorun 0\r')
-		#res = self.get_response()
-		#if str(res).strip() != "OK":
+		#res = self.engine.command_line('pwruptorun 0')
+		#if res != "OK":
 		#	print("***** Error disabling power to run ****",res)
 		#	raise Exception("Could not turn off pwruptorun")
-		#print("No pwruptorun: ",data)
-		self.serial.write(f"para {params} \r".encode('utf-8'))
-		res = self.get_response()
-		if str(res).strip() == "OK":
-			self.serial.write(b'para')
-			res = self.get_response()
+		res = self.engine.command_line(f"para {params}")
+		if res == "OK":
+			res = self.engine.command_line('para')
 			print("data set: ", res)
 		else:
 			print("Respose: ",res)
 			raise Exception("Could not set the Parameters")
-		new_time = datetime.now() + timedelta(seconds=2)
+		new_time = datetime.datetime.now() + datetime.timedelta(seconds=2)
 		new_time = new_time.strftime('%H:%M:%S')
-		data = f"time {new_time}\r\n".encode('utf-8')
-		print("Setting time: ",data.decode())
-		self.serial.write(data)
-		res = self.get_response()
-		if str(res).strip() != "OK":
+		print("Setting time: ",new_time)
+		res = self.engine.command_line(f"time {new_time}")
+		if res != "OK":
 			raise Exception("Error setting time")
 		
 	def get_active_usb_serial_ports(self):
@@ -208,12 +457,10 @@ class Exo2():
 	def read_data(self):
 		data_string = ""
 		if (self.conn_type == self.SERIAL):
-			time.sleep(0.5)
-			self.serial.write(self.command2)
-			time.sleep(0.5)
-			command = self.serial.readline()
-			data = self.serial.readline()
-			data_string = data.decode('utf-8').strip()
+			try:
+				data_string = self.engine.command_line('data')
+			except (TimeoutError, Exo2CommandError) as e:
+				print(f"Error reading data - {e}")
 		return data_string
 	def get_data(self):
 		"""
@@ -262,17 +509,22 @@ class Exo2():
 		"""
 		Get the Exo2 sensor parameters by sending the 'para' command.
 
+		In run mode the sonde does not answer commands, so a stream is stopped
+		for the 'para' command and started again with the new number of values.
+
 		Returns:
 			str: The parameters received from the server, or None if an error occurred.
 		"""
 		if (self.conn_type == self.SERIAL):
-			time.sleep(0.5)
-			self.serial.write(self.PARAM_COMMAND)
-			time.sleep(0.5)
-			#if self.is_echoing:
-			command = self.serial.readline()
-			data = self.serial.readline()
-			data_string = data.decode('utf-8').strip()
+			streaming = self._streaming
+			data_string = ""
+			if streaming:
+				self.stop_stream()
+			try:
+				data_string = self.engine.command_line('para')
+			finally:
+				if streaming:
+					self._resume_stream(len(data_string.split()) if data_string else self._stream_fields)
 			param_list = data_string.split()
 			param_name_list = [self.PARAMS_DICT[int(x)] for x in param_list]
 			
@@ -292,14 +544,143 @@ class Exo2():
 		return {key : self.PARAMS_DICT[key] for key in param_list}
 
 	def start_collection(self):
-		#TODO: test if the encode is needed
-		self.serial.write(self.RUN_COMMAND.encode())
+		self.engine.send_raw(self.RUN_COMMAND)
+
+	def stop_collection(self, timeout=3.0):
+		"""
+		Take the sonde out of run mode and wait for the '#' prompt.
+
+		Returns:
+			bool: True if the prompt was seen before the timeout.
+		"""
+		self.engine.send_raw(self.STOP_COMMAND)
+		return self.resync(timeout)
+
+	def resync(self, timeout=3.0):
+		"""
+		Wait until the sonde shows the '#' prompt again, ignoring what it sends before.
+
+		Returns:
+			bool: True if the prompt was seen before the timeout.
+		"""
+		return self.engine.wait_prompt(timeout)
+
+	def start_stream(self, callback=None, num_fields=None, max_pending=1000):
+		"""
+		Put the sonde in run mode and collect the rows it emits.
+
+		Every row is delivered as a StreamRow, either to callback (called on the
+		serial reader thread) or through stream() / read_stream_row(). Rows with
+		another number of values than num_fields are delivered too, with a
+		warning: the para list changed, and the reader should re-read it with
+		get_exo2_params(), which resumes the stream with the new count.
+
+		Args:
+			callback: Optional function called with each StreamRow.
+			num_fields: Number of values per row; read with 'para' when None.
+			max_pending: Rows kept for stream() before the oldest are dropped.
+		"""
+		if self.conn_type != self.SERIAL:
+			raise ValueError("Streaming needs a serial connection")
+		if self._streaming:
+			return
+		if num_fields is None:
+			param_list, _ = self.get_exo2_params()
+			num_fields = len(param_list)
+		self._stream_fields = num_fields
+		self._mismatched_fields = None
+		self._stream_callback = callback
+		self._stream_queue = queue.Queue(maxsize=max_pending)
+		self._streaming = True
+		self.start_collection()
+
+	def _resume_stream(self, num_fields):
+		# Back to run mode after a command, keeping the queued rows and the callback
+		self._stream_fields = num_fields
+		self._mismatched_fields = None
+		self._streaming = True
+		self.start_collection()
+
+	def stop_stream(self, timeout=3.0):
+		"""Bring the sonde back from run mode to the '#' prompt."""
+		if not self._streaming:
+			return True
+		self._streaming = False
+		return self.stop_collection(timeout)
+
+	def _parse_stream_line(self, text):
+		values = text.split()
+		if len(values) < 2:
+			return None
+		try:
+			for value in values:
+				float(value)
+		except ValueError:
+			return None
+		return text
+
+	def _on_stream_line(self, text):
+		# Called by the engine for lines that do not answer a command
+		if not self._streaming:
+			return
+		row = self._parse_stream_line(text)
+		if row is None:
+			self.stream_skipped += 1
+			STREAM_SKIPPED.inc()
+			return
+		num_fields = len(row.split())
+		if num_fields != self._stream_fields:
+			if self._mismatched_fields != num_fields:
+				print(f"EXO2 rows have {num_fields} values instead of {self._stream_fields}, the para list changed")
+			self._mismatched_fields = num_fields
+			self.stream_mismatched += 1
+			STREAM_MISMATCHED.inc()
+		stream_row = StreamRow(datetime.datetime.now(), time.monotonic(), row)
+		self.stream_rows += 1
+		STREAM_ROWS.inc()
+		if self._stream_callback:
+			self._stream_callback(stream_row)
+		else:
+			self._queue_stream_row(stream_row)
+
+	def _queue_stream_row(self, stream_row):
+		try:
+			self._stream_queue.put_nowait(stream_row)
+		except queue.Full:
+			try:
+				self._stream_queue.get_nowait()
+			except queue.Empty:
+				pass
+			self._stream_queue.put_nowait(stream_row)
+			self.stream_dropped += 1
+			STREAM_DROPPED.inc()
+
+	def read_stream_row(self, timeout=None):
+		"""
+		Return the next streamed StreamRow, or None if none arrives within timeout seconds.
+		"""
+		try:
+			return self._stream_queue.get(timeout=timeout)
+		except queue.Empty:
+			return None
+
+	def stream(self, timeout=None):
+		"""
+		Iterate over streamed rows until the stream is stopped or no row arrives within timeout seconds.
+		"""
+		while self._streaming:
+			stream_row = self.read_stream_row(timeout if timeout is not None else 0.5)
+			if stream_row is not None:
+				yield stream_row
+			elif timeout is not None:
+				return
 
 	def close(self):
 		if (self.conn_type == self.SERIAL):
+			self.stop_stream()
+			self.engine.close()
 			self.serial.close()
 		elif (self.conn_type == self.DUMMY):
 			pass
 	def __exit__(self, *args):
-		if (self.conn_type == self.SERIAL):
-			self.serial.close()
+		self.close()
@@ -0,0 +1,170 @@
+import datetime
+from array import array
+from operator import itemgetter
+
+import numpy as np
+
+from exo2 import Exo2
+
+# Parameter codes that hold the sonde's own date and time instead of a measurement
+DATE_FORMATS = {
+    51: '%d%m%y',
+    52: '%m%d%y',
+    53: '%y%m%d',
+}
+TIME_CODE = 54
+
+
+class Exo2Record():
+    """
+    One EXO2 row parsed by an Exo2Codec.
+
+    values holds the measurements as doubles, in the order of codec.value_codes.
+    sonde_date / sonde_time are the sonde's own date and time (codes 51-54),
+    None if they are not in the para list.
+    """
+    __slots__ = ('codec', 'values', 'sonde_date', 'sonde_time', 'timestamp')
+
+    def __init__(self, codec, values, sonde_date, sonde_time, timestamp):
+        self.codec = codec
+        self.values = values
+        self.sonde_date = sonde_date
+        self.sonde_time = sonde_time
+        self.timestamp = timestamp
+
+    def __getitem__(self, code):
+        return self.values[self.codec.value_index[int(code)]]
+
+    def __repr__(self):
+        return f"<Exo2Record {self.timestamp} {dict(zip(self.codec.value_codes, self.values))}>"
+
+    def sonde_timestamp(self):
+        """Sonde date and time combined, None if either is missing."""
+        if self.sonde_date is None or self.sonde_time is None:
+            return None
+        return datetime.datetime.combine(self.sonde_date, self.sonde_time)
+
+    def exodata(self):
+        """Values keyed by parameter code (str), dates and times as ISO strings."""
+        data = dict(zip(self.codec.value_keys, self.values))
+        if self.codec.date_code is not None and self.sonde_date is not None:
+            data[str(self.codec.date_code)] = self.sonde_date.isoformat()
+        if self.codec.time_position is not None and self.sonde_time is not None:
+            data[str(TIME_CODE)] = self.sonde_time.isoformat()
+        return data
+
+    def to_document(self, latitude=None, longitude=None, metadata=None):
+        """The record in the form stored in MongoDB and in the JSON logs."""
+        document = {
+            'exodata': self.exodata(),
+            'date': self.timestamp.strftime("%Y-%m-%d"),
+            'time': self.timestamp.strftime("%H:%M:%S"),
+            'latitude': latitude,
+            'longitude': longitude,
+            'timestamp': self.timestamp,
+        }
+        sonde_timestamp = self.sonde_timestamp()
+        if sonde_timestamp is not None:
+            document['sonde_timestamp'] = sonde_timestamp
+        document['metadata'] = metadata if metadata is not None else {}
+        return document
+
+
+class Exo2Codec():
+    """
+    Row parser compiled once from the sonde's para list.
+
+    Parameters:
+        param_codes: Parameter codes in row order, as returned by Exo2.get_exo2_params().
+    """
+
+    def __init__(self, param_codes):
+        self.param_codes = [int(code) for code in param_codes]
+        self.date_code = None
+        self.date_position = None
+        self.time_position = None
+        value_positions = []
+        self.value_codes = []
+        for position, code in enumerate(self.param_codes):
+            if code in DATE_FORMATS:
+                self.date_code = code
+                self.date_position = position
+            elif code == TIME_CODE:
+                self.time_position = position
+            else:
+                value_positions.append(position)
+                self.value_codes.append(code)
+        self.value_keys = [str(code) for code in self.value_codes]
+        self.value_names = [Exo2.PARAMS_DICT.get(code, str(code)) for code in self.value_codes]
+        self.value_index = {code: i for i, code in enumerate(self.value_codes)}
+        self.num_fields = len(self.param_codes)
+        # itemgetter with a single index returns a value instead of a tuple
+        if len(value_positions) == 1:
+            position = value_positions[0]
+            self._get_values = lambda fields: (fields[position],)
+        elif value_positions:
+            self._get_values = itemgetter(*value_positions)
+        else:
+            self._get_values = lambda fields: ()
+        self._date_format = DATE_FORMATS.get(self.date_code)
+
+    def parse(self, row, timestamp=None):
+        """
+        Parse a raw row.
+
+        Parameters:
+            row: Whitespace separated values, as sent by the sonde.
+            timestamp: Host time of the row, datetime.now() when None.
+
+        Returns:
+            Exo2Record, or None if the row does not have one value per parameter.
+        """
+        fields = row.split()
+        if len(fields) != self.num_fields:
+            return None
+        try:
+            values = array('d', map(float, self._get_values(fields)))
+            sonde_date = None
+            sonde_time = None
+            if self.date_position is not None:
+                value = fields[self.date_position].zfill(6)
+                sonde_date = datetime.datetime.strptime(value, self._date_format).date()
+            if self.time_position is not None:
+                value = fields[self.time_position].zfill(6)
+                sonde_time = datetime.time(int(value[0:2]), int(value[2:4]), int(value[4:6]))
+        except ValueError:
+            return None
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        return Exo2Record(self, values, sonde_date, sonde_time, timestamp)
+
+    def document_columns(self):
+        """
+        Flat columns of the documents made by Exo2Record.to_document().
+
+        Returns:
+            List of (header, path) pairs, path being the keys leading to the value,
+            with the sonde parameter names as headers.
+        """
+        columns = [('timestamp', ('timestamp',)), ('date', ('date',)), ('time', ('time',)),
+                   ('latitude', ('latitude',)), ('longitude', ('longitude',))]
+        if self.date_code is not None and self.time_position is not None:
+            columns.append(('sonde_timestamp', ('sonde_timestamp',)))
+        columns.extend((name, ('exodata', key)) for name, key in zip(self.value_names, self.value_keys))
+        columns.append(('asvid', ('metadata', 'asvid')))
+        return columns
+
+    def to_columns(self, records):
+        """
+        Turn a list of records into NumPy columns.
+
+        Returns:
+            dict with a datetime64 'timestamp' column and one float64 column per value code (str).
+        """
+        records = list(records)
+        values = np.frombuffer(b''.join(record.values.tobytes() for record in records), dtype=np.float64)
+        values = values.reshape(len(records), len(self.value_codes))
+        columns = {'timestamp': np.array([record.timestamp for record in records], dtype='datetime64[us]')}
+        for i, key in enumerate(self.value_keys):
+            columns[key] = values[:, i].copy()
+        return columns
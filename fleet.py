@@ -0,0 +1,241 @@
+"""
+Fleet runner: one process driving every ASV of a mission.
+
+python fleet.py [config.yaml]
+
+Each vessel runs as its own asyncio task (see aioruntime.py) with its own
+Surveyor connection, sonde port, logs and sample points. All readings go
+through a single BatchedDBWriter and MongoClient into the time-series
+collection of tsstore.TimeSeriesStore. A vessel that fails (lost link,
+unplugged sonde, ...) is restarted after restart_interval seconds without
+touching the others. See fleet.example.yaml for the config format.
+"""
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+import yaml
+
+from aioruntime import AsyncExo2, AsyncSurveyor, acquire, writer_sink
+from dbwriter import BatchedDBWriter
+from exo2codec import Exo2Codec
+from samplepoints import SampleCoordinateStore
+from textlog import NdjsonWriter
+
+DEFAULTS = {
+    'surveyor': '192.168.0.50:8003',
+    'sonde': '/dev/ttyUSB0',
+    'baudrate': 9600,
+    'sample_points': None,
+    'sample_radius': 5.0,
+}
+
+
+def load_config(filename):
+    """Read a fleet config and fill in the defaults of every vessel."""
+    with open(filename, 'r') as f:
+        config = yaml.safe_load(f)
+    if not config or not config.get('vessels'):
+        raise ValueError(f"No vessels in {filename}")
+    config.setdefault('mission', datetime.datetime.now().strftime("%Y%m%d%H%M"))
+    config.setdefault('log_dir', '.')
+    config.setdefault('restart_interval', 10.0)
+    config.setdefault('max_silence', 30.0)
+    config.setdefault('database', {})
+    vessels = []
+    asvids = set()
+    for entry in config['vessels']:
+        vessel = dict(DEFAULTS, **entry)
+        if 'asvid' not in vessel:
+            raise ValueError(f"Vessel without asvid in {filename}: {entry}")
+        if vessel['asvid'] in asvids:
+            raise ValueError(f"asvid {vessel['asvid']} is listed twice in {filename}")
+        asvids.add(vessel['asvid'])
+        host, _, port = str(vessel['surveyor']).rpartition(':')
+        vessel['surveyor_host'] = host
+        vessel['surveyor_port'] = int(port)
+        vessels.append(vessel)
+    config['vessels'] = vessels
+    return config
+
+
+class SharedDBSink():
+    """Turns a vessel's documents into time-series readings for the shared writer."""
+
+    def __init__(self, writer, ts_store, mission, asvid):
+        self.writer = writer
+        self.ts_store = ts_store
+        self.mission = mission
+        self.asvid = asvid
+
+    def put(self, document):
+        self.writer.put(self.ts_store.reading(document, self.mission, self.asvid))
+
+
+class SamplePointSink():
+    """Logs the sample points a vessel passes, one 'asvid,id,latitude,longitude,timestamp' line each."""
+
+    def __init__(self, store, radius_m, filename, asvid):
+        self.store = store
+        self.radius_m = radius_m
+        self.filename = filename
+        self.asvid = asvid
+
+    def put(self, document):
+        found = self.store.take_nearest((document['latitude'], document['longitude']), self.radius_m)
+        if found:
+            point_id, (lat, lon), distance = found
+            print(f"ASV {self.asvid} reached sample point {point_id} ({distance:.1f} m)")
+            with open(self.filename, 'a') as f:
+                f.write(f"{self.asvid},{point_id},{lat},{lon},{document['timestamp']}\n")
+
+
+class VesselRunner():
+    """
+    Runs one vessel and restarts it when it fails.
+
+    Parameters:
+        vessel: Vessel entry of the config.
+        config: Whole config (mission, log_dir, restart_interval, max_silence).
+        db_writer: Shared BatchedDBWriter, or None.
+        ts_store: TimeSeriesStore of the shared writer, or None.
+    """
+
+    def __init__(self, vessel, config, db_writer=None, ts_store=None):
+        self.vessel = vessel
+        self.asvid = vessel['asvid']
+        self.mission = config['mission']
+        self.restart_interval = config['restart_interval']
+        self.max_silence = config['max_silence']
+        self.db_writer = db_writer
+        self.ts_store = ts_store
+        self.log_base = os.path.join(config['log_dir'], f"{self.mission}-{self.asvid}")
+        self.sample_store = None
+        if vessel['sample_points']:
+            self.sample_store = SampleCoordinateStore(vessel['sample_points'])
+        self.starts = 0
+        self.failures = 0
+        self.rows = 0
+        self.last_error = None
+        self.running = False
+        self.exo = None
+
+    async def run(self):
+        """Run the vessel until cancelled; failures only restart this vessel."""
+        while True:
+            self.starts += 1
+            try:
+                await self._run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+                print(f"ASV {self.asvid} failed, restarting in {self.restart_interval} s - {self.last_error}")
+            finally:
+                self.running = False
+            await asyncio.sleep(self.restart_interval)
+
+    async def _register(self, exo, codec):
+        if self.ts_store is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, lambda: self.ts_store.register_mission(
+                self.mission, self.asvid, exo.sn, exo.ssn, codec.param_codes, codec.value_names))
+        except Exception as e:
+            print(f"ASV {self.asvid}: could not register the mission - {e}")
+
+    async def _run_once(self):
+        vessel = self.vessel
+        surveyor = AsyncSurveyor(vessel['surveyor_host'], vessel['surveyor_port'])
+        exo = self.exo = AsyncExo2(vessel['sonde'], vessel['baudrate'])
+        async with surveyor, exo:
+            keys, _ = await exo.get_exo2_params()
+            await exo.get_sn()
+            await exo.get_ssn()
+            codec = Exo2Codec(keys)
+            await self._register(exo, codec)
+
+            log = NdjsonWriter(self.log_base + ".ndjson")
+            log_sink = writer_sink(log)
+            log_sink.start()
+            sinks = [log_sink]
+            if self.db_writer is not None:
+                sinks.append(SharedDBSink(self.db_writer, self.ts_store, self.mission, self.asvid))
+            if self.sample_store is not None:
+                sinks.append(SamplePointSink(self.sample_store, vessel['sample_radius'],
+                                             self.log_base + "-samples.txt", self.asvid))
+            await exo.start_stream(num_fields=codec.num_fields)
+            self.running = True
+            print(f"ASV {self.asvid} running, sonde {exo.sn}, params {keys}")
+            try:
+                await acquire(surveyor, exo, codec, sinks, self.asvid, max_silence=self.max_silence)
+            finally:
+                self.rows += exo.stream_rows
+                self.exo = None
+                await log_sink.close()
+                log.close()
+
+    def status(self):
+        state = 'running' if self.running else 'down'
+        rows = self.rows + (self.exo.stream_rows if self.exo is not None else 0)
+        text = f"ASV {self.asvid}: {state}, rows {rows}, starts {self.starts}, failures {self.failures}"
+        if self.last_error and not self.running:
+            text += f", last error: {self.last_error}"
+        return text
+
+
+async def report(runners, db_writer, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(time.strftime("%H:%M:%S"), " | ".join(runner.status() for runner in runners))
+        if db_writer is not None:
+            print("DB writer: ", db_writer.stats())
+
+
+async def run_fleet(config, db_writer=None, ts_store=None, report_interval=30.0):
+    """Run every vessel of the config until cancelled."""
+    runners = [VesselRunner(vessel, config, db_writer, ts_store) for vessel in config['vessels']]
+    tasks = [asyncio.create_task(runner.run(), name=f"asv-{runner.asvid}") for runner in runners]
+    tasks.append(asyncio.create_task(report(runners, db_writer, report_interval), name='report'))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    import certifi
+    from pymongo import MongoClient
+
+    from tsstore import TimeSeriesStore
+
+    config = load_config(sys.argv[1] if len(sys.argv) > 1 else 'fleet.yaml')
+    database = config['database']
+    client = MongoClient(os.environ['COSMODB_STRING'], tlsCAFile=certifi.where())
+    ts_store = TimeSeriesStore(client[database.get('name', 'missions')], readings=database.get('readings', 'readings'),
+                               create=False)
+    try:
+        ts_store.ensure_collections()
+    except Exception as e:
+        print(f"Could not prepare the collections - {e}")
+    # Through the store, so batches the writer retries are not stored twice
+    db_writer = BatchedDBWriter(ts_store,
+                                batch_size=database.get('batch_size', 100),
+                                flush_interval=database.get('flush_interval', 2.0),
+                                max_queue=database.get('max_queue', 20000),
+                                policy=BatchedDBWriter.SPILL,
+                                spill_file=os.path.join(config['log_dir'], f"{config['mission']}-db_spill.jsonl"))
+    try:
+        asyncio.run(run_fleet(config, db_writer, ts_store, config.get('report_interval', 30.0)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db_writer.close()
+        print("DB writer stats: ", db_writer.stats())
+        client.close()
@@ -4,12 +4,13 @@ import math
 import os
 import sys
 
-from geopy.distance import geodesic
 import pynmea2
 
-#import numpy as np
+import numpy as np
 import pandas as pd
 
+import geodesy
+
 
 def create_grad_eval_coordinates(lat, lon, side_length):
     """
@@ -23,16 +24,12 @@ def create_grad_eval_coordinates(lat, lon, side_length):
     Returns:
     List[tuple]: A list of tuples representing the GPS coordinates of two corners of the square.
     """
-    half_diagonal = (side_length / math.sqrt(2)) / 1000  # Convert meters to kilometers
+    half_diagonal = side_length / math.sqrt(2)
 
-    # Calculate the coordinates of the two corners
-    top_left = geodesic(kilometers=half_diagonal).destination((lat, lon), bearing=315)
-    top_right = geodesic(kilometers=half_diagonal).destination((lat, lon), bearing=45)
-    #bottom_left = geodesic(kilometers=half_diagonal).destination((lat, lon), bearing=225)
-    #bottom_right = geodesic(kilometers=half_diagonal).destination((lat, lon), bearing=135)
+    # Calculate the coordinates of the two corners (top left, top right)
+    corners = geodesy.destination((lat, lon), half_diagonal, [315, 45])
 
-    return [(top_left.latitude, top_left.longitude),
-            (top_right.latitude, top_right.longitude)]
+    return [tuple(map(float, corner)) for corner in corners]
 
 
 def create_square_coordinates(lat, lon, side_length):
@@ -47,18 +44,12 @@ def create_square_coordinates(lat, lon, side_length):
     Returns:
     List[tuple]: A list of tuples representing the GPS coordinates of the four corners of the square.
     """
-    half_diagonal = (side_length / math.sqrt(2)) / 1000  # Convert meters to kilometers
+    half_diagonal = side_length / math.sqrt(2)
 
-    # Calculate the coordinates of the four corners
-    top_left = geodesic(kilometers=half_diagonal).destination((lat, lon), bearing=315)
-    top_right = geodesic(kilometers=half_diagonal).destination((lat, lon), bearing=45)
-    bottom_left = geodesic(kilometers=half_diagonal).destination((lat, lon), bearing=225)
-    bottom_right = geodesic(kilometers=half_diagonal).destination((lat, lon), bearing=135)
+    # Calculate the coordinates of the four corners (top left, top right, bottom right, bottom left)
+    corners = geodesy.destination((lat, lon), half_diagonal, [315, 45, 135, 225])
 
-    return [(top_left.latitude, top_left.longitude),
-            (top_right.latitude, top_right.longitude),
-            (bottom_right.latitude, bottom_right.longitude),
-            (bottom_left.latitude, bottom_left.longitude)]
+    return [tuple(map(float, corner)) for corner in corners]
 
 
 def are_coordinates_close(coord1, coord2, tolerance_meters=2):
@@ -73,8 +64,8 @@ def are_coordinates_close(coord1, coord2, tolerance_meters=2):
     Returns:
         Boolean indicating if the two coordinates are close enough.
     """
-    distance = geodesic(coord1, coord2).meters
-    return distance <= tolerance_meters
+    distance = geodesy.vincenty(coord1, coord2)
+    return bool(distance <= tolerance_meters)
 
 
 def append_tuple_to_csv(data_tuple, post_fix="", cols=["latitude", "longitude", "noisy latitude", "noisy longitude"]):
@@ -141,62 +132,24 @@ def get_control_mode(message):
     if psead:
         psead = psead.split(',')
         code = psead[1]
-
-        switch_dict = {
-            'L': 'Standby',
-            'T': 'Thruster',
-            'C': 'Heading',
-            'G': 'Speed',
-            'R': 'Station Keep',
-            'N': 'River Nav',
-            'W': 'Waypoint',
-            'I': 'Autopilot',
-            '3': 'Compass Cal',
-            'H': 'Go To ERP',
-            'D': 'Depth',
-            'S': 'Gravity Vector Direction',
-            'F': 'File Download',
-            '!': 'Boot Loader'
-        }
-        return switch_dict.get(code, 'Unknown')
+        return CONTROL_MODES.get(code, 'Unknown')
     return None
 
 
 def get_timestamp(gga_message):
-    try:
-        gga = pynmea2.parse(gga_message)
-
-        if isinstance(gga, pynmea2.GGA):
-            # Use the attributes provided by pynmea2
-            return gga.timestamp
-
-    except pynmea2.ParseError:
-        pass
-    except ValueError:
-        pass
-    except TypeError:
-        pass
-
+    if not gga_message:
+        return None
+    gga = parse_nmea_sentence(gga_message)
+    if isinstance(gga, GgaMessage):
+        return gga.timestamp
     return None
 
 def get_coordinates(gga_message):
-    try:
-        gga = pynmea2.parse(gga_message)
-
-        if isinstance(gga, pynmea2.GGA):
-            # Use the attributes provided by pynmea2
-            latitude_nmea = gga.latitude
-            longitude_nmea = gga.longitude
-
-            return latitude_nmea, longitude_nmea
-
-    except pynmea2.ParseError:
-        pass
-    except ValueError:
-        pass
-    except TypeError:
-        pass
-
+    if not gga_message:
+        return None
+    gga = parse_nmea_sentence(gga_message)
+    if isinstance(gga, GgaMessage):
+        return gga.latitude, gga.longitude
     return None
 
 
@@ -216,6 +169,230 @@ def get_heading(attitude_message):
     return None
 
 
+CONTROL_MODES = {
+    'L': 'Standby',
+    'T': 'Thruster',
+    'C': 'Heading',
+    'G': 'Speed',
+    'R': 'Station Keep',
+    'N': 'River Nav',
+    'W': 'Waypoint',
+    'I': 'Autopilot',
+    '3': 'Compass Cal',
+    'H': 'Go To ERP',
+    'D': 'Depth',
+    'S': 'Gravity Vector Direction',
+    'F': 'File Download',
+    '!': 'Boot Loader'
+}
+
+
+def xor_bytes(data):
+    """XOR of all bytes in data, folded as one big integer instead of byte by byte."""
+    n = len(data)
+    if n == 0:
+        return 0
+    width = (1 << (n - 1).bit_length()) * 8
+    value = int.from_bytes(data, 'big')
+    while width > 8:
+        width >>= 1
+        value = (value >> width) ^ (value & ((1 << width) - 1))
+    return value
+
+
+def nmea_degrees_to_decimal(value, hemisphere):
+    """Convert a (d)ddmm.mmmm field and its hemisphere to signed decimal degrees."""
+    if not value or value == '0':
+        return 0.0
+    dot = value.find('.')
+    if dot < 0:
+        dot = len(value)
+    if dot < 3:
+        raise ValueError(f"Geographic coordinate value '{value}' is not valid DDDMM.MMM")
+    decimal = float(value[:dot - 2]) + float(value[dot - 2:]) / 60
+    return -decimal if hemisphere in ('S', 'W') else decimal
+
+
+def nmea_time(value):
+    """Convert a hhmmss[.ss] field to a UTC datetime.time, None if empty."""
+    if not value:
+        return None
+    fraction = value[6:]
+    return datetime.time(int(value[0:2]), int(value[2:4]), int(value[4:6]),
+                         int(float(fraction) * 1000000) if fraction else 0,
+                         tzinfo=datetime.timezone.utc)
+
+
+class NmeaMessage():
+    """
+    A decoded NMEA sentence.
+
+    address is the text between '$' and the first comma (e.g. 'GPGGA', 'PSEAB')
+    and data holds the remaining fields as strings, like pynmea2 does.
+    """
+    __slots__ = ('address', 'data')
+
+    def __init__(self, address, data):
+        self.address = address
+        self.data = data
+
+    @property
+    def talker(self):
+        return 'P' if self.address.startswith('P') else self.address[:2]
+
+    @property
+    def sentence_type(self):
+        return self.address[1:] if self.address.startswith('P') else self.address[2:]
+
+    def to_pynmea2(self):
+        """Parse the same sentence with pynmea2, for sentence types not decoded here."""
+        return pynmea2.parse(f"${self.address},{','.join(self.data)}")
+
+    def __repr__(self):
+        return f"<{self.address}({','.join(self.data)})>"
+
+
+class GgaMessage(NmeaMessage):
+    """GPGGA fix with the same attribute names as pynmea2.GGA."""
+    __slots__ = ('timestamp', 'latitude', 'longitude')
+
+    def __init__(self, address, data):
+        super().__init__(address, data)
+        self.timestamp = nmea_time(data[0])
+        self.latitude = nmea_degrees_to_decimal(data[1], data[2])
+        self.longitude = nmea_degrees_to_decimal(data[3], data[4])
+
+    lat = property(lambda self: self.data[1])
+    lat_dir = property(lambda self: self.data[2])
+    lon = property(lambda self: self.data[3])
+    lon_dir = property(lambda self: self.data[4])
+    gps_qual = property(lambda self: int(self.data[5]) if self.data[5] else None)
+    num_sats = property(lambda self: self.data[6])
+    horizontal_dil = property(lambda self: self.data[7])
+    altitude = property(lambda self: float(self.data[8]) if self.data[8] else None)
+    altitude_units = property(lambda self: self.data[9])
+
+
+class AttitudeMessage(NmeaMessage):
+    """PSEAA attitude sentence."""
+    __slots__ = ('heading',)
+
+    def __init__(self, address, data):
+        super().__init__(address, data)
+        self.heading = float(data[2]) if data[2] else None
+
+
+class ControlModeMessage(NmeaMessage):
+    """PSEAD control mode sentence."""
+    __slots__ = ('mode_code', 'control_mode')
+
+    def __init__(self, address, data):
+        super().__init__(address, data)
+        self.mode_code = data[0]
+        self.control_mode = CONTROL_MODES.get(self.mode_code, 'Unknown')
+
+
+# Sentences with typed messages; anything else becomes a plain NmeaMessage
+NMEA_MESSAGE_TYPES = {
+    'GPGGA': GgaMessage,
+    'PSEAA': AttitudeMessage,
+    'PSEAB': NmeaMessage,
+    'PSEAD': ControlModeMessage,
+    'PSEAE': NmeaMessage,
+    'PSEAF': NmeaMessage,
+    'PSEAG': NmeaMessage,
+    'PSEAJ': NmeaMessage,
+}
+
+GGA_MIN_FIELDS = 10
+
+
+def _decode_line(line):
+    """Decode one sentence (bytes without line end), raising ValueError if it is invalid."""
+    start = line.find(b'$')
+    if start < 0:
+        raise ValueError("No start of sentence")
+    star = line.rfind(b'*')
+    if star > start:
+        expected = line[star + 1:star + 3]
+        if len(expected) != 2 or int(expected, 16) != xor_bytes(line[start + 1:star]):
+            raise ValueError("Checksum does not match")
+        body = line[start + 1:star]
+    else:
+        body = line[start + 1:]
+    fields = body.decode('ascii').split(',')
+    address = fields[0]
+    message_type = NMEA_MESSAGE_TYPES.get(address)
+    if message_type is GgaMessage and len(fields) <= GGA_MIN_FIELDS:
+        raise ValueError("GGA sentence is too short")
+    if message_type is not None:
+        return message_type(address, fields[1:])
+    return NmeaMessage(address, fields[1:])
+
+
+def parse_nmea_sentence(sentence):
+    """
+    Decode one NMEA sentence (str or bytes, line end optional).
+
+    Returns:
+        A GgaMessage, AttitudeMessage or ControlModeMessage for those types, an
+        NmeaMessage for any other sentence (see NmeaMessage.to_pynmea2), or None
+        if the sentence is malformed or its checksum is wrong.
+    """
+    if isinstance(sentence, str):
+        sentence = sentence.encode('ascii', 'replace')
+    try:
+        return _decode_line(sentence.rstrip(b'\r\n'))
+    except (ValueError, IndexError, UnicodeDecodeError):
+        return None
+
+
+class NmeaDecoder():
+    """
+    Incremental decoder for a stream of NMEA bytes.
+
+    feed() keeps incomplete sentences between calls and returns the messages
+    of every complete one in a single pass over the buffer. Sentences that
+    fail the checksum or cannot be parsed are counted in dropped.
+    """
+
+    MAX_BUFFER = 65536  # Drop the buffer if no line end shows up for this long
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.sentences = 0
+        self.dropped = 0
+
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        messages = []
+        start = 0
+        while True:
+            end = buffer.find(b'\r\n', start)
+            if end < 0:
+                break
+            if end > start:
+                try:
+                    messages.append(_decode_line(bytes(buffer[start:end])))
+                    self.sentences += 1
+                except (ValueError, IndexError, UnicodeDecodeError):
+                    self.dropped += 1
+            start = end + 2
+        del buffer[:start]
+        if len(buffer) > self.MAX_BUFFER:
+            self.dropped += 1
+            buffer.clear()
+        return messages
+
+
+def decode_nmea_buffer(buffer):
+    """Decode every complete sentence in buffer (str or bytes) and return the messages."""
+    if isinstance(buffer, str):
+        buffer = buffer.encode('ascii', 'replace')
+    return NmeaDecoder().feed(buffer)
+
+
 def save(coordinates, exo2_data, add_noise=True):
     """
     Process the coordinates and Exo2 data, add noise (if required), and append to CSV.
@@ -243,22 +420,25 @@ def save(coordinates, exo2_data, add_noise=True):
 
 def compute_nmea_checksum(message):
     """Compute the checksum for an NMEA message."""
-    checksum = 0
-    for char in message:
-        checksum ^= ord(char)
-    return '{:02X}'.format(checksum)
+    return '{:02X}'.format(xor_bytes(message.encode('latin-1')))
+
+
+# Degrees as whole ten-thousandths of a minute, the resolution of the waypoint messages
+MINUTE_UNITS = 600000
+
+
+def _degrees_minutes(decimal_degree, width):
+    # Rounded as a whole so 59.99996 minutes becomes the next degree instead of '60.0000'
+    degrees, minutes = divmod(round(abs(decimal_degree) * MINUTE_UNITS), MINUTE_UNITS)
+    return "{:0{}d}{:02d}.{:04d}".format(degrees, width, minutes // 10000, minutes % 10000)
 
 
 def convert_lat_to_nmea_degrees_minutes(decimal_degree):
-    degrees = int(abs(decimal_degree))
-    minutes_decimal = (abs(decimal_degree) - degrees) * 60
-    return "{:02d}{:.4f}".format(degrees, minutes_decimal)
+    return _degrees_minutes(decimal_degree, 2)
 
 
 def convert_lon_to_nmea_degrees_minutes(decimal_degree):
-    degrees = int(abs(decimal_degree))
-    minutes_decimal = (abs(decimal_degree) - degrees) * 60
-    return "{:03d}{:.4f}".format(degrees, minutes_decimal)
+    return _degrees_minutes(decimal_degree, 3)
 
 
 def get_hemisphere_lat(value):
@@ -279,6 +459,103 @@ def create_way_point_message(latitude_minutes, latitude_hemisphere, longitude_mi
     return "OIWPL,{},{},".format(latitude_minutes, latitude_hemisphere) + "{},{},".format(longitude_minutes, longitude_hemisphere) + str(number)
 
 
+def _digits(values, width):
+    """ASCII digits of non-negative integers as a (len(values), width) uint8 array, zero-padded on the left."""
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return (values[:, None] // powers % 10 + ord('0')).astype(np.uint8)
+
+
+def _degrees_minutes_columns(values, width):
+    """'DDMM.mmmm' (width digits of degrees) of every value as a uint8 array of shape (len(values), width + 7)."""
+    units = np.rint(np.abs(values) * MINUTE_UNITS).astype(np.int64)
+    degrees, minutes = np.divmod(units, MINUTE_UNITS)
+    columns = np.empty((len(values), width + 7), dtype=np.uint8)
+    columns[:, :width] = _digits(degrees, width)
+    columns[:, width:width + 2] = _digits(minutes // 10000, 2)
+    columns[:, width + 2] = ord('.')
+    columns[:, width + 3:] = _digits(minutes % 10000, 4)
+    return columns
+
+
+def _strings(matrix):
+    """One str per row of a uint8 matrix; the zero bytes at the end of a row are dropped."""
+    matrix = np.ascontiguousarray(matrix)
+    return matrix.view(f"S{matrix.shape[1]}").ravel().astype(str)
+
+
+HEX_DIGITS = np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)
+
+
+def build_way_point_messages(latitudes, longitudes, first_number=0):
+    """
+    OIWPL waypoint messages for whole arrays of coordinates at once.
+
+    Every field has a fixed width except the waypoint number, so the message
+    bodies are built as one uint8 matrix with the numbers left-aligned and
+    zero bytes after them. XOR leaves zero bytes out, so the checksums are a
+    single bitwise_xor.reduce over the rows.
+
+    Parameters:
+        latitudes, longitudes: Decimal degrees, anything numpy can turn into an array.
+        first_number: Number of the first waypoint, the others follow in order.
+
+    Returns:
+        dict of numpy str arrays: 'latitude_minutes', 'longitude_minutes',
+        'latitude_hemisphere', 'longitude_hemisphere', 'nmea_waypoints' (the
+        message bodies) and 'nmea_message' (full sentences with checksum and line end).
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64).ravel()
+    longitudes = np.asarray(longitudes, dtype=np.float64).ravel()
+    count = len(latitudes)
+    numbers = np.arange(first_number, first_number + count, dtype=np.int64)
+    number_widths = np.maximum(1, np.floor(np.log10(np.maximum(numbers, 1))).astype(np.int64) + 1)
+    number_width = int(number_widths.max()) if count else 1
+
+    # 'OIWPL,' lat(9) ',' N ',' lon(10) ',' W ',' then the number
+    fixed = 31
+    body = np.zeros((count, fixed + number_width), dtype=np.uint8)
+    body[:, :6] = np.frombuffer(b'OIWPL,', dtype=np.uint8)
+    body[:, 6:15] = _degrees_minutes_columns(latitudes, 2)
+    body[:, [15, 17, 28, 30]] = ord(',')
+    body[:, 16] = np.where(latitudes >= 0, ord('N'), ord('S'))
+    body[:, 18:28] = _degrees_minutes_columns(longitudes, 3)
+    body[:, 29] = np.where(longitudes >= 0, ord('E'), ord('W'))
+    # Digit k of a number is at 10 ** (width - 1 - k); past its width the byte stays zero
+    exponents = number_widths[:, None] - 1 - np.arange(number_width)
+    digits = numbers[:, None] // 10 ** np.maximum(exponents, 0) % 10 + ord('0')
+    body[:, fixed:] = np.where(exponents >= 0, digits, 0)
+
+    checksums = np.bitwise_xor.reduce(body, axis=1)
+    lines = np.zeros((count, fixed + number_width + 6), dtype=np.uint8)
+    lines[:, 0] = ord('$')
+    lines[:, 1:fixed + number_width + 1] = body
+    end = 1 + fixed + number_widths
+    row_index = np.arange(count)
+    lines[row_index, end] = ord('*')
+    lines[row_index, end + 1] = HEX_DIGITS[checksums >> 4]
+    lines[row_index, end + 2] = HEX_DIGITS[checksums & 0x0F]
+    lines[row_index, end + 3] = ord('\r')
+    lines[row_index, end + 4] = ord('\n')
+
+    return {
+        'latitude_minutes': _strings(body[:, 6:15]),
+        'longitude_minutes': _strings(body[:, 18:28]),
+        'latitude_hemisphere': _strings(body[:, 16:17]),
+        'longitude_hemisphere': _strings(body[:, 29:30]),
+        'nmea_waypoints': _strings(body),
+        'nmea_message': _strings(lines),
+    }
+
+
+def _way_point_messages_df(df):
+    """Add the message columns of build_way_point_messages to a DataFrame with latitude and longitude columns."""
+    columns = build_way_point_messages(df['latitude'].astype(float).to_numpy(),
+                                       df['longitude'].astype(float).to_numpy())
+    for name, values in columns.items():
+        df[name] = values.tolist()
+    return df
+
+
 def create_way_point_messages_df(filename, erp_filename):
     """
     Create a DataFrame with waypoint messages from a CSV file.
@@ -307,29 +584,8 @@ def create_way_point_messages_df(filename, erp_filename):
         print(f"Error loading ERP CSV file: {e}")
         return pd.DataFrame()
 
-    # Append ERP to the beginning of the DataFrame
-    df = pd.concat([erp_df, df], ignore_index=True)
-
-    # Convert latitude and longitude to desired format
-    df['latitude_minutes'] = df['latitude'].apply(
-        lambda x: convert_lat_to_nmea_degrees_minutes(float(x)))
-    df['longitude_minutes'] = df['longitude'].apply(
-        lambda x: convert_lon_to_nmea_degrees_minutes(float(x)))
-
-    # Get hemisphere for latitude and longitude
-    df['latitude_hemisphere'] = df['latitude'].apply(get_hemisphere_lat)
-    df['longitude_hemisphere'] = df['longitude'].apply(get_hemisphere_lon)
-
-    # Adjust the nmea_waypoints column for the emergency recovery point and the sequential waypoints
-    df['nmea_waypoints'] = df.apply(lambda row: create_way_point_message(
-        row['latitude_minutes'], row['latitude_hemisphere'], row['longitude_minutes'], row['longitude_hemisphere'],
-        row.name), axis=1)
-
-    # Create full NMEA message with checksum
-    df['nmea_message'] = df['nmea_waypoints'].apply(
-        lambda waypoint: create_nmea_message(waypoint))
-
-    return df
+    # The emergency recovery point is waypoint 0, the others follow from 1
+    return _way_point_messages_df(pd.concat([erp_df, df], ignore_index=True))
 
 
 def create_way_point_messages_df_from_list(waypoints, erp):
@@ -352,46 +608,46 @@ def create_way_point_messages_df_from_list(waypoints, erp):
         print("The ERP DataFrame is empty.")
         return pd.DataFrame()
 
-    # Append ERP to the beginning of the DataFrame
-    df = pd.concat([erp_df, waypoints_df], ignore_index=True)
-
-    # Convert latitude and longitude to desired format
-    df['latitude_minutes'] = df['latitude'].apply(
-        lambda x: convert_lat_to_nmea_degrees_minutes(float(x)))
-    df['longitude_minutes'] = df['longitude'].apply(
-        lambda x: convert_lon_to_nmea_degrees_minutes(float(x)))
+    return _way_point_messages_df(pd.concat([erp_df, waypoints_df], ignore_index=True))
 
-    # Get hemisphere for latitude and longitude
-    df['latitude_hemisphere'] = df['latitude'].apply(get_hemisphere_lat)
-    df['longitude_hemisphere'] = df['longitude'].apply(get_hemisphere_lon)
 
-    # Adjust the nmea_waypoints column for the emergency recovery point and the sequential waypoints
-    df['nmea_waypoints'] = df.apply(lambda row: create_way_point_message(
-        row['latitude_minutes'], row['latitude_hemisphere'], row['longitude_minutes'], row['longitude_hemisphere'],
-        row.name), axis=1)
-
-    # Create full NMEA message with checksum
-    df['nmea_message'] = df['nmea_waypoints'].apply(
-        lambda waypoint: create_nmea_message(waypoint))
-
-    return df
+def _mission_header(throttle):
+    return create_nmea_message("PSEAR,0,000,{},0,000".format(throttle))
 
 
 def create_waypoint_mission(df, throttle=20, pause_time=0):
     """Generate a waypoint mission from a DataFrame."""
+    # The PSEAR command sets the throttle, then the OIWPL commands from the DataFrame
+    return _mission_header(throttle) + ''.join(df['nmea_message'].tolist())
 
-    # Start with the PSEAR command
-    psear_cmd = "PSEAR,0,000,{},0,000".format(throttle)
-    psear_cmd_with_checksum = "${}*{}\r\n".format(
-        psear_cmd, compute_nmea_checksum(psear_cmd))
 
-    # Generate OIWPL commands from the DataFrame
-    oi_wpl_cmds = df['nmea_message'].tolist()
+def write_waypoint_mission(filename, waypoints, erp, throttle=20, pause_time=0, chunk_size=10000):
+    """
+    Write the .sea mission of a list of waypoints straight to a file.
+
+    The same text as create_waypoint_mission(create_way_point_messages_df_from_list(waypoints, erp)),
+    built chunk_size waypoints at a time without a DataFrame, for surveys with
+    tens of thousands of waypoints.
 
-    # Concatenate all the commands to form the mission
-    mission = psear_cmd_with_checksum + ''.join(oi_wpl_cmds)
-    #print(mission)
-    return mission
+    Parameters:
+        filename: Path of the .sea file.
+        waypoints: Sequence of (latitude, longitude), or an array of shape (n, 2).
+        erp: (latitude, longitude) of the emergency recovery point, written as waypoint 0.
+
+    Returns:
+        Number of waypoints written, without the ERP.
+    """
+    waypoints = np.asarray(waypoints, dtype=np.float64).reshape(-1, 2)
+    if len(waypoints) == 0:
+        print("The waypoints list is empty.")
+        return 0
+    with open(filename, 'w', newline='') as f:
+        f.write(_mission_header(throttle))
+        f.write(build_way_point_messages([erp[0]], [erp[1]])['nmea_message'][0])
+        for start in range(0, len(waypoints), chunk_size):
+            chunk = waypoints[start:start + chunk_size]
+            f.write(''.join(build_way_point_messages(chunk[:, 0], chunk[:, 1], start + 1)['nmea_message'].tolist()))
+    return len(waypoints)
 
 
 if __name__ == "__main__":
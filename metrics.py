@@ -0,0 +1,379 @@
+"""
+Lightweight latency histograms and counters for the acquisition loop.
+
+Histograms are HDR-style: durations are kept in microseconds in log-linear
+buckets (64 exact values, then 32 buckets per power of two), so any
+percentile is known to about 3% and recording a value is a couple of integer
+operations under a lock. Metrics live in a Registry (REGISTRY by default) and
+are exported in the Prometheus text format by MetricsServer and summarised
+on one log line by SummaryReporter.
+
+    EXO2_COMMAND = metrics.histogram('exo2_command_seconds', 'Sonde command round trip', command='data')
+    with EXO2_COMMAND.time():
+        ...
+    metrics.counter('exo2_timeouts_total', 'Sonde commands without answer').inc()
+
+python metrics.py
+    Print the cost of recording a value and of a timed block on this machine.
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUB_BITS = 6
+SUB_COUNT = 1 << SUB_BITS
+HALF_COUNT = SUB_COUNT >> 1
+MAX_MICROS = (1 << 36) - 1  # About 19 hours, longer durations are counted here
+BUCKETS = SUB_COUNT + (MAX_MICROS.bit_length() - SUB_BITS) * HALF_COUNT
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(micros):
+    """Bucket of a duration in whole microseconds."""
+    if micros < SUB_COUNT:
+        return micros if micros > 0 else 0
+    if micros > MAX_MICROS:
+        micros = MAX_MICROS
+    shift = micros.bit_length() - SUB_BITS
+    return SUB_COUNT + (shift - 1) * HALF_COUNT + (micros >> shift) - HALF_COUNT
+
+
+def bucket_value(index):
+    """Middle of a bucket in microseconds."""
+    if index < SUB_COUNT:
+        return index
+    shift = (index - SUB_COUNT) // HALF_COUNT + 1
+    low = (HALF_COUNT + (index - SUB_COUNT) % HALF_COUNT) << shift
+    return low + ((1 << shift) - 1) / 2
+
+
+def _percentiles(counts, total, quantiles):
+    """Seconds at each quantile of bucket counts holding total values."""
+    results = []
+    if total == 0:
+        return [0.0 for _ in quantiles]
+    targets = [max(1, round(q * total)) for q in quantiles]
+    seen = 0
+    target = 0
+    for index, count in enumerate(counts):
+        if not count:
+            continue
+        seen += count
+        while target < len(targets) and seen >= targets[target]:
+            results.append(bucket_value(index) / 1e6)
+            target += 1
+        if target == len(targets):
+            break
+    return results
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class _Timer():
+    """Context manager recording the time spent in its block."""
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.record(time.monotonic() - self.start)
+
+
+class Histogram():
+    """
+    Durations in log-linear buckets.
+
+    Parameters:
+        name: Metric name, ending in _seconds.
+        help: One line description for the export.
+        labels: Tuple of (key, value) pairs.
+    """
+
+    kind = 'summary'
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        """Add one duration in seconds."""
+        index = bucket_index(int(seconds * 1e6))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def time(self):
+        """Context manager recording the duration of its block."""
+        return _Timer(self)
+
+    def since(self, start):
+        """Record the time since start (a time.monotonic() value) and return now."""
+        now = time.monotonic()
+        self.record(now - start)
+        return now
+
+    def percentiles(self, quantiles=QUANTILES):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        return _percentiles(counts, total, quantiles)
+
+    def snapshot(self):
+        """(bucket counts, count, sum) to compute the percentiles of an interval with since_snapshot()."""
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+    def since_snapshot(self, snapshot, quantiles=QUANTILES):
+        """(count, sum, percentiles) of the values recorded after snapshot was taken."""
+        counts, count, total = self.snapshot()
+        if snapshot is not None:
+            counts = [now - then for now, then in zip(counts, snapshot[0])]
+            count -= snapshot[1]
+            total -= snapshot[2]
+        return count, total, _percentiles(counts, count, quantiles)
+
+    def export(self):
+        quantile_values = self.percentiles()
+        lines = []
+        for quantile, value in zip(QUANTILES, quantile_values):
+            lines.append(f"{self.name}{_label_text(self.labels + (('quantile', quantile),))} {value:.6f}")
+        lines.append(f"{self.name}_sum{_label_text(self.labels)} {self.sum:.6f}")
+        lines.append(f"{self.name}_count{_label_text(self.labels)} {self.count}")
+        return lines
+
+
+class Counter():
+    """Count of events such as retries, timeouts or dropped sentences."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def export(self):
+        return [f"{self.name}{_label_text(self.labels)} {self.value}"]
+
+
+class FunctionMetric():
+    """Counter or gauge read from a function when exported, for counts an object already keeps."""
+
+    def __init__(self, name, help, func, kind='counter', labels=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+        self.labels = labels
+
+    @property
+    def value(self):
+        try:
+            return self.func()
+        except Exception:
+            return 0
+
+    def export(self):
+        return [f"{self.name}{_label_text(self.labels)} {self.value}"]
+
+
+class Registry():
+    """Named metrics; asking twice for the same name and labels returns the same metric."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels):
+        key = (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(name, help, key[1])
+        return metric
+
+    def histogram(self, name, help='', **labels):
+        return self._get(Histogram, name, help, labels)
+
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def register_function(self, name, help, func, kind='counter', **labels):
+        """Export func() as a counter (or kind='gauge'); replaces an earlier function of the same name."""
+        key = (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+        with self._lock:
+            self._metrics[key] = FunctionMetric(name, help, func, kind, key[1])
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def export(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        described = set()
+        for metric in sorted(self.metrics(), key=lambda metric: (metric.name, metric.labels)):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.export())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def histogram(name, help='', **labels):
+    return REGISTRY.histogram(name, help, **labels)
+
+
+def counter(name, help='', **labels):
+    return REGISTRY.counter(name, help, **labels)
+
+
+def register_function(name, help, func, kind='counter', **labels):
+    REGISTRY.register_function(name, help, func, kind, **labels)
+
+
+class MetricsServer():
+    """
+    Serves the registry at http://host:port/metrics on a background thread.
+
+    Parameters:
+        port: TCP port; 0 picks a free one (see self.port).
+        host: Address to listen on, the local host only by default.
+    """
+
+    def __init__(self, port=9108, host='127.0.0.1', registry=REGISTRY):
+        self.registry = registry
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = outer.registry.export().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SummaryReporter(threading.Thread):
+    """
+    Prints one line every interval seconds with what happened in that interval:
+    count, p50, p99 and p99.9 of every histogram that saw values and the
+    change of every counter that moved.
+
+    Parameters:
+        interval: Seconds between lines.
+        prefix: Start of the line, e.g. 'metrics'.
+    """
+
+    def __init__(self, interval=60.0, prefix='metrics', registry=REGISTRY, log=print):
+        super().__init__(name='metrics-summary', daemon=True)
+        self.interval = interval
+        self.prefix = prefix
+        self.registry = registry
+        self.log = log
+        self._previous = {}
+        self._stop_event = threading.Event()
+
+    def summary(self):
+        """The summary line of the values recorded since the previous call."""
+        parts = []
+        for metric in sorted(self.registry.metrics(), key=lambda metric: (metric.name, metric.labels)):
+            key = (metric.name, metric.labels)
+            name = metric.name + ''.join(f"[{value}]" for _, value in metric.labels)
+            if isinstance(metric, Histogram):
+                count, _, (p50, p99, p999) = metric.since_snapshot(self._previous.get(key), (0.5, 0.99, 0.999))
+                self._previous[key] = metric.snapshot()
+                if count:
+                    parts.append(f"{name} n={count} p50={_ms(p50)} p99={_ms(p99)} p99.9={_ms(p999)}")
+            else:
+                value = metric.value
+                change = value - self._previous.get(key, 0)
+                self._previous[key] = value
+                if change:
+                    parts.append(f"{name} +{change}")
+        return f"{self.prefix}: " + (" | ".join(parts) if parts else "idle")
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.log(self.summary())
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:.2f}ms"
+
+
+if __name__ == "__main__":
+    import timeit
+
+    h = Histogram('bench_seconds')
+    count = 200000
+    record = timeit.timeit(lambda: h.record(0.0123), number=count) / count
+
+    def timed():
+        with h.time():
+            pass
+
+    block = timeit.timeit(timed, number=count) / count
+    c = Counter('bench_total')
+    inc = timeit.timeit(c.inc, number=count) / count
+    print(f"record {record * 1e9:.0f} ns, timed block {block * 1e9:.0f} ns, counter inc {inc * 1e9:.0f} ns")
+
+    # Percentiles of a known distribution stay within the bucket precision
+    h = Histogram('check_seconds')
+    for micros in range(1, 100001):
+        h.record(micros / 1e6)
+    for quantile, value in zip(QUANTILES, h.percentiles()):
+        error = abs(value - quantile * 0.1) / (quantile * 0.1)
+        print(f"p{quantile * 100:g}: {value * 1000:.3f} ms (error {error:.1%})")
+        assert error < 0.04
@@ -0,0 +1,313 @@
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+# File layout:
+#   header   magic, schema length, schema (JSON), padded to 8 bytes
+#   chunks   chunk header, then every column of the chunk one after the other
+#   footer   chunk index, then the trailer pointing at it (written on close)
+# A chunk header is enough to find the next chunk, so a file whose writer
+# did not close it (no footer) can still be read by scanning the chunks.
+FILE_MAGIC = b'MLOG0001'
+HEADER = struct.Struct('<8sI4x')
+CHUNK_MAGIC = b'CHNK'
+# magic, number of rows, crc32 of the column data, column data length, first and last timestamp
+CHUNK_HEADER = struct.Struct('<4sIIIqq')
+# chunk offset, number of rows, first and last timestamp
+INDEX_ENTRY = struct.Struct('<QI4xqq')
+FOOTER_MAGIC = b'MLOGEND1'
+# index offset, number of chunks, crc32 of the index
+TRAILER = struct.Struct('<QII8s')
+
+TIMESTAMP = 'timestamp'
+TIMESTAMP_DTYPE = np.dtype('datetime64[us]')
+
+
+def _pad(length):
+    return -length % 8
+
+
+def to_microseconds(timestamp):
+    """datetime / datetime64 / epoch microseconds to int64 microseconds."""
+    if isinstance(timestamp, (int, np.integer)):
+        return int(timestamp)
+    return int(np.datetime64(timestamp, 'us').astype(np.int64))
+
+
+class MissionLogWriter():
+    """
+    Appends rows to a columnar binary mission log.
+
+    Rows are buffered in memory and written as one chunk per flush: a small
+    header with the row count and time range, then every column as a typed
+    array. The chunk index and a footer are written by close(). Opening an
+    existing log with the same columns continues it.
+
+    Parameters:
+        filename: Log file.
+        columns: Column names (float64), or (name, dtype) tuples. A 'timestamp'
+            column (datetime64[us]) is always added first.
+        flush_every: Write a chunk every N rows, 1 to write every row.
+        flush_interval: Also write a chunk when a row is added and the oldest buffered row
+            is this many seconds old.
+        fsync: fsync the file after every chunk.
+    """
+
+    def __init__(self, filename, columns, flush_every=100, flush_interval=None, fsync=False):
+        self.filename = filename
+        self.columns = [(TIMESTAMP, TIMESTAMP_DTYPE.str)]
+        for column in columns:
+            name, dtype = (column, 'f8') if isinstance(column, str) else column
+            if name != TIMESTAMP:
+                self.columns.append((name, np.dtype(dtype).str))
+        self.flush_every = max(1, flush_every)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rows = 0
+        self.chunks = 0
+        self._buffer = []
+        self._first_buffered = None
+        self._index = []
+
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            reader = MissionLogReader(filename)
+            if reader.columns != self.columns:
+                reader.close()
+                raise ValueError(f"{filename} has columns {reader.columns}, not {self.columns}")
+            self._index = [(c.offset, c.rows, c.start, c.end) for c in reader.chunks]
+            end = reader.data_end
+            self.rows = len(reader)
+            reader.close()
+            self._file = open(filename, 'r+b')
+            # Drop the footer (or a torn chunk), new chunks go right after the last one
+            self._file.truncate(end)
+            self._file.seek(end)
+        else:
+            self._file = open(filename, 'wb')
+            schema = json.dumps({'columns': self.columns}).encode('utf-8')
+            self._file.write(HEADER.pack(FILE_MAGIC, len(schema)) + schema + b'\0' * _pad(len(schema)))
+            self._file.flush()
+        self.chunks = len(self._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, timestamp, values):
+        """
+        Add one row.
+
+        Parameters:
+            timestamp: datetime of the row.
+            values: Mapping of column name to value, missing columns are stored as NaN.
+        """
+        row = [to_microseconds(timestamp)]
+        for name, _ in self.columns[1:]:
+            value = values.get(name)
+            row.append(np.nan if value is None else value)
+        self._buffer.append(row)
+        if self._first_buffered is None:
+            self._first_buffered = time.monotonic()
+        if len(self._buffer) >= self.flush_every or (
+                self.flush_interval is not None
+                and time.monotonic() - self._first_buffered >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as one chunk."""
+        if not self._buffer:
+            return
+        rows = len(self._buffer)
+        data = []
+        for i, (name, dtype) in enumerate(self.columns):
+            if i == 0:
+                column = np.array([row[0] for row in self._buffer], dtype=np.int64)
+            else:
+                column = np.array([row[i] for row in self._buffer], dtype=np.dtype(dtype))
+            data.append(column.tobytes())
+            data.append(b'\0' * _pad(column.nbytes))
+        data = b''.join(data)
+        times = [row[0] for row in self._buffer]
+        start, end = min(times), max(times)
+        offset = self._file.tell()
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, rows, zlib.crc32(data), len(data), start, end) + data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._index.append((offset, rows, start, end))
+        self.rows += rows
+        self.chunks += 1
+        self._buffer = []
+        self._first_buffered = None
+
+    def close(self):
+        """Write the last chunk and the footer."""
+        if self._file is None:
+            return
+        self.flush()
+        index = b''.join(INDEX_ENTRY.pack(*entry) for entry in self._index)
+        index_offset = self._file.tell()
+        self._file.write(index + TRAILER.pack(index_offset, len(self._index), zlib.crc32(index), FOOTER_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+
+class Chunk():
+    __slots__ = ('offset', 'rows', 'start', 'end')
+
+    def __init__(self, offset, rows, start, end):
+        self.offset = offset
+        self.rows = rows
+        self.start = start
+        self.end = end
+
+
+class MissionLogReader():
+    """
+    Memory-mapped reader for a mission log.
+
+    Columns are NumPy views on the mapped file, so reading a time range only
+    touches the chunks that overlap it. Logs without a footer (writer still
+    running or crashed) are read by scanning the chunk headers; a torn last
+    chunk is ignored.
+
+    Parameters:
+        filename: Log file written by MissionLogWriter.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if len(self._map) < HEADER.size:
+            self.close()
+            raise ValueError(f"{filename} is not a mission log")
+        magic, schema_length = HEADER.unpack_from(self._map, 0)
+        if magic != FILE_MAGIC:
+            self.close()
+            raise ValueError(f"{filename} is not a mission log")
+        schema = json.loads(bytes(self._map[HEADER.size:HEADER.size + schema_length]))
+        self.columns = [tuple(column) for column in schema['columns']]
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in self.columns}
+        self.data_start = HEADER.size + schema_length + _pad(schema_length)
+        self.chunks, self.data_end = self._read_footer()
+        if self.chunks is None:
+            self.chunks, self.data_end = self._scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return sum(chunk.rows for chunk in self.chunks)
+
+    def _read_footer(self):
+        if len(self._map) < self.data_start + TRAILER.size:
+            return None, None
+        index_offset, count, crc, magic = TRAILER.unpack_from(self._map, len(self._map) - TRAILER.size)
+        if magic != FOOTER_MAGIC or index_offset + count * INDEX_ENTRY.size != len(self._map) - TRAILER.size:
+            return None, None
+        index = self._map[index_offset:index_offset + count * INDEX_ENTRY.size]
+        if zlib.crc32(index) != crc:
+            return None, None
+        chunks = [Chunk(*INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)) for i in range(count)]
+        return chunks, index_offset
+
+    def _scan(self):
+        chunks = []
+        offset = self.data_start
+        while offset + CHUNK_HEADER.size <= len(self._map):
+            magic, rows, crc, length, start, end = CHUNK_HEADER.unpack_from(self._map, offset)
+            data_offset = offset + CHUNK_HEADER.size
+            if magic != CHUNK_MAGIC or data_offset + length > len(self._map) \
+                    or zlib.crc32(self._map[data_offset:data_offset + length]) != crc:
+                break
+            chunks.append(Chunk(offset, rows, start, end))
+            offset = data_offset + length
+        return chunks, offset
+
+    def _chunk_column(self, chunk, name):
+        offset = chunk.offset + CHUNK_HEADER.size
+        for column, _ in self.columns:
+            dtype = self.dtypes[column]
+            if column == name:
+                return np.frombuffer(self._map, dtype=dtype, count=chunk.rows, offset=offset)
+            nbytes = dtype.itemsize * chunk.rows
+            offset += nbytes + _pad(nbytes)
+        raise KeyError(name)
+
+    def read(self, start=None, end=None, columns=None):
+        """
+        Read the rows with start <= timestamp <= end.
+
+        Parameters:
+            start: datetime, None for the beginning of the log.
+            end: datetime, None for the end of the log.
+            columns: Column names to return, all of them by default.
+
+        Returns:
+            dict of column name to NumPy array, 'timestamp' as datetime64[us].
+        """
+        names = [name for name, _ in self.columns] if columns is None else list(columns)
+        if TIMESTAMP not in names:
+            names = [TIMESTAMP] + names
+        t0 = to_microseconds(start) if start is not None else None
+        t1 = to_microseconds(end) if end is not None else None
+        parts = {name: [] for name in names}
+        for chunk in self.chunks:
+            if (t0 is not None and chunk.end < t0) or (t1 is not None and chunk.start > t1):
+                continue
+            times = self._chunk_column(chunk, TIMESTAMP).view(np.int64)
+            if (t0 is None or chunk.start >= t0) and (t1 is None or chunk.end <= t1):
+                selection = slice(None)
+            else:
+                selection = np.ones(chunk.rows, dtype=bool)
+                if t0 is not None:
+                    selection &= times >= t0
+                if t1 is not None:
+                    selection &= times <= t1
+            for name in names:
+                parts[name].append(self._chunk_column(chunk, name)[selection])
+        return {name: np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=self.dtypes[name])
+                for name in names}
+
+    def to_dataframe(self, start=None, end=None, columns=None):
+        """Same as read(), as a pandas DataFrame indexed by timestamp."""
+        import pandas as pd
+
+        return pd.DataFrame(self.read(start, end, columns)).set_index(TIMESTAMP)
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+if __name__ == "__main__":
+    # Print a summary of a mission log and optionally export it:
+    # python missionlog.py [log_file] [csv_output]
+    import sys
+
+    if len(sys.argv) < 2:
+        print("python missionlog.py [log_file] [csv_output]")
+        sys.exit(1)
+    with MissionLogReader(sys.argv[1]) as log:
+        print(f"{len(log)} rows in {len(log.chunks)} chunks, columns: {[name for name, _ in log.columns]}")
+        if log.chunks:
+            first = np.datetime64(log.chunks[0].start, 'us')
+            last = np.datetime64(log.chunks[-1].end, 'us')
+            print(f"from {first} to {last}")
+        if len(sys.argv) > 2:
+            log.to_dataframe().to_csv(sys.argv[2])
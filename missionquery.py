@@ -0,0 +1,203 @@
+from array import array
+
+import numpy as np
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE
+from pymongo.errors import OperationFailure
+
+from geodesy import EARTH_RADIUS_M
+from tsstore import META_FIELD, TIME_FIELD
+
+
+class MissionQuery():
+    """
+    Read stored readings back as NumPy columns or pandas DataFrames.
+
+    Works on the time-series collection of tsstore.TimeSeriesStore (the
+    default field names) and on the older per-mission collections written
+    directly by run.py (asv_field='metadata.asvid', mission_field=None).
+    Results are read from the cursor batch by batch straight into typed
+    arrays, only the fields that are needed are fetched.
+
+    Parameters:
+        collection: pymongo Collection.
+        batch_size: Documents per cursor batch.
+        asv_field: Field holding the vessel id.
+        mission_field: Field holding the mission name, None if the collection has one mission.
+    """
+
+    def __init__(self, collection, batch_size=1000, asv_field=META_FIELD + '.asvid',
+                 mission_field=META_FIELD + '.mission'):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.asv_field = asv_field
+        self.mission_field = mission_field
+
+    def ensure_indexes(self, backfill=True):
+        """
+        Create the 2dsphere and timestamp indexes.
+
+        Parameters:
+            backfill: Add the GeoJSON 'location' field to documents that only
+                have latitude/longitude (older collections), the 2dsphere index
+                is built on it. On a time-series collection this update needs
+                MongoDB 7.0 (earlier servers only update the meta field); when
+                the server refuses it the backfill is skipped, readings written
+                by TimeSeriesStore have a location already.
+        """
+        if backfill:
+            try:
+                self.collection.update_many(
+                    {'location': {'$exists': False}, 'latitude': {'$type': 'number'}, 'longitude': {'$type': 'number'}},
+                    [{'$set': {'location': {'type': 'Point', 'coordinates': ['$longitude', '$latitude']}}}])
+            except OperationFailure as e:
+                print(f"Skipping the location backfill of {self.collection.name} - {e}")
+        self.collection.create_index([('location', GEOSPHERE)])
+        self.collection.create_index([(TIME_FIELD, ASCENDING)])
+        self.collection.create_index([(self.asv_field, ASCENDING), (TIME_FIELD, DESCENDING)])
+        if self.mission_field:
+            self.collection.create_index([(self.mission_field, ASCENDING), (TIME_FIELD, ASCENDING)])
+
+    def _filter(self, start=None, end=None, mission=None, asvid=None, geometry=None):
+        query = {}
+        if start is not None or end is not None:
+            query[TIME_FIELD] = {}
+            if start is not None:
+                query[TIME_FIELD]['$gte'] = start
+            if end is not None:
+                query[TIME_FIELD]['$lte'] = end
+        if mission is not None:
+            if self.mission_field is None:
+                raise ValueError("This collection has no mission field")
+            query[self.mission_field] = mission
+        if asvid is not None:
+            query[self.asv_field] = asvid
+        if geometry is not None:
+            query['location'] = {'$geoWithin': geometry}
+        return query
+
+    def _projection(self, params):
+        projection = {'_id': 0, TIME_FIELD: 1, 'latitude': 1, 'longitude': 1, self.asv_field: 1}
+        if params is None:
+            projection['exodata'] = 1
+        else:
+            for code in params:
+                projection[f'exodata.{code}'] = 1
+        return projection
+
+    def _get(self, document, field):
+        for key in field.split('.'):
+            if not isinstance(document, dict):
+                return None
+            document = document.get(key)
+        return document
+
+    def _collect(self, cursor, params=None):
+        """Read a cursor into columns; params None collects every numeric exodata field."""
+        timestamps = []
+        asvids = []
+        latitude = array('d')
+        longitude = array('d')
+        values = {str(code): array('d') for code in params} if params is not None else {}
+        nan = float('nan')
+        rows = 0
+        for document in cursor.batch_size(self.batch_size):
+            timestamps.append(document.get(TIME_FIELD))
+            asvids.append(self._get(document, self.asv_field))
+            lat = document.get('latitude')
+            lon = document.get('longitude')
+            latitude.append(nan if lat is None else lat)
+            longitude.append(nan if lon is None else lon)
+            exodata = document.get('exodata') or {}
+            if params is None:
+                for key, value in exodata.items():
+                    if key not in values and _to_float(value) is not None:
+                        # Parameter that shows up mid-stream, earlier rows did not have it
+                        values[key] = array('d', [nan]) * rows
+            for key, column in values.items():
+                value = _to_float(exodata.get(key))
+                column.append(nan if value is None else value)
+            rows += 1
+        columns = {
+            TIME_FIELD: np.array(timestamps, dtype='datetime64[us]'),
+            'asvid': np.array(asvids, dtype=object),
+            'latitude': np.frombuffer(latitude, dtype=np.float64),
+            'longitude': np.frombuffer(longitude, dtype=np.float64),
+        }
+        for key, column in values.items():
+            columns[key] = np.frombuffer(column, dtype=np.float64)
+        return columns
+
+    def find(self, start=None, end=None, mission=None, asvid=None, params=None, geometry=None):
+        """
+        Readings in a time window, sorted by time.
+
+        Parameters:
+            start, end: datetime bounds (inclusive), None for open ended.
+            mission, asvid: Only readings of this mission / vessel.
+            params: Parameter codes to return, all numeric ones when None.
+            geometry: $geoWithin operand, used by within_radius() and within_polygon().
+
+        Returns:
+            dict of NumPy columns: timestamp, asvid, latitude, longitude and one per parameter code.
+        """
+        cursor = self.collection.find(self._filter(start, end, mission, asvid, geometry),
+                                      self._projection(params)).sort(TIME_FIELD, ASCENDING)
+        return self._collect(cursor, params)
+
+    def within_radius(self, center, radius_m, start=None, end=None, **options):
+        """Readings within radius_m meters of center (latitude, longitude), see find()."""
+        geometry = {'$centerSphere': [[center[1], center[0]], radius_m / EARTH_RADIUS_M]}
+        return self.find(start, end, geometry=geometry, **options)
+
+    def within_polygon(self, polygon, start=None, end=None, **options):
+        """Readings inside a polygon given as (latitude, longitude) vertices, see find()."""
+        ring = [[lon, lat] for lat, lon in polygon]
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+        geometry = {'$geometry': {'type': 'Polygon', 'coordinates': [ring]}}
+        return self.find(start, end, geometry=geometry, **options)
+
+    def latest_per_asv(self, mission=None, params=None):
+        """
+        Most recent reading of every vessel.
+
+        Returns:
+            dict of NumPy columns, one row per vessel.
+        """
+        match = self._filter(mission=mission)
+        pipeline = ([{'$match': match}] if match else []) + [
+            {'$sort': {TIME_FIELD: -1}},
+            {'$group': {'_id': '$' + self.asv_field, 'reading': {'$first': '$$ROOT'}}},
+            {'$replaceRoot': {'newRoot': '$reading'}},
+            {'$project': self._projection(params)},
+            {'$sort': {self.asv_field: 1}},
+        ]
+        return self._collect(self.collection.aggregate(pipeline, batchSize=self.batch_size), params)
+
+    def parameter_series(self, code, mission=None, asvid=None, start=None, end=None):
+        """
+        One parameter over time.
+
+        Returns:
+            (timestamps as datetime64[us], values as float64)
+        """
+        columns = self.find(start, end, mission, asvid, params=[code])
+        return columns[TIME_FIELD], columns[str(code)]
+
+    def to_dataframe(self, columns):
+        """Turn the columns returned by the other methods into a DataFrame indexed by timestamp."""
+        import pandas as pd
+
+        return pd.DataFrame(columns).set_index(TIME_FIELD)
+
+
+def _to_float(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        # Older missions stored the sonde values as strings
+        return float(value)
+    except (TypeError, ValueError):
+        return None
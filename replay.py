@@ -0,0 +1,474 @@
+"""
+Replay a recorded mission through the acquisition pipeline.
+
+python replay.py [log] [speed] [runtime] [nmea_capture]
+    log:          JSON log of run.py (concatenated or one document per line,
+                  .gz segments too) or a sampler log like samples.out
+    speed:        1 for real time, N for N times faster, max for as fast as possible (default max)
+    runtime:      threads (run.py's AcquisitionPipeline, default) or asyncio (aioruntime.py)
+    nmea_capture: Raw NMEA stream to send instead of GGA sentences made from the log
+python replay.py [nmea_capture] [speed] nmea
+    Only send the capture through the Surveyor reader and count what it decodes.
+
+The recorded rows are sent by an Exo2Emulator and the GPS fixes by a
+SurveyorEmulator (see emulators.py), both driven by the replay instead of
+their own clocks. A single driver thread
+sends both streams in recorded order, so runs are repeatable. The documents
+the pipeline produces are checked against the log: same sonde values in the
+same order and, without a capture, the same position.
+"""
+import collections
+import datetime
+import gzip
+import json
+import re
+import sys
+import threading
+import time
+
+import helper as hlp
+from emulators import Exo2Emulator, SurveyorEmulator, _nmea_degrees
+from exo2codec import DATE_FORMATS, TIME_CODE, Exo2Codec
+from geodesy import haversine
+
+# time: epoch seconds of the host timestamp, row: the line the sonde sent
+ReplayRecord = collections.namedtuple('ReplayRecord', ['time', 'latitude', 'longitude', 'params', 'row'])
+
+GPS = 0
+EXO2 = 1
+SAMPLER_MARKER = ', exo: '
+_WHITESPACE = re.compile(r'\s*')
+
+
+def read_json_documents(filename):
+    """Documents of a JSON log, written back to back (old run.py) or one per line (NdjsonWriter)."""
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    documents = []
+    position = _WHITESPACE.match(text, 0).end()
+    while position < len(text):
+        try:
+            document, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError as e:
+            print(f"Stopping at a damaged record in {filename} - {e}")
+            break
+        documents.append(document)
+        position = _WHITESPACE.match(text, position).end()
+    return documents
+
+
+def read_sampler_log(filename):
+    """Documents logged with the samples in a sampler log ('<time>, <point>, exo: {...}' lines)."""
+    documents = []
+    with open(filename, 'r') as f:
+        for line in f:
+            position = line.find(SAMPLER_MARKER)
+            if position < 0:
+                continue
+            try:
+                documents.append(json.loads(line[position + len(SAMPLER_MARKER):]))
+            except json.JSONDecodeError:
+                print(f"Skipping damaged line in {filename}: {line.strip()}")
+    return documents
+
+
+def _row_value(code, value):
+    """A stored exodata value as the sonde sent it."""
+    code = int(code)
+    if isinstance(value, str):
+        # Logs written since exo2codec store the sonde date and time as ISO strings
+        if code in DATE_FORMATS and '-' in value:
+            return datetime.date.fromisoformat(value).strftime(DATE_FORMATS[code])
+        if code == TIME_CODE and ':' in value:
+            return value.replace(':', '')[:6]
+        return value
+    return repr(float(value))
+
+
+def _epoch(timestamp):
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if isinstance(timestamp, dict):
+        # Extended JSON from a database export
+        timestamp = timestamp.get('$date')
+    return datetime.datetime.fromisoformat(str(timestamp).replace('Z', '+00:00')).timestamp()
+
+
+def load_records(filename):
+    """
+    Rows of a mission log, oldest first.
+
+    Records whose parameters differ from the first record's are skipped,
+    the sonde can only replay one para list.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(4096)
+    if filename.endswith('.gz') or SAMPLER_MARKER.encode() not in head:
+        documents = read_json_documents(filename)
+    else:
+        documents = read_sampler_log(filename)
+    records = []
+    skipped = 0
+    for document in documents:
+        exodata = document.get('exodata')
+        if not exodata or document.get('timestamp') is None:
+            skipped += 1
+            continue
+        params = tuple(exodata.keys())
+        if records and params != records[0].params:
+            skipped += 1
+            continue
+        try:
+            row = ' '.join(_row_value(code, value) for code, value in exodata.items())
+            records.append(ReplayRecord(_epoch(document['timestamp']), document.get('latitude'),
+                                        document.get('longitude'), params, row))
+        except (TypeError, ValueError):
+            skipped += 1
+    if skipped:
+        print(f"Skipped {skipped} documents of {filename} that cannot be replayed")
+    records.sort(key=lambda record: record.time)
+    return records
+
+
+def gga_sentence(timestamp, latitude, longitude):
+    utc = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    body = (f"GPGGA,{utc:%H%M%S}.{utc.microsecond // 10000:02d},"
+            f"{_nmea_degrees(latitude, 2)},{hlp.get_hemisphere_lat(latitude)},"
+            f"{_nmea_degrees(longitude, 3)},{hlp.get_hemisphere_lon(longitude)},"
+            "1,08,0.9,0.0,M,0.0,M,,")
+    return hlp.create_nmea_message(body).encode('ascii')
+
+
+def read_nmea_capture(filename):
+    """
+    Sentences of a raw NMEA capture as (seconds from the first GGA, sentence bytes).
+
+    The capture has no timestamps of its own, every sentence is timed by the
+    GGA before it.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    sentences = []
+    first = None
+    offset = 0.0
+    for line in data.split(b'\n'):
+        line = line.strip()
+        if not line.startswith(b'$'):
+            continue
+        if line[3:6] == b'GGA':
+            fix_time = hlp.nmea_time(line.split(b',')[1].decode('ascii', 'replace'))
+            if fix_time is not None:
+                seconds = fix_time.hour * 3600 + fix_time.minute * 60 + fix_time.second + fix_time.microsecond / 1e6
+                if first is None:
+                    first = seconds
+                offset = (seconds - first) % 86400  # past midnight UTC
+        sentences.append((offset, line + b'\r\n'))
+    return sentences
+
+
+def build_events(records=None, capture=None):
+    """Merge the sonde rows and GPS sentences into one list of (offset, GPS or EXO2, bytes)."""
+    events = []
+    if records:
+        start = records[0].time
+        for record in records:
+            events.append((record.time - start, EXO2, (record.row + '\r\n').encode('ascii')))
+            if capture is None and record.latitude is not None:
+                events.append((record.time - start, GPS, gga_sentence(record.time, record.latitude,
+                                                                      record.longitude)))
+    if capture:
+        events.extend((offset, GPS, sentence) for offset, sentence in capture)
+    # A fix goes out before the row recorded at the same time
+    events.sort(key=lambda event: (event[0], event[1]))
+    return events
+
+
+class ReplayDriver(threading.Thread):
+    """
+    Sends the events to the emulators on the recorded schedule.
+
+    Starts once the pipeline is connected to the Surveyor and the sonde is in
+    run mode. speed is the replay rate (2 = twice as fast), None to send as
+    fast as possible. With a collector and a window, a row is only sent while
+    fewer than window rows are waiting for their document, so the pipeline is
+    run at the highest rate it sustains instead of being flooded. While it
+    waits, the last GGA sentence is repeated every gps_repeat seconds like a
+    receiver would, so the pipeline never waits for a newer fix.
+    """
+
+    def __init__(self, events, surveyor, sonde, speed=None, collector=None, window=None, start_timeout=30.0,
+                 stall_timeout=1.0, gps_repeat=0.01):
+        super().__init__(name='replay-driver', daemon=True)
+        self.events = events
+        self.surveyor = surveyor
+        self.sonde = sonde
+        self.speed = speed
+        self.collector = collector
+        self.window = window
+        self.start_timeout = start_timeout
+        self.stall_timeout = stall_timeout
+        self.gps_repeat = gps_repeat
+        self.started = None
+        self.finished = None
+        self.sent = 0
+        self.rows = 0
+        self.stalls = 0
+        self.done = threading.Event()
+        self._last_gps = None
+
+    def _wait_window(self):
+        collector = self.collector
+        deadline = time.monotonic() + self.stall_timeout
+        with collector.cond:
+            while self.rows - len(collector.documents) >= self.window:
+                if time.monotonic() >= deadline:
+                    # Rows lost in the pipeline never produce a document, do not wait for them forever
+                    self.stalls += 1
+                    return
+                if not collector.cond.wait(self.gps_repeat) and self._last_gps is not None:
+                    self.surveyor.send(self._last_gps)
+
+    def run(self):
+        try:
+            deadline = time.monotonic() + self.start_timeout
+            if not self.surveyor.wait_client(self.start_timeout):
+                print("The pipeline did not connect to the Surveyor emulator")
+                return
+            if self.sonde is not None and not self.sonde.running.wait(max(0.0, deadline - time.monotonic())):
+                print("The pipeline did not start the sonde")
+                return
+            self.started = time.monotonic()
+            for offset, kind, data in self.events:
+                if self.speed:
+                    wait = self.started + offset / self.speed - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                if kind == GPS:
+                    self.surveyor.send(data)
+                    if data[3:7] == b'GGA,':
+                        self._last_gps = data
+                else:
+                    if self.window:
+                        self._wait_window()
+                    self.sonde.emit(data)
+                    self.rows += 1
+                self.sent += 1
+            self.finished = time.monotonic()
+        finally:
+            self.done.set()
+
+
+class _Collector():
+    """Sink keeping the produced documents and the time of the last one."""
+
+    def __init__(self):
+        self.documents = []
+        self.last = time.monotonic()
+        self.cond = threading.Condition()
+
+    def put(self, document):
+        with self.cond:
+            self.documents.append(document)
+            self.last = time.monotonic()
+            self.cond.notify_all()
+
+
+def _finished(driver, collector, expected, idle_timeout):
+    if len(collector.documents) >= expected:
+        return True
+    return driver.done.is_set() and time.monotonic() - max(collector.last, driver.finished or 0) > idle_timeout
+
+
+def run_threaded(driver, collector, surveyor_port, sonde_port, expected, idle_timeout=3.0, gps_interval=0.0,
+                 max_skew=2.0):
+    """Run run.py's acquisition path (Exo2 streaming, Surveyor reader, AcquisitionPipeline)."""
+    import surveyor
+    from acquisition import AcquisitionPipeline, stamped_reader
+    from exo2 import Exo2
+
+    stats = {}
+    exo = Exo2('localhost', sonde_port, 9600, 0.05, Exo2.SERIAL)
+    try:
+        keys, _ = exo.get_exo2_params()
+        codec = Exo2Codec(keys)
+        metadata = {'asvid': 0, 'sn': exo.get_sn(), 'ssn': exo.get_ssn()}
+        with surveyor.Surveyor('127.0.0.1', surveyor_port, background=True) as s:
+            exo.start_stream(num_fields=len(keys))
+            driver.start()
+            read_exo = stamped_reader(exo.read_stream_row, timeout=0.5)
+            with AcquisitionPipeline(s.get_next_gps_coordinates, read_exo,
+                                     gps_interval=gps_interval, max_skew=max_skew) as pipeline:
+                while not _finished(driver, collector, expected, idle_timeout):
+                    for row, fix in pipeline.pairs(timeout=0.5):
+                        record = codec.parse(row.value, row.wall)
+                        if record is not None:
+                            collector.put(record.to_document(fix.value[0], fix.value[1], dict(metadata)))
+                        if len(collector.documents) >= expected:
+                            break
+                stats = {'discarded': pipeline.discarded, 'stream_dropped': exo.stream_dropped,
+                         'stream_skipped': exo.stream_skipped}
+    finally:
+        exo.close()
+    return stats
+
+
+def run_asyncio(driver, collector, surveyor_port, sonde_port, expected, idle_timeout=3.0, max_skew=2.0):
+    """Run aioruntime's acquire() with AsyncSurveyor and AsyncExo2."""
+    import asyncio
+
+    from aioruntime import AsyncExo2, AsyncSurveyor, acquire
+
+    async def main():
+        async with AsyncSurveyor('127.0.0.1', surveyor_port) as surveyor, AsyncExo2(sonde_port) as exo:
+            keys, _ = await exo.get_exo2_params()
+            await exo.get_sn()
+            await exo.get_ssn()
+            codec = Exo2Codec(keys)
+            await exo.start_stream(num_fields=codec.num_fields)
+            driver.start()
+            task = asyncio.create_task(acquire(surveyor, exo, codec, [collector], max_rows=expected,
+                                               max_skew=max_skew, row_timeout=idle_timeout))
+            while not task.done():
+                await asyncio.sleep(0.2)
+                if _finished(driver, collector, expected, idle_timeout):
+                    task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return {'stream_dropped': exo.stream_dropped, 'stream_skipped': exo.stream_skipped}
+
+    return asyncio.run(main())
+
+
+def check_output(records, documents, tolerance_m=1.0, check_positions=True, position_slack=0, lookahead=1000):
+    """
+    Compare the produced documents with the recorded rows.
+
+    Documents are matched to records in order by their sonde values; records
+    without a document are missing, documents without a record unexpected.
+    A position counts as right when it is within tolerance_m of the record's,
+    or of one of the position_slack records before or after it: when the
+    replay is faster than real time the fixes are too close together in time
+    for the pipeline to tell them apart.
+    """
+    codec = Exo2Codec(records[0].params)
+    expected = [codec.parse(record.row).exodata() for record in records]
+    matched = missing = unexpected = position_errors = 0
+    max_position_error = 0.0
+    i = 0
+    for document in documents:
+        exodata = document['exodata']
+        j = i
+        while j < len(expected) and j - i < lookahead and expected[j] != exodata:
+            j += 1
+        if j == len(expected) or expected[j] != exodata:
+            unexpected += 1
+            continue
+        missing += j - i
+        matched += 1
+        record = records[j]
+        i = j + 1
+        if check_positions and record.latitude is not None:
+            nearby = [(r.latitude, r.longitude) for r in records[max(0, j - position_slack):j + position_slack + 1]
+                      if r.latitude is not None]
+            error = float(haversine(nearby, (document['latitude'], document['longitude'])).min())
+            max_position_error = max(max_position_error, error)
+            if error > tolerance_m:
+                position_errors += 1
+    missing += len(expected) - i
+    return {'records': len(records), 'produced': len(documents), 'matched': matched, 'missing': missing,
+            'unexpected': unexpected, 'position_errors': position_errors,
+            'max_position_error_m': max_position_error}
+
+
+def replay(records, speed=None, runtime='threads', capture=None, window=4, idle_timeout=3.0, tolerance_m=1.0,
+           echo=True, exo_faults=None, gps_faults=None):
+    """
+    Replay records through the pipeline and check what comes out.
+
+    At max speed (speed None) at most window rows are in the pipeline at once,
+    the rate is then the highest record rate it sustains. exo_faults and
+    gps_faults are emulators.FaultInjector for the sonde and Surveyor links.
+
+    Returns:
+        dict with the check_output() counters, the pipeline's own counters,
+        elapsed seconds and the rate of matched records per second.
+    """
+    if not records:
+        raise ValueError("Nothing to replay")
+    events = build_events(records, capture)
+    surveyor = SurveyorEmulator(rate=None, faults=gps_faults)
+    sonde = Exo2Emulator(records[0].params, sn='REPLAY', echo=echo, sample_interval=None, faults=exo_faults)
+    collector = _Collector()
+    driver = ReplayDriver(events, surveyor, sonde, speed, collector, window if speed is None else None)
+    try:
+        if runtime == 'asyncio':
+            stats = run_asyncio(driver, collector, surveyor.port, sonde.port, len(records), idle_timeout)
+        else:
+            stats = run_threaded(driver, collector, surveyor.port, sonde.port, len(records), idle_timeout)
+    finally:
+        driver.done.wait(5)
+        surveyor.close()
+        sonde.close()
+    report = check_output(records, collector.documents, tolerance_m, check_positions=capture is None,
+                          position_slack=window if speed is None else 0 if speed == 1 else 1)
+    report.update(stats)
+    elapsed = (collector.last - driver.started) if driver.started and collector.documents else 0.0
+    report['elapsed'] = elapsed
+    report['rate'] = report['matched'] / elapsed if elapsed > 0 else 0.0
+    report['rows_not_sent'] = sonde.lost
+    report['driver_stalls'] = driver.stalls
+    return report
+
+
+def replay_nmea(capture, speed=None, idle_timeout=2.0):
+    """Send a capture through the Surveyor reader; returns sent, decoded and dropped sentence counts."""
+    import surveyor
+
+    server = SurveyorEmulator(rate=None)
+    driver = ReplayDriver(build_events(capture=capture), server, None, speed)
+    try:
+        with surveyor.Surveyor('127.0.0.1', server.port, background=True) as s:
+            driver.start()
+            driver.done.wait()
+            reader = s._reader
+            count = -1
+            last_change = time.monotonic()
+            while time.monotonic() - last_change < idle_timeout:
+                if reader.sentences + reader.dropped != count:
+                    count = reader.sentences + reader.dropped
+                    last_change = time.monotonic()
+                time.sleep(0.01)
+            elapsed = max(last_change, driver.finished) - driver.started
+            return {'sent': driver.sent, 'decoded': reader.sentences, 'dropped': reader.dropped,
+                    'elapsed': elapsed, 'rate': reader.sentences / elapsed}
+    finally:
+        server.close()
+
+
+def parse_speed(value):
+    return None if value in ('max', '0') else float(value)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("python replay.py [log] [speed] [runtime] [nmea_capture]")
+        print("python replay.py [nmea_capture] [speed] nmea")
+        sys.exit(1)
+    speed = parse_speed(sys.argv[2]) if len(sys.argv) > 2 else None
+    runtime = sys.argv[3] if len(sys.argv) > 3 else 'threads'
+    if runtime == 'nmea':
+        print(replay_nmea(read_nmea_capture(sys.argv[1]), speed))
+        sys.exit(0)
+    records = load_records(sys.argv[1])
+    capture = read_nmea_capture(sys.argv[4]) if len(sys.argv) > 4 else None
+    print(f"Replaying {len(records)} records at {'max' if speed is None else speed} speed with the {runtime} runtime")
+    report = replay(records, speed, runtime, capture)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    ok = report['missing'] == 0 and report['unexpected'] == 0 and report['position_errors'] == 0
+    print("output matches the log" if ok else "OUTPUT DIFFERS FROM THE LOG")
+    sys.exit(0 if ok else 2)
@@ -4,31 +4,12 @@ port = '/dev/ttyUSB0'
 
 exo = Exo2('',port,9600,0.05,Exo2.SERIAL)
 
-exo.serial.write(b'0')
-exo.serial.readline()
-exo.serial.readline()
-exo.serial.readline()
-res = b''
-while not res:
-	exo.serial.write(b'setecho\r')
-	res = exo.serial.readline()
+# Leave run mode if the sonde is in it and wait for the prompt
+exo.engine.send_raw(Exo2.STOP_COMMAND)
+exo.engine.wait_prompt(2.0)
+# The engine detects the echo state on every command, so just turn it back on
+res = exo.engine.command_line('setecho 1')
 print(res)
-if res == b'?Command\r\n':
-	res = exo.serial.readline()
-if res == b'setecho\r\n':
-	#echo is on just received echo
-	#read response
-	echo = exo.serial.readline()
-	#read hashtagb
-	exo.serial.readline()
-if res == b'0':
-	#echo is off 
-	#turn it back on
-
-	exo.serial.write(b'setecho 1\r')
-	res = exo.serial.readline()
-	print(res)
-	exo.serial.readline()
-	exo.serial.readline()
-
-
+exo.engine.command_line('setecho')
+print("echo on: ", exo.is_echoing)
+exo.close()
@@ -2,14 +2,26 @@ import time
 import surveyor
 
 from exo2 import Exo2
+from exo2codec import Exo2Codec, Exo2Record
+from array import array
 import datetime
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 import certifi
 import sys
 import os
-import geopy.distance
 import json
 from watersampler import WaterSamplerController
+from samplepoints import SampleCoordinateStore
+from acquisition import AcquisitionPipeline, stamped_reader
+from dbwriter import BatchedDBWriter
+from spool import Spool, SpoolUploader
+from aggregator import AggregatorUploader
+from missionlog import MissionLogWriter
+from tsstore import TimeSeriesStore
+from textlog import NdjsonWriter, CsvWriter, FSYNC_INTERVAL
+from shmring import ShmRing, SampleRecord, start_consumer, pin_to_cpus
+import metrics
 
 current_coordinates = None
 
@@ -17,60 +29,261 @@ CONNECTION_AWS = os.environ['COSMODB_STRING']
 client = MongoClient(CONNECTION_AWS, tlsCAFile=certifi.where())
 
 keys = []
+codec = None
 #port = 'COM4'
 port = '/dev/ttyUSB0'
 baudrate = 9600
 take_samples = False
-sample_points = []
+sample_store = None
 MIN_DIST = 0.005
+# GPS and EXO2 are read on their own threads; each row gets the closest fix in time
+GPS_INTERVAL = 0.2
+MAX_GPS_SKEW = 2.0
+# Let the sonde sample on its own clock ('run' mode) instead of polling with 'data'
+STREAM_EXO2 = True
 
+# Records are handed to a background writer and stored with insert_many
+db_writer = None
+DB_BATCH_SIZE = 25
+DB_FLUSH_INTERVAL = 2.0
+DB_MAX_QUEUE = 5000
+DB_POLICY = BatchedDBWriter.SPILL
 
-def read_sensor_data(sensor, coordinates=(0,0), asvid=0):
-    global keys
-    data_string = sensor.read_data()
+# With the spool enabled every record is written to disk first and uploaded
+# in the background, so nothing is lost while the link to the cluster is down
+USE_SPOOL = True
+SPOOL_DIR = 'spool'
+spool = None
+uploader = None
+
+# Send the spool to the shore aggregator (aggregator.py) instead of uploading
+# to the cluster from the boat; needs USE_SPOOL
+USE_AGGREGATOR = False
+AGGREGATOR_HOST = '192.168.0.10'
+AGGREGATOR_PORT = 8765
+
+# Readings of every mission go to one time-series collection, the sonde
+# identity and parameters are stored once per mission (see tsstore.py).
+# That collection does not enforce a unique _id, so the spool and the writer
+# go through TimeSeriesStore.insert_many, which skips readings already stored.
+# With USE_TIMESERIES = False each mission gets its own collection as before.
+USE_TIMESERIES = True
+ts_store = None
+
+# Typed columnar copy of the mission, read back with missionlog.MissionLogReader
+mission_log = None
+MISSION_LOG_FLUSH_EVERY = 10
+MISSION_LOG_FLUSH_INTERVAL = 5.0
+
+# Human readable copies of the mission (.ndjson and .csv), written through a
+# buffer and fsynced every few seconds instead of flushed on every record
+text_logs = []
+TEXT_LOG_FSYNC = FSYNC_INTERVAL
+TEXT_LOG_FSYNC_INTERVAL = 5.0
+TEXT_LOG_MAX_BYTES = 16 * 1024 * 1024
+TEXT_LOG_MAX_AGE = 3600
+
+# Multi-process mode: this process only talks to the instruments and puts
+# fixed-size records in a shared memory ring, a consumer process does the
+# JSON, database and file work so it cannot add jitter to the sensor loop
+MULTIPROCESS = False
+RING_CAPACITY = 4096
+RING_BATCH = 100
+ACQUISITION_CPUS = [0]
+PERSISTENCE_CPUS = [1, 2, 3]
+ring = None
+
+# Time spent in each stage of the loop and instrument counters (see metrics.py),
+# served as Prometheus text on METRICS_PORT (None to disable) and summarised
+# in the log every METRICS_SUMMARY_INTERVAL seconds. With MULTIPROCESS the
+# db/file/mission_log stages and the db/spool counters live in the consumer
+# process, which serves them on METRICS_PORT + 1
+METRICS_PORT = 9108
+METRICS_SUMMARY_INTERVAL = 60.0
+STAGES = {stage: metrics.histogram('acquisition_stage_seconds', 'Time spent in each stage of the acquisition loop',
+                                   stage=stage)
+          for stage in ('pair_wait', 'parse', 'ring', 'sample', 'db', 'file', 'mission_log', 'print')}
+LOOP_TIME = metrics.histogram('acquisition_loop_seconds', 'Time to handle one row once it is paired with a fix')
+ROW_AGE = metrics.histogram('acquisition_row_age_seconds', 'Age of a row when the loop picks it up')
+
+
+def read_sensor_data(sensor, coordinates=(0,0), asvid=0, data_string=None, timestamp=None):
+    global keys, codec
+    if data_string is None:
+        data_string = sensor.read_data()
     #print("Data",data_string)
-    data_list = data_string.split()
-    # print(len(data_list))
-    if len(data_list) > 1:
-        #keys = ['Date', 'Time', 'Chl (ug/L)', 'BGA-PE (ug/L)', 'Turb (FNU)', 'TSS (mg/L)', 'ODO (%sat)', 'ODO (mg/l)', 'Temp (C)', 'Cond (uS/cm)', 'Sal (PPT)', 'Pressure (psi a)', 'Depth (m)']
-        if len(keys) != len(data_list):
+    num_fields = len(data_string.split()) if data_string else 0
+    if num_fields < 2:
+        return None
+    if codec is None or codec.num_fields != num_fields:
+        # The para list changed on the sonde, compile a new codec. The query goes
+        # through the command engine, which serialises it with the reader's
+        # commands and pauses a run mode stream while it is answered.
+        if len(keys) != num_fields:
             keys, _ = sensor.get_exo2_params()
-        data_dict = {}
-        data_dict_exo = {keys[i]: data_list[i] for i in range(len(keys))}
-        data_dict['exodata'] = data_dict_exo 
-        data_dict['date'] = datetime.datetime.now().strftime("%Y-%m-%d")
-        data_dict['time'] = datetime.datetime.now().strftime("%H:%M:%S")
-        data_dict['latitude'] = current_coordinates[0]
-        data_dict['longitude'] = current_coordinates[1]
-        data_dict['timestamp'] = datetime.datetime.now()
-        data_dict['metadata'] = {}
-        data_dict['metadata']['asvid'] = asvid
-        data_dict['metadata']['sn'] = sensor.get_sn()
-        data_dict['metadata']['ssn'] = sensor.get_ssn()
-        return data_dict
-    else:
-        pass
+        codec = Exo2Codec(keys)
+    record = codec.parse(data_string, timestamp)
+    if record is None:
+        print(f"Invalid EXO2 row: {data_string}")
+        return None
+    metadata = {'asvid': asvid, 'sn': sensor.get_sn(), 'ssn': sensor.get_ssn()}
+    return record.to_document(coordinates[0], coordinates[1], metadata)
 
-def save_data_to_db(collection_name='test', data={}):
+def save_data_to_db(collection_name='test', data={}, mission_name=None, asvid=0):
     # client = MongoClient(CONNECTION_STRING)
     #print(f"DB Client: {client}")
     db = client.missions
     #print(f"DB: {db}")
 
     collection = db[collection_name]
+    if data and ts_store:
+        data = ts_store.reading(data, mission_name if mission_name is not None else collection_name, asvid)
+        collection = ts_store.readings
     if data:
-        collection.insert_one(data)
-        print('Data saved: ', data)
+        if spool:
+            spool.append(data)
+            print('Data spooled: ', data)
+        elif db_writer:
+            # insert_many adds an _id to the document, so queue a copy
+            db_writer.put(dict(data))
+            print('Data queued: ', data)
+        else:
+            collection.insert_one(data)
+            print('Data saved: ', data)
 
-def save_data_to_file(file, data={}):
+def save_data_to_file(writers, data={}):
     
     if data:
-        file.write(json.dumps(data,default=str))
-        file.flush()
+        for writer in writers:
+            writer.write_record(data)
+
+def open_sinks(collection_name, asvid, codec, sn, ssn, mission_name=None):
+    """Open the database and file outputs of the mission (named after collection_name by default)."""
+    global ts_store, spool, uploader, db_writer, mission_log, text_logs
+    if mission_name is None:
+        mission_name = collection_name
+    db_collection = client.missions[collection_name]
+    if USE_TIMESERIES:
+        ts_store = TimeSeriesStore(client.missions, create=False)
+        if not USE_AGGREGATOR:
+            try:
+                ts_store.ensure_collections()
+                ts_store.register_mission(mission_name, asvid, sn, ssn, codec.param_codes, codec.value_names)
+            except PyMongoError as e:
+                # Readings are spooled anyway, the metadata can be registered later
+                print(f"Could not register the mission - {e}")
+        # Not ts_store.readings: the store skips readings a retry sends again
+        db_collection = ts_store
+    if USE_SPOOL:
+        spool_name = f"{collection_name}-{asvid}"
+        spool = Spool(os.path.join(SPOOL_DIR, spool_name), spool_name)
+        if USE_AGGREGATOR:
+            # The aggregator registers the mission when the boat connects
+            mission = {'mission': mission_name, 'asvid': asvid, 'sn': sn, 'ssn': ssn,
+                       'params': codec.param_codes, 'param_names': codec.value_names}
+            uploader = AggregatorUploader(spool, AGGREGATOR_HOST, AGGREGATOR_PORT, mission=mission)
+        else:
+            uploader = SpoolUploader(spool, db_collection, batch_size=DB_BATCH_SIZE)
+    else:
+        db_writer = BatchedDBWriter(db_collection,
+                                    batch_size=DB_BATCH_SIZE,
+                                    flush_interval=DB_FLUSH_INTERVAL,
+                                    max_queue=DB_MAX_QUEUE,
+                                    policy=DB_POLICY,
+                                    spill_file=collection_name+"-db_spill.jsonl")
+        # Every error is followed by a retry of the same batch
+        metrics.register_function('db_retries_total', 'Failed database writes that are retried',
+                                  lambda: db_writer.errors)
+        metrics.register_function('db_dropped_total', 'Records dropped by the database writer',
+                                  lambda: db_writer.dropped)
+        metrics.register_function('db_spilled_total', 'Records spilled to disk by the database writer',
+                                  lambda: db_writer.spilled)
+    if USE_SPOOL:
+        metrics.register_function('upload_retries_total', 'Failed spool uploads that are retried',
+                                  lambda: uploader.errors)
+        metrics.register_function('spool_pending', 'Spooled records not uploaded yet',
+                                  lambda: spool.pending(), kind='gauge')
+    mission_log = MissionLogWriter(collection_name + ".mlog", ['latitude', 'longitude'] + codec.value_keys,
+                                   flush_every=MISSION_LOG_FLUSH_EVERY,
+                                   flush_interval=MISSION_LOG_FLUSH_INTERVAL)
+    text_log_options = dict(fsync_policy=TEXT_LOG_FSYNC, fsync_interval=TEXT_LOG_FSYNC_INTERVAL,
+                            max_bytes=TEXT_LOG_MAX_BYTES, max_age=TEXT_LOG_MAX_AGE)
+    text_logs = [NdjsonWriter(collection_name + ".ndjson", **text_log_options),
+                 CsvWriter(collection_name + ".csv", codec.document_columns(), **text_log_options)]
+
+def persist(data, collection_name, mission_name=None, asvid=0):
+    with STAGES['db'].time():
+        save_data_to_db(collection_name, data, mission_name, asvid)
+    with STAGES['file'].time():
+        save_data_to_file(text_logs, data)
+    if data:
+        with STAGES['mission_log'].time():
+            mission_log.append(data['timestamp'], dict(data['exodata'], latitude=data['latitude'],
+                                                       longitude=data['longitude']))
+
+def close_sinks():
+    if mission_log:
+        mission_log.close()
+    for text_log in text_logs:
+        text_log.close()
+    if db_writer:
+        db_writer.close()
+        print("DB writer stats: ", db_writer.stats())
+    if spool:
+        uploader.close()
+        spool.close()
+        print(f"Uploaded {uploader.uploaded} records, {spool.pending()} left in {spool.directory}")
+
+def persistence_consumer(consumer, collection_name, mission_name, asvid, keys, sn, ssn):
+    """
+    Body of the consumer process in multi-process mode.
+
+    Everything it needs comes in as arguments: with the spawn start method the
+    globals set by the main block do not exist in this process.
+    """
+    global client, codec
+    # The parent's MongoClient must not be used after the fork
+    client = MongoClient(CONNECTION_AWS, tlsCAFile=certifi.where())
+    codec = Exo2Codec(keys)
+    layout = SampleRecord(codec.value_keys)
+    open_sinks(collection_name, asvid, codec, sn, ssn, mission_name)
+    # The stage timings of persist() are kept in this process
+    summary = metrics.SummaryReporter(METRICS_SUMMARY_INTERVAL, prefix='metrics (persistence)')
+    summary.start()
+    metrics_server = None
+    if METRICS_PORT is not None:
+        try:
+            metrics_server = metrics.MetricsServer(METRICS_PORT + 1)
+            print(f"Persistence metrics on http://127.0.0.1:{metrics_server.port}/metrics")
+        except OSError as e:
+            print(f"Could not serve the persistence metrics on port {METRICS_PORT + 1} - {e}")
+    try:
+        while True:
+            batch = consumer.get_batch(RING_BATCH, timeout=1.0)
+            if not batch:
+                if consumer.ring.is_closed():
+                    break
+                continue
+            for record in batch:
+                timestamp, latitude, longitude, values, sonde_date, sonde_time = layout.unpack(record)
+                data = Exo2Record(codec, array('d', values), sonde_date, sonde_time, timestamp).to_document(
+                    latitude, longitude, {'asvid': asvid, 'sn': sn, 'ssn': ssn})
+                persist(data, collection_name, mission_name, asvid)
+    finally:
+        summary.stop()
+        if metrics_server:
+            metrics_server.close()
+        close_sinks()
+        client.close()
+        print(summary.summary())
+        print(f"Persistence process done, {consumer.dropped} records dropped")
+
 def take_sample(pos, sampler, filename,data):
     data = json.dumps(data,default=str)
     print("taking sample at ", pos, data)
-    sampler.sample_and_log(filename, data, updated_coords=pos)
+    # The pump runs on the sampler's scheduler so acquisition keeps going.
+    # None when the pump did not take the request
+    return sampler.sample_and_log_async(filename, data, updated_coords=pos)
 
 if __name__ == "__main__":
     asvid = 0
@@ -88,13 +301,13 @@ if __name__ == "__main__":
     if len(sys.argv) > 3 :
         sample_points_file = sys.argv[3]
         take_samples = True
-        with open(sample_points_file, 'r+') as f:
-            for line in f:
-                point = line.strip().split(",")
-                print(point)
-                sample_points.append((float(point[0]),float(point[1])))
+        # Points already sampled in an earlier run are in sample_points_file + '.journal'
+        sample_store = SampleCoordinateStore(sample_points_file)
+        print(f"{len(sample_store)} sample points left: {sample_store.remaining()}")
     if len(sys.argv) > 4 :
         sample_output = sys.argv[4]
+    metrics_server = None
+    summary = metrics.SummaryReporter(METRICS_SUMMARY_INTERVAL)
     try:
         sampler = WaterSamplerController()
         collection_name = '' + mission_name
@@ -106,6 +319,7 @@ if __name__ == "__main__":
                 #exo.initial_setup('1 5 12 20 22 53 54 211 212')
                 keys, _ = exo.get_exo2_params()
                 print("keys ",keys)
+                codec = Exo2Codec(keys)
                 if len(keys) > 0:
                     instant_fault = False
             except Exception as ex:
@@ -113,38 +327,104 @@ if __name__ == "__main__":
                 sys.exit()
                 pass
             
-        with surveyor.Surveyor(dummy=False) as s, open(collection_name+".csv", "w") as file:
+        # Cache the sonde identity before the EXO2 thread owns the serial port
+        exo.get_sn()
+        exo.get_ssn()
+        ring = None
+        if MULTIPROCESS:
+            # Start the consumer before any acquisition thread runs
+            sample_layout = SampleRecord(codec.value_keys)
+            ring = ShmRing.create(sample_layout.size, capacity=RING_CAPACITY)
+            consumers = [start_consumer(ring, 0, persistence_consumer,
+                                        (collection_name, mission_name, asvid, keys, exo.get_sn(), exo.get_ssn()),
+                                        cpus=PERSISTENCE_CPUS)]
+            pin_to_cpus(ACQUISITION_CPUS)
+        else:
+            open_sinks(collection_name, asvid, codec, exo.get_sn(), exo.get_ssn(), mission_name)
+        if METRICS_PORT is not None:
+            try:
+                metrics_server = metrics.MetricsServer(METRICS_PORT)
+                print(f"Metrics on http://127.0.0.1:{metrics_server.port}/metrics")
+            except OSError as e:
+                print(f"Could not serve the metrics on port {METRICS_PORT} - {e}")
+        summary.start()
+        read_exo = exo.read_data
+        if STREAM_EXO2:
+            exo.start_stream(num_fields=len(keys))
+            read_exo = stamped_reader(exo.read_stream_row, timeout=1.0)
+        with surveyor.Surveyor(dummy=False, background=True) as s, \
+                AcquisitionPipeline(s.get_next_gps_coordinates, read_exo,
+                                    gps_interval=GPS_INTERVAL, max_skew=MAX_GPS_SKEW) as pipeline:
             print("running surveyor")
-            for i in range(1000):
+            stage_start = time.monotonic()
+            for i, (row, fix) in zip(range(1000), pipeline.pairs()):
+                loop_start = STAGES['pair_wait'].since(stage_start)
+                ROW_AGE.record(loop_start - row.monotonic)
                 try:
-                    current_coordinates = s.get_gps_coordinates()
+                    current_coordinates = fix.value
                     #print("here ", current_coordinates)
                     #current_time = s.get_timestamp()
-                    print(current_coordinates)
+                    if not ring:
+                        with STAGES['print'].time():
+                            print(current_coordinates)
                     if (current_coordinates and current_coordinates[0] != 0):
                         
-                        data = read_sensor_data(exo, current_coordinates, asvid)
+                        if ring:
+                            # Only parse here, the consumer process stores the record. Its
+                            # layout is fixed at start, so rows of a changed para list
+                            # (which the sonde reader warns about) are not parsed
+                            with STAGES['parse'].time():
+                                record = codec.parse(row.value, row.wall)
+                            if record is None:
+                                continue
+                            with STAGES['ring'].time():
+                                ring.put(sample_layout.pack(record.timestamp, current_coordinates[0],
+                                                            current_coordinates[1], record.values,
+                                                            record.sonde_date, record.sonde_time))
+                            data = record.to_document(current_coordinates[0], current_coordinates[1], {'asvid': asvid})
+                        else:
+                            with STAGES['parse'].time():
+                                data = read_sensor_data(exo, current_coordinates, asvid,
+                                                        data_string=row.value, timestamp=row.wall)
 
                         if (take_samples):
-                            for i in range(len(sample_points)):
-                                distance = geopy.distance.geodesic(sample_points[i], current_coordinates)
-                                print(f"distance to {i} is {distance}")
-                                if distance < MIN_DIST:
-                                    sample_points.remove(sample_points[i])
-                                    take_sample(current_coordinates, sampler, sample_output,data)
-                                    break
+                            with STAGES['sample'].time():
+                                # MIN_DIST is in km, the index works in meters
+                                found = sample_store.take_nearest(current_coordinates, MIN_DIST * 1000)
+                                if found:
+                                    print(f"distance to {found[0]} is {found[2]:.1f} m")
+                                    if take_sample(current_coordinates, sampler, sample_output,data) is None:
+                                        # Not sampled, keep the station for a later pass
+                                        sample_store.restore(found[0])
                                     
-                        save_data_to_db(data=data, collection_name=collection_name)
-                        save_data_to_file(file, data)
-                        print(data)
+                        if not ring:
+                            persist(data, collection_name, mission_name, asvid)
+                            with STAGES['print'].time():
+                                print(data)
                 except Exception as exception:
                     print(exception)
-                
-                time.sleep(0.2)
+                finally:
+                    stage_start = LOOP_TIME.since(loop_start)
+            print(f"GPS fixes: {pipeline.gps.count}, EXO2 rows: {pipeline.exo.count}, discarded: {pipeline.discarded}")
     except Exception as exception:
         print(exception)
     finally:
+        summary.stop()
+        print(summary.summary())
+        if metrics_server:
+            metrics_server.close()
+        if sampler.scheduler.busy():
+            print("Waiting for the pump to finish")
+            while sampler.scheduler.busy():
+                time.sleep(0.5)
         exo.close()
+        if ring:
+            ring.close_stream()
+            for process in consumers:
+                process.join()
+            print("Ring consumers: ", ring.consumer_stats())
+            ring.close()
+        close_sinks()
         client.close()
 
     # ser.close()
@@ -0,0 +1,217 @@
+import math
+import os
+
+import geodesy
+from geodesy import EARTH_RADIUS_M
+
+
+class SamplePointIndex():
+    """
+    Grid index for finding the sample point closest to the boat.
+
+    Points are projected once on a local equirectangular plane centred on
+    the mission and bucketed into square cells of cell_size meters. A query
+    only looks at the cells that can hold a point within the radius, keeps
+    the points whose projected distance is within reach, and confirms those
+    with the exact geodesic distance. Lookups and removals cost the same for
+    ten or a thousand points, and a miss costs no geodesic computation.
+
+    Parameters:
+        points: Iterable of (latitude, longitude) tuples.
+        cell_size: Side of a grid cell in meters, around the usual query radius.
+    """
+
+    def __init__(self, points, cell_size=25.0):
+        self.cell_size = cell_size
+        self._points = {}
+        self._cells = {}
+        points = list(points)
+        if points:
+            self._lat0 = sum(p[0] for p in points) / len(points)
+            self._lon0 = sum(p[1] for p in points) / len(points)
+        else:
+            self._lat0 = self._lon0 = 0.0
+        self._cos_lat0 = math.cos(math.radians(self._lat0))
+        for point_id, point in enumerate(points):
+            self._points[point_id] = (float(point[0]), float(point[1]))
+            self._cells.setdefault(self._cell(*self._project(point)), set()).add(point_id)
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, point_id):
+        return point_id in self._points
+
+    def _project(self, coord):
+        """Local x/y in meters relative to the centre of the points."""
+        x = math.radians(coord[1] - self._lon0) * self._cos_lat0 * EARTH_RADIUS_M
+        y = math.radians(coord[0] - self._lat0) * EARTH_RADIUS_M
+        return x, y
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def points(self):
+        """Remaining (point_id, (latitude, longitude)) pairs."""
+        return list(self._points.items())
+
+    def candidates(self, coord, radius_m):
+        """Ids of the points that can be within radius_m of coord, by their projected distance."""
+        x, y = self._project(coord)
+        # The projection is only approximate away from the centre, so search a bit wider
+        reach = radius_m * 1.01 + 1.0
+        cx0, cy0 = self._cell(x - reach, y - reach)
+        cx1, cy1 = self._cell(x + reach, y + reach)
+        found = []
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                cell = self._cells.get((cx, cy))
+                if cell:
+                    for point_id in cell:
+                        px, py = self._project(self._points[point_id])
+                        if math.hypot(px - x, py - y) <= reach:
+                            found.append(point_id)
+        return found
+
+    def nearest(self, coord, radius_m):
+        """
+        Find the closest point within radius_m meters of coord.
+
+        Returns:
+            (point_id, (latitude, longitude), distance in meters), or None.
+        """
+        candidates = self.candidates(coord, radius_m)
+        if not candidates:
+            return None
+        points = [self._points[point_id] for point_id in candidates]
+        distances = geodesy.vincenty(points, coord)
+        i = int(distances.argmin())
+        if distances[i] > radius_m:
+            return None
+        return candidates[i], points[i], float(distances[i])
+
+    def add(self, point_id, point):
+        """Put a point back, e.g. when its sample could not be taken."""
+        self._points[point_id] = (float(point[0]), float(point[1]))
+        self._cells.setdefault(self._cell(*self._project(point)), set()).add(point_id)
+
+    def remove(self, point_id):
+        """Remove a point, e.g. once it has been sampled."""
+        point = self._points.pop(point_id)
+        cell_key = self._cell(*self._project(point))
+        cell = self._cells[cell_key]
+        cell.discard(point_id)
+        if not cell:
+            del self._cells[cell_key]
+        return point
+
+    def pop_nearest(self, coord, radius_m):
+        """Like nearest(), but removes the point that was found."""
+        found = self.nearest(coord, radius_m)
+        if found:
+            self.remove(found[0])
+        return found
+
+
+def read_coordinates(filename):
+    """Read 'latitude,longitude' lines, skipping empty and invalid ones."""
+    coords = []
+    with open(filename, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line:  # ignore empty lines
+                parts = line.split(',')
+                if len(parts) == 2:
+                    try:
+                        lat = float(parts[0].strip())
+                        lon = float(parts[1].strip())
+                        coords.append((lat, lon))
+                    except ValueError:
+                        print(f"Skipping invalid line: {line}")
+    return coords
+
+
+class SampleCoordinateStore():
+    """
+    Sample coordinates kept in memory, with removals saved in a journal.
+
+    The coordinates file is read once. Every point that is taken is appended
+    to the journal as one 'removed,<id>,<lat>,<lon>' line, and a point put
+    back with restore() as a 'restored,...' line, each written with a single
+    append and fsynced, so the coordinates file itself is never rewritten. On start the file and the journal are read once to rebuild the
+    remaining points; a torn last journal line is ignored.
+
+    Parameters:
+        filename: Coordinates file, one 'latitude,longitude' per line.
+        journal_file: Journal path, filename + '.journal' by default.
+    """
+
+    def __init__(self, filename, journal_file=None, cell_size=25.0):
+        self.filename = filename
+        self.journal_file = journal_file or filename + '.journal'
+        self.coords = read_coordinates(filename)
+        self.index = SamplePointIndex(self.coords, cell_size)
+        for point_id in self._read_journal():
+            if point_id in self.index:
+                self.index.remove(point_id)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read_journal(self):
+        removed = []
+        try:
+            with open(self.journal_file, 'r') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return removed
+        if content and not content.endswith('\n'):
+            # Cut off a torn write so the next entry starts on its own line
+            content = content[:content.rfind('\n') + 1]
+            with open(self.journal_file, 'r+') as f:
+                f.truncate(len(content.encode('utf-8')))
+        for line in content.splitlines():
+            parts = line.strip().split(',')
+            if len(parts) == 4 and parts[0] in ('removed', 'restored'):
+                point_id = int(parts[1])
+                if 0 <= point_id < len(self.coords) and \
+                        self.coords[point_id] == (float(parts[2]), float(parts[3])):
+                    if parts[0] == 'removed':
+                        removed.append(point_id)
+                    elif point_id in removed:
+                        removed.remove(point_id)
+                else:
+                    print(f"Journal entry does not match {self.filename}: {line.strip()}")
+        return removed
+
+    def _append_journal(self, action, point_id, point):
+        fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, f"{action},{point_id},{point[0]!r},{point[1]!r}\n".encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def remaining(self):
+        """Points not taken yet, in file order."""
+        return [point for _, point in sorted(self.index.points())]
+
+    def take_nearest(self, reference, radius_m):
+        """
+        Remove and return the closest point within radius_m meters of reference.
+
+        Returns:
+            (point_id, (latitude, longitude), distance in meters), or None.
+        """
+        found = self.index.pop_nearest(reference, radius_m)
+        if found:
+            self._append_journal('removed', found[0], found[1])
+        return found
+
+    def restore(self, point_id):
+        """Put back a point taken with take_nearest, e.g. when the pump could not sample it."""
+        if point_id in self.index:
+            return
+        point = self.coords[point_id]
+        self.index.add(point_id, point)
+        self._append_journal('restored', point_id, point)
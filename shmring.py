@@ -0,0 +1,296 @@
+import datetime
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+# Layout of the shared memory block:
+#   header          magic, capacity, record size, max consumers
+#   write_seq       sequence number of the last record written
+#   closed          set to 1 when the producer is done
+#   consumer table  per consumer: next sequence number to read, records dropped, state
+#   slots           per slot: sequence number of the record it holds, then the record
+# Sequence numbers start at 1, a slot whose sequence number is WRITING is being overwritten.
+MAGIC = b'SHMRING1'
+HEADER = struct.Struct('<8sIII4x')
+COUNTER = struct.Struct('<Q')
+CONSUMER = struct.Struct('<QQQ')
+WRITE_SEQ_OFFSET = HEADER.size
+CLOSED_OFFSET = WRITE_SEQ_OFFSET + COUNTER.size
+CONSUMERS_OFFSET = CLOSED_OFFSET + COUNTER.size
+WRITING = 2 ** 64 - 1
+# Consumer table states
+UNUSED = 0
+ATTACHED = 1
+DETACHED = 2
+
+
+class ShmRing():
+    """
+    Single-producer, multi-consumer ring buffer of fixed-size records in shared memory.
+
+    The producer never waits: when a consumer falls more than capacity records
+    behind, the records it missed are overwritten and counted as dropped for
+    that consumer. Every consumer reads every record (fan-out) and keeps its
+    position and drop count in the consumer table, so the producer side can
+    report them.
+
+    Use ShmRing.create() in the producer and ShmRing.attach() in the consumers.
+    """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.buf = shm.buf
+        magic, self.capacity, self.record_size, self.max_consumers = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{shm.name} is not a ring buffer")
+        self.slot_size = COUNTER.size + self.record_size + (-self.record_size % 8)
+        self.slots_offset = CONSUMERS_OFFSET + self.max_consumers * CONSUMER.size
+        self.name = shm.name
+        self._write_seq = COUNTER.unpack_from(self.buf, WRITE_SEQ_OFFSET)[0]
+
+    @classmethod
+    def create(cls, record_size, capacity=1024, max_consumers=4, name=None):
+        slot_size = COUNTER.size + record_size + (-record_size % 8)
+        size = CONSUMERS_OFFSET + max_consumers * CONSUMER.size + capacity * slot_size
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:size] = bytes(size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, capacity, record_size, max_consumers)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        # Consumers started with start_consumer() share the producer's resource
+        # tracker, so attaching does not make them responsible for the block
+        return cls(shm=shared_memory.SharedMemory(name=name), owner=False)
+
+    def _slot_offset(self, seq):
+        return self.slots_offset + (seq % self.capacity) * self.slot_size
+
+    def put(self, record):
+        """Write one record (bytes of at most record_size). Never blocks."""
+        if len(record) > self.record_size:
+            raise ValueError(f"Record of {len(record)} bytes, the ring holds {self.record_size}")
+        seq = self._write_seq + 1
+        offset = self._slot_offset(seq)
+        COUNTER.pack_into(self.buf, offset, WRITING)
+        self.buf[offset + COUNTER.size:offset + COUNTER.size + len(record)] = record
+        COUNTER.pack_into(self.buf, offset, seq)
+        COUNTER.pack_into(self.buf, WRITE_SEQ_OFFSET, seq)
+        self._write_seq = seq
+        return seq
+
+    def write_seq(self):
+        return COUNTER.unpack_from(self.buf, WRITE_SEQ_OFFSET)[0]
+
+    def close_stream(self):
+        """Tell the consumers that no more records will come."""
+        COUNTER.pack_into(self.buf, CLOSED_OFFSET, 1)
+
+    def is_closed(self):
+        return COUNTER.unpack_from(self.buf, CLOSED_OFFSET)[0] == 1
+
+    def consumer_stats(self):
+        """Per consumer: {'lag': records not read yet, 'dropped': records lost to overruns, 'attached': bool}."""
+        write_seq = self.write_seq()
+        stats = {}
+        for consumer_id in range(self.max_consumers):
+            next_seq, dropped, state = CONSUMER.unpack_from(self.buf, CONSUMERS_OFFSET + consumer_id * CONSUMER.size)
+            if state != UNUSED:
+                stats[consumer_id] = {'lag': max(0, write_seq + 1 - next_seq), 'dropped': dropped,
+                                      'attached': state == ATTACHED}
+        return stats
+
+    def close(self):
+        """Detach, and free the block if this is the producer."""
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingConsumer():
+    """
+    Reader of a ShmRing.
+
+    Parameters:
+        ring: Attached ShmRing.
+        consumer_id: Slot in the consumer table, unique per consumer (0 .. max_consumers - 1).
+        from_start: Read the records still in the ring, otherwise start with the next record.
+        poll_interval: Seconds between checks for new records when the ring is empty.
+    """
+
+    def __init__(self, ring, consumer_id, from_start=True, poll_interval=0.01):
+        if not 0 <= consumer_id < ring.max_consumers:
+            raise ValueError(f"consumer_id must be below {ring.max_consumers}")
+        self.ring = ring
+        self.consumer_id = consumer_id
+        self.poll_interval = poll_interval
+        self._offset = CONSUMERS_OFFSET + consumer_id * CONSUMER.size
+        write_seq = ring.write_seq()
+        self.next_seq = max(1, write_seq + 1 - ring.capacity) if from_start else write_seq + 1
+        self.dropped = 0
+        self._publish()
+
+    def _publish(self, state=ATTACHED):
+        CONSUMER.pack_into(self.ring.buf, self._offset, self.next_seq, self.dropped, state)
+
+    def _read_one(self):
+        """Next record, or None if there is none yet. Skips over records lost to an overrun."""
+        ring = self.ring
+        while True:
+            write_seq = ring.write_seq()
+            if self.next_seq > write_seq:
+                return None
+            if write_seq - self.next_seq >= ring.capacity:
+                # Overrun: the producer has already reused the slots we had not read
+                skip_to = write_seq - ring.capacity + 1
+                self.dropped += skip_to - self.next_seq
+                self.next_seq = skip_to
+            offset = ring._slot_offset(self.next_seq)
+            seq = COUNTER.unpack_from(ring.buf, offset)[0]
+            record = bytes(ring.buf[offset + COUNTER.size:offset + COUNTER.size + ring.record_size])
+            # The slot must still hold our record after the copy, else it was overwritten meanwhile
+            if seq == self.next_seq and COUNTER.unpack_from(ring.buf, offset)[0] == seq:
+                self.next_seq += 1
+                return record
+            self.dropped += 1
+            self.next_seq += 1
+
+    def get(self, timeout=None):
+        """
+        Wait for the next record.
+
+        Returns:
+            bytes of record_size, or None on timeout or when the producer closed the ring and it is drained.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            record = self._read_one()
+            if record is not None:
+                self._publish()
+                return record
+            if self.ring.is_closed() and self.next_seq > self.ring.write_seq():
+                return None
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def get_batch(self, max_records=100, timeout=None):
+        """Wait for at least one record and return up to max_records of them."""
+        first = self.get(timeout)
+        if first is None:
+            return []
+        records = [first]
+        while len(records) < max_records:
+            record = self._read_one()
+            if record is None:
+                break
+            records.append(record)
+        self._publish()
+        return records
+
+    def close(self):
+        self._publish(DETACHED)
+
+
+class SampleRecord():
+    """
+    Fixed-size binary form of a paired EXO2 row and GPS fix.
+
+    Parameters:
+        value_keys: Parameter codes of the values, e.g. Exo2Codec.value_keys.
+    """
+
+    def __init__(self, value_keys):
+        self.value_keys = list(value_keys)
+        # host time (epoch microseconds), latitude, longitude, the sonde's date
+        # (ordinal, 0 if unknown) and time (seconds since midnight, -1 if unknown),
+        # then the values
+        self.struct = struct.Struct('<qddii' + 'd' * len(self.value_keys))
+        self.size = self.struct.size
+
+    def pack(self, timestamp, latitude, longitude, values, sonde_date=None, sonde_time=None):
+        date = sonde_date.toordinal() if sonde_date is not None else 0
+        seconds = sonde_time.hour * 3600 + sonde_time.minute * 60 + sonde_time.second if sonde_time is not None else -1
+        return self.struct.pack(int(timestamp.timestamp() * 1e6), latitude, longitude, date, seconds, *values)
+
+    def unpack(self, record):
+        """Returns (timestamp, latitude, longitude, values as a tuple, sonde_date, sonde_time)."""
+        fields = self.struct.unpack_from(record)
+        timestamp = datetime.datetime.fromtimestamp(fields[0] / 1e6)
+        sonde_date = datetime.date.fromordinal(fields[3]) if fields[3] > 0 else None
+        sonde_time = None
+        if fields[4] >= 0:
+            sonde_time = datetime.time(fields[4] // 3600, fields[4] // 60 % 60, fields[4] % 60)
+        return timestamp, fields[1], fields[2], fields[5:], sonde_date, sonde_time
+
+
+def pin_to_cpus(cpus):
+    """Restrict the calling process to the given CPUs, where the OS supports it."""
+    if hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, set(cpus))
+        except OSError as e:
+            print(f"Could not pin to CPUs {cpus} - {e}")
+
+
+def _consumer_main(ring_name, consumer_id, target, args, cpus):
+    if cpus:
+        pin_to_cpus(cpus)
+    ring = ShmRing.attach(ring_name)
+    consumer = RingConsumer(ring, consumer_id)
+    try:
+        target(consumer, *args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        consumer.close()
+        ring.close()
+
+
+def start_consumer(ring, consumer_id, target, args=(), cpus=None):
+    """
+    Run target(consumer, *args) in a new process reading from ring.
+
+    target should loop on consumer.get()/get_batch() until they return
+    nothing because the ring was closed with ring.close_stream().
+    """
+    process = multiprocessing.Process(target=_consumer_main, args=(ring.name, consumer_id, target, args, cpus),
+                                      name=f'ring-consumer-{consumer_id}', daemon=True)
+    process.start()
+    return process
+
+
+if __name__ == "__main__":
+    # Throughput check: one producer, two consumers, one of them too slow to keep up
+    def count_records(consumer, delay):
+        count = 0
+        while True:
+            batch = consumer.get_batch(100, timeout=1.0)
+            if not batch:
+                if consumer.ring.is_closed():
+                    break
+                continue
+            count += len(batch)
+            time.sleep(delay)
+        print(f"consumer {consumer.consumer_id}: read {count}, dropped {consumer.dropped}")
+
+    layout = SampleRecord([str(code) for code in range(10)])
+    ring = ShmRing.create(layout.size, capacity=256)
+    consumers = [start_consumer(ring, 0, count_records, (0.0,)), start_consumer(ring, 1, count_records, (0.05,))]
+    time.sleep(0.5)
+    now = datetime.datetime.now()
+    n = 100000
+    start = time.perf_counter()
+    for i in range(n):
+        ring.put(layout.pack(now, 25.0, -80.0, [float(i)] * 10))
+    elapsed = time.perf_counter() - start
+    print(f"{n} records in {elapsed:.3f} s, {elapsed / n * 1e6:.2f} us per put")
+    ring.close_stream()
+    for process in consumers:
+        process.join()
+    print(ring.consumer_stats())
+    ring.close()
@@ -0,0 +1,344 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import bson
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from dbwriter import DUPLICATE_KEY_ERROR
+
+# Every record is framed as: payload length, crc32 of the payload, sequence number
+FRAME_HEADER = struct.Struct('<IIQ')
+SEGMENT_SUFFIX = '.seg'
+ACK_FILE = 'ack'
+ID_FILE = 'id'
+
+
+def record_id(name, seq, spool_id=''):
+    """
+    Deterministic document _id for the record number seq of a spool.
+
+    spool_id (Spool.spool_id) tells apart spools that reuse a name, e.g. a
+    mission name used again after the spool directory was cleared.
+    """
+    key = f"{spool_id}:{name}:{seq}" if spool_id else f"{name}:{seq}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+
+
+class Spool():
+    """
+    Append-only on-disk record spool.
+
+    Records are BSON encoded and appended to segment files named after the
+    sequence number of their first record. Each frame carries a crc32, so a
+    torn write at the end of the last segment is detected and cut off when the
+    spool is reopened. The highest uploaded sequence number is kept in the ack
+    file; segments that are fully acknowledged are deleted. A random spool_id
+    is created with the spool and kept in the id file, so the document ids of
+    a new spool never collide with those of an old one of the same name.
+    read() remembers where it stopped in each segment and resumes there.
+
+    Parameters:
+        directory: Folder holding the segments (created if missing).
+        name: Stream name, used for the deterministic document ids.
+        segment_bytes: Size after which a new segment is started.
+        fsync_interval: Seconds between fsyncs of the active segment, 0 to fsync every record.
+    """
+
+    def __init__(self, directory, name, segment_bytes=4 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.name = name
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._last_fsync = time.monotonic()
+        self._positions = {}
+        os.makedirs(directory, exist_ok=True)
+        self.spool_id = self._read_id()
+
+        self.acked_seq = self._read_ack()
+        self.next_seq = self.acked_seq + 1
+        self._file = None
+        segments = self.segments()
+        if segments:
+            last_start = segments[-1]
+            end_seq, valid_bytes = self._scan_segment(last_start)
+            path = self._segment_path(last_start)
+            if valid_bytes < os.path.getsize(path):
+                print(f"Truncating torn record at the end of {path}")
+                with open(path, 'r+b') as f:
+                    f.truncate(valid_bytes)
+            self.next_seq = max(self.next_seq, end_seq)
+            self._file = open(path, 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _segment_path(self, start_seq):
+        return os.path.join(self.directory, f"{start_seq:020d}{SEGMENT_SUFFIX}")
+
+    def _read_ack(self):
+        try:
+            with open(os.path.join(self.directory, ACK_FILE), 'r') as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return -1
+
+    def _read_id(self):
+        path = os.path.join(self.directory, ID_FILE)
+        try:
+            with open(path, 'r') as f:
+                spool_id = f.read().strip()
+            if spool_id:
+                return spool_id
+        except OSError:
+            pass
+        spool_id = os.urandom(8).hex()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(spool_id)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return spool_id
+
+    def record_id(self, seq):
+        """Document _id of the record number seq of this spool."""
+        return record_id(self.name, seq, self.spool_id)
+
+    def _write_ack(self, seq):
+        path = os.path.join(self.directory, ACK_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def segments(self):
+        """Start sequence numbers of the segments on disk, oldest first."""
+        return sorted(int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(self.directory)
+                      if f.endswith(SEGMENT_SUFFIX))
+
+    def _iter_frames(self, f):
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            length, crc, seq = FRAME_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            yield seq, payload, f.tell()
+
+    def _scan_segment(self, start_seq):
+        """Return the sequence number after the last valid record and the valid size in bytes."""
+        end_seq = start_seq
+        valid_bytes = 0
+        with open(self._segment_path(start_seq), 'rb') as f:
+            for seq, _, offset in self._iter_frames(f):
+                end_seq = seq + 1
+                valid_bytes = offset
+        return end_seq, valid_bytes
+
+    def append(self, record):
+        """Append a record (dict) and return its sequence number."""
+        payload = bson.encode(record)
+        with self._lock:
+            seq = self.next_seq
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(self._segment_path(seq), 'ab')
+            self._file.write(FRAME_HEADER.pack(len(payload), zlib.crc32(payload), seq) + payload)
+            self._file.flush()
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+            self.next_seq = seq + 1
+        return seq
+
+    def read(self, after_seq, limit=100):
+        """Return up to limit (seq, record) pairs with a sequence number above after_seq."""
+        with self._lock:
+            segments = self.segments()
+        records = []
+        for i, start in enumerate(segments):
+            next_start = segments[i + 1] if i + 1 < len(segments) else None
+            if next_start is not None and next_start <= after_seq + 1:
+                continue
+            # Frames before a remembered position all have a sequence number up to its seq
+            with self._lock:
+                position = self._positions.get(start)
+            offset = position[1] if position and position[0] <= after_seq else 0
+            last = None
+            try:
+                with open(self._segment_path(start), 'rb') as f:
+                    f.seek(offset)
+                    for seq, payload, end in self._iter_frames(f):
+                        last = (seq, end)
+                        if seq <= after_seq:
+                            continue
+                        records.append((seq, bson.decode(payload)))
+                        if len(records) >= limit:
+                            break
+            except FileNotFoundError:
+                # Segment was acknowledged and removed while we were reading
+                continue
+            if last is not None:
+                with self._lock:
+                    self._positions[start] = last
+            if len(records) >= limit:
+                return records
+        return records
+
+    def pending(self):
+        """Number of records not yet acknowledged."""
+        return self.next_seq - self.acked_seq - 1
+
+    def ack(self, seq):
+        """Mark every record up to seq as uploaded and delete segments that are no longer needed."""
+        with self._lock:
+            if seq <= self.acked_seq:
+                return
+            self._write_ack(seq)
+            self.acked_seq = seq
+            segments = self.segments()
+            for i, start in enumerate(segments[:-1]):
+                # A segment ends right before the next one starts
+                if segments[i + 1] - 1 <= seq:
+                    os.remove(self._segment_path(start))
+            segments = set(self.segments())
+            self._positions = {start: position for start, position in self._positions.items() if start in segments}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+
+class SpoolUploader():
+    """
+    Background thread that uploads spooled records to a MongoDB collection.
+
+    Records are sent with insert_many using record_id() as the _id, so a
+    batch that is sent again after a crash or a lost connection only produces
+    duplicate key errors, which are ignored. A batch that fails for another
+    reason is retried record by record; records that still fail are appended
+    to rejected_file (in the spool directory by default) and acknowledged, so
+    one bad record does not hold up the spool.
+    """
+
+    def __init__(self, spool, collection, batch_size=100, poll_interval=1.0, retry_interval=5.0,
+                 rejected_file=None):
+        self.spool = spool
+        self.collection = collection
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.rejected_file = rejected_file or os.path.join(spool.directory, 'rejected.jsonl')
+        self.uploaded = 0
+        self.rejected = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='spool-uploader', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def upload_pending(self):
+        """Upload one batch; returns the number of records acknowledged."""
+        batch = self.spool.read(self.spool.acked_seq, self.batch_size)
+        if not batch:
+            return 0
+        documents = []
+        for seq, record in batch:
+            record['_id'] = self.spool.record_id(seq)
+            documents.append(record)
+        try:
+            self._insert(documents)
+        except PyMongoError:
+            raise
+        except Exception as e:
+            print(f"Spool upload failed, retrying record by record - {e!r}")
+            for document in documents:
+                try:
+                    self._insert([document])
+                except PyMongoError:
+                    raise
+                except Exception as e:
+                    self._reject(document, e)
+        self.spool.ack(batch[-1][0])
+        self.uploaded += len(batch)
+        return len(batch)
+
+    def _insert(self, documents):
+        try:
+            self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(err.get('code') != DUPLICATE_KEY_ERROR for err in errors):
+                raise
+
+    def _reject(self, document, error):
+        print(f"Rejected spooled record {document['_id']} written to {self.rejected_file} - {error!r}")
+        with open(self.rejected_file, 'a') as f:
+            f.write(json.dumps(document, default=str) + "\n")
+        self.rejected += 1
+
+    def _run(self):
+        while True:
+            try:
+                count = self.upload_pending()
+            except Exception as e:
+                # Anything but a connection problem has already been retried
+                # record by record, so this keeps the thread alive (e.g. a full disk)
+                self.errors += 1
+                print(f"Spool upload failed, {self.spool.pending()} records waiting - {e!r}")
+                if self._stop.wait(self.retry_interval):
+                    return
+                continue
+            if count == 0 and self._stop.wait(self.poll_interval):
+                return
+
+    def close(self, timeout=None):
+        """Stop the uploader after a last attempt to drain the spool."""
+        self._stop.set()
+        self._thread.join(timeout)
+
+
+if __name__ == "__main__":
+    # Upload what is left in a spool, e.g. after a mission ended offline:
+    # python spool.py [spool_dir] [collection_name]
+    import sys
+
+    import certifi
+    from pymongo import MongoClient
+
+    if len(sys.argv) < 3:
+        print("python spool.py [spool_dir] [collection_name]")
+        sys.exit(1)
+    spool_dir = sys.argv[1].rstrip('/')
+    client = MongoClient(os.environ['COSMODB_STRING'], tlsCAFile=certifi.where())
+    with Spool(spool_dir, os.path.basename(spool_dir)) as s:
+        uploader = SpoolUploader(s, client.missions[sys.argv[2]])
+        while s.pending() > 0 and uploader.upload_pending():
+            pass
+        uploader.close()
+        print(f"Uploaded {uploader.uploaded} records, {s.pending()} left")
+    client.close()
@@ -1,16 +1,89 @@
 import socket
 import sys
+import threading
 import time
 
 import helper as hlp
+import metrics
+
+NMEA_SENTENCES = metrics.counter('nmea_sentences_total', 'NMEA sentences decoded from the Surveyor')
+NMEA_DROPPED = metrics.counter('nmea_dropped_total', 'NMEA sentences dropped for a bad checksum or format')
+SEND_TIME = metrics.histogram('surveyor_send_seconds', 'Time to send one command to the Surveyor')
+TIMEOUTS = metrics.counter('surveyor_timeouts_total', 'Surveyor reads and waits that timed out')
+ERRORS = metrics.counter('surveyor_errors_total', 'Surveyor socket errors')
+
+
+class NmeaStreamReader(threading.Thread):
+    """
+    Thread that reads the Surveyor socket and hands over decoded NMEA messages.
+
+    Received bytes go through a helper.NmeaDecoder, which keeps incomplete
+    sentences until the rest arrives, so sentences split across recv() calls
+    are not lost. Sentences with a bad checksum are counted in dropped.
+
+    Parameters:
+        sock: Connected socket, owned by the reader while it runs.
+        on_message: Function called with each decoded message.
+    """
+
+    def __init__(self, sock, on_message, bufsize=4096):
+        super().__init__(name='nmea-reader', daemon=True)
+        self.sock = sock
+        self.on_message = on_message
+        self.bufsize = bufsize
+        self.decoder = hlp.NmeaDecoder()
+        self._stop_event = threading.Event()
+
+    @property
+    def sentences(self):
+        return self.decoder.sentences
+
+    @property
+    def dropped(self):
+        return self.decoder.dropped
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                data = self.sock.recv(self.bufsize)
+            except socket.timeout:
+                continue
+            except (socket.error, ValueError) as e:
+                if not self._stop_event.is_set():
+                    ERRORS.inc()
+                    print(f"Error receiving data - {e}")
+                return
+            if not data:
+                print("Connection closed by the server.")
+                return
+            self.feed(data)
+
+    def feed(self, data):
+        dropped = self.decoder.dropped
+        messages = self.decoder.feed(data)
+        if messages:
+            NMEA_SENTENCES.inc(len(messages))
+        if self.decoder.dropped != dropped:
+            NMEA_DROPPED.inc(self.decoder.dropped - dropped)
+        for message in messages:
+            self.on_message(message)
+
+    def stop(self):
+        self._stop_event.set()
 
 
 class Surveyor:
 
-    def __init__(self, host='192.168.0.50', port=8003, dummy=False):
+    def __init__(self, host='192.168.0.50', port=8003, dummy=False, background=False):
         self.host = host
         self.port = port
         self.is_dummy = dummy
+        self.background = background
+        self._reader = None
+        # Latest decoded state: key -> (time.monotonic() of arrival, value)
+        self._cache = {}
+        self._cache_cond = threading.Condition()
+        self._last_fix_time = None
 
     def __enter__(self):
         if self.is_dummy:
@@ -20,11 +93,22 @@ class Surveyor:
             self.socket.connect((self.host, self.port))
             self.socket.settimeout(5)  # Set a timeout for the connection
         except socket.error as e:
+            ERRORS.inc()
             print(f"Error connecting to {self.host}:{self.port} - {e}")
+            return self
+        if self.background:
+            self._reader = NmeaStreamReader(self.socket, self._update_cache)
+            self._reader.start()
         return self
 
     def __exit__(self, *args):
+        if self.is_dummy:
+            return
+        if self._reader:
+            self._reader.stop()
         self.socket.close()
+        if self._reader:
+            self._reader.join(1)
 
     def send(self, msg):
         msg = hlp.create_nmea_message(msg)
@@ -32,9 +116,11 @@ class Surveyor:
             print('sending ', msg)
             return 
         try:
-            self.socket.send(msg.encode())
+            with SEND_TIME.time():
+                self.socket.send(msg.encode())
             time.sleep(0.001)
         except socket.error as e:
+            ERRORS.inc()
             print(f"Error sending message - {e}")
 
     def receive(self, bytes=1024):
@@ -47,10 +133,62 @@ class Surveyor:
                 print("Connection closed by the server.")
             return data.decode('utf-8')
         except socket.timeout:
+            TIMEOUTS.inc()
             print("Socket timeout.")
         except socket.error as e:
+            ERRORS.inc()
             print(f"Error receiving data - {e}")
 
+    def _update_cache(self, message):
+        """Store a decoded message from the reader thread."""
+        now = time.monotonic()
+        updates = {'$' + message.address: message}
+        if isinstance(message, hlp.GgaMessage):
+            updates['coordinates'] = (message.latitude, message.longitude)
+            if message.timestamp:
+                updates['timestamp'] = message.timestamp
+        elif isinstance(message, hlp.AttitudeMessage):
+            if message.heading is not None:
+                updates['heading'] = message.heading
+        elif isinstance(message, hlp.ControlModeMessage):
+            updates['control_mode'] = message.control_mode
+        with self._cache_cond:
+            for key, value in updates.items():
+                self._cache[key] = (now, value)
+            self._cache_cond.notify_all()
+
+    def get_latest(self, key, newer_than=None, timeout=None):
+        """
+        Get the latest cached value for key from the background reader.
+
+        Parameters:
+            key: 'coordinates', 'timestamp', 'heading', 'control_mode' or a sentence
+                 prefix such as '$PSEAB' for the last decoded message of that type.
+            newer_than: time.monotonic() value the update must be newer than, None for any update.
+            timeout: Seconds to wait for a matching update, None to wait forever.
+
+        Returns:
+            (monotonic arrival time, value), or None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cache_cond:
+            while True:
+                entry = self._cache.get(key)
+                if entry and (newer_than is None or entry[0] > newer_than):
+                    return entry
+                if self._reader is None or not self._reader.is_alive():
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    TIMEOUTS.inc()
+                    return None
+                # Wake up now and then to notice a reader that died
+                self._cache_cond.wait(1.0 if remaining is None else min(remaining, 1.0))
+
+    def _get_cached(self, key, newer_than, timeout):
+        entry = self.get_latest(key, newer_than, timeout)
+        return entry[1] if entry else None
+
     def set_standby_mode(self):
         msg = "PSEAC,L,0,0,0,"
         self.send(msg)
@@ -106,34 +244,40 @@ class Surveyor:
         for cmd in commands:
             self.send(cmd)
 
-    def get_control_mode_data(self):
+    def get_control_mode_data(self, newer_than=None, timeout=None):
         """
         Get control mode data from the Surveyor connection object.
 
         Parameters:
-            s: The Surveyor connection object.
+            newer_than: With the background reader, only accept an update newer than this time.monotonic() value.
+            timeout: With the background reader, seconds to wait before returning None.
 
         Returns:
             Control mode string.
         """
+        if self._reader:
+            return self._get_cached('control_mode', newer_than, timeout)
         control_mode = None
         while not control_mode:
             control_mode = hlp.get_control_mode(self.receive())
 
         return control_mode
 
-    def get_timestamp(self):
+    def get_timestamp(self, newer_than=None, timeout=None):
         """
         Get timestamp from the Surveyor connection object.
 
         Parameters:
-            s: The Surveyor connection object.
+            newer_than: With the background reader, only accept an update newer than this time.monotonic() value.
+            timeout: With the background reader, seconds to wait before returning None.
 
         Returns:
             timestamp.
         """
         if (self.is_dummy):
             return time.time()
+        if self._reader:
+            return self._get_cached('timestamp', newer_than, timeout)
         timestamp = None
         gga_message = None
         while (timestamp == None) or (gga_message == None):
@@ -141,18 +285,21 @@ class Surveyor:
             timestamp = hlp.get_timestamp(gga_message)
 
         return timestamp
-    def get_gps_coordinates(self):
+    def get_gps_coordinates(self, newer_than=None, timeout=None):
         """
         Get GPS coordinates from the Surveyor connection object.
 
         Parameters:
-            s: The Surveyor connection object.
+            newer_than: With the background reader, only accept a fix newer than this time.monotonic() value.
+            timeout: With the background reader, seconds to wait before returning None.
 
         Returns:
             Tuple containing GPS coordinates.
         """
         if (self.is_dummy):
             return [0,0]
+        if self._reader:
+            return self._get_cached('coordinates', newer_than, timeout)
         coordinates = None
         gga_message = None
         while (coordinates == None) or (gga_message == None):
@@ -161,16 +308,31 @@ class Surveyor:
 
         return coordinates
 
-    def get_attitude(self):
+    def get_next_gps_coordinates(self, timeout=1.0):
+        """
+        Wait for the first GPS fix newer than the one this method returned last.
+
+        Needs the background reader. Returns None if no new fix arrives within timeout seconds.
+        """
+        entry = self.get_latest('coordinates', self._last_fix_time, timeout)
+        if entry is None:
+            return None
+        self._last_fix_time = entry[0]
+        return entry[1]
+
+    def get_attitude(self, newer_than=None, timeout=None):
         """
         Get Attitude information from the Surveyor connection object.
 
         Parameters:
-            s: The Surveyor connection object.
+            newer_than: With the background reader, only accept an update newer than this time.monotonic() value.
+            timeout: With the background reader, seconds to wait before returning None.
 
         Returns:
             Tuple containing heading.
         """
+        if self._reader:
+            return self._get_cached('heading', newer_than, timeout)
         heading = None
         attitude_message = None
         while (heading == None) or (attitude_message == None):
@@ -0,0 +1,77 @@
+"""
+geodesy.py against geopy, around the survey area and worldwide.
+
+pip install -r requirements-dev.txt
+python -m pytest test_geodesy.py
+"""
+import geopy.distance as geopy_distance
+import numpy as np
+import pytest
+
+import geodesy
+
+VINCENTY_TOLERANCE_M = 1e-4
+HAVERSINE_TOLERANCE_M = 1e-6
+DESTINATION_TOLERANCE_DEG = 1e-10
+
+
+def _points(area, count=300, seed=0):
+    rng = np.random.default_rng(seed)
+    if area == 'local':
+        return np.column_stack([25.91 + rng.uniform(-0.05, 0.05, count), -80.13 + rng.uniform(-0.05, 0.05, count)])
+    return np.column_stack([rng.uniform(-80, 80, count), rng.uniform(-180, 180, count)])
+
+
+@pytest.fixture(params=['local', 'world'])
+def points(request):
+    return _points(request.param)
+
+
+def test_vincenty_matches_geodesic(points):
+    other = np.roll(points, 1, axis=0)
+    expected = np.array([geopy_distance.geodesic(p, q).meters for p, q in zip(points, other)])
+    assert np.max(np.abs(geodesy.vincenty(points, other) - expected)) < VINCENTY_TOLERANCE_M
+
+
+def test_haversine_matches_great_circle(points):
+    other = np.roll(points, 1, axis=0)
+    expected = np.array([geopy_distance.great_circle(p, q).meters for p, q in zip(points, other)])
+    assert np.max(np.abs(geodesy.haversine(points, other) - expected)) < HAVERSINE_TOLERANCE_M
+
+
+def test_single_pair_returns_scalar():
+    a, b = (25.912642, -80.13755), (25.913, -80.138)
+    assert geodesy.vincenty(a, b) == pytest.approx(geopy_distance.geodesic(a, b).meters, abs=VINCENTY_TOLERANCE_M)
+    assert geodesy.vincenty(a, a) == 0
+
+
+def test_destination_matches_geodesic(points):
+    rng = np.random.default_rng(1)
+    bearings = rng.uniform(0, 360, len(points))
+    distances = rng.uniform(1, 20000, len(points))
+    expected = np.array([(d.latitude, d.longitude) for d in
+                         (geopy_distance.geodesic(meters=m).destination(tuple(p), bearing=b)
+                          for p, m, b in zip(points, distances, bearings))])
+    moved = geodesy.destination(points, distances, bearings)
+    assert np.max(np.abs(moved - expected)) < DESTINATION_TOLERANCE_DEG
+
+
+def test_destination_round_trip():
+    start = (25.912642, -80.13755)
+    bearing = 37.0
+    end = geodesy.destination(start, 1234.5, bearing)
+    assert geodesy.vincenty(start, end) == pytest.approx(1234.5, abs=VINCENTY_TOLERANCE_M)
+    # initial_bearing and destination_sphere are both great-circle
+    end = geodesy.destination_sphere(start, 1234.5, bearing)
+    assert geodesy.initial_bearing(start, end) == pytest.approx(bearing, abs=1e-6)
+    assert geodesy.haversine(start, end) == pytest.approx(1234.5, abs=HAVERSINE_TOLERANCE_M)
+
+
+def test_distance_matrix():
+    points = _points('local', count=20)
+    matrix = geodesy.distance_matrix(points, points)
+    assert matrix.shape == (20, 20)
+    assert np.allclose(np.diag(matrix), 0)
+    assert np.allclose(matrix, matrix.T)
+    assert matrix[3, 7] == pytest.approx(geopy_distance.geodesic(points[3], points[7]).meters,
+                                         abs=VINCENTY_TOLERANCE_M)
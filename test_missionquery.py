@@ -0,0 +1,124 @@
+"""
+MissionQuery against a mongomock collection.
+
+pip install -r requirements-dev.txt
+python -m pytest test_missionquery.py
+
+mongomock does not run $geoWithin or pipeline updates, so the geospatial
+queries are only checked up to the filter they send.
+"""
+import datetime
+
+import mongomock
+import numpy as np
+import pytest
+from pymongo.errors import OperationFailure
+
+from missionquery import MissionQuery
+from tsstore import TimeSeriesStore
+
+START = datetime.datetime(2026, 1, 1, 12, 0, 0)
+
+
+def _document(i, **exodata):
+    return {'timestamp': START + datetime.timedelta(seconds=i), 'latitude': 25.9 + i * 1e-4, 'longitude': -80.1,
+            'exodata': exodata or {'1': 20.0 + i, '5': 38.0}}
+
+
+@pytest.fixture
+def store():
+    return TimeSeriesStore(mongomock.MongoClient().missions, create=False)
+
+
+@pytest.fixture
+def query(store):
+    for i in range(10):
+        store.insert(_document(i), 'm1', 1)
+        store.insert(_document(i + 0.5), 'm1', 2)
+    store.insert(_document(100), 'm2', 1)
+    return MissionQuery(store.readings, batch_size=3)
+
+
+def test_find_returns_sorted_columns(query):
+    columns = query.find(mission='m1', asvid=1)
+    assert list(columns) == ['timestamp', 'asvid', 'latitude', 'longitude', '1', '5']
+    assert columns['timestamp'].dtype == np.dtype('datetime64[us]')
+    assert len(columns['timestamp']) == 10
+    assert np.all(np.diff(columns['timestamp']) > np.timedelta64(0))
+    assert columns['1'].tolist() == [20.0 + i for i in range(10)]
+    assert set(columns['asvid']) == {1}
+
+
+def test_find_time_window_and_params(query):
+    columns = query.find(START + datetime.timedelta(seconds=2), START + datetime.timedelta(seconds=4),
+                         mission='m1', params=[5])
+    assert list(columns) == ['timestamp', 'asvid', 'latitude', 'longitude', '5']
+    # Vessel 2 reads half a second after vessel 1, so its 4.5 s reading is outside
+    assert columns['asvid'].tolist() == [1, 2, 1, 2, 1]
+    assert columns['5'].tolist() == [38.0] * 5
+
+
+def test_parameter_series(query):
+    timestamps, values = query.parameter_series(1, mission='m1', asvid=2)
+    assert len(timestamps) == len(values) == 10
+    assert values[0] == 20.5
+
+
+def test_latest_per_asv(query):
+    columns = query.latest_per_asv(mission='m1')
+    assert columns['asvid'].tolist() == [1, 2]
+    assert columns['1'].tolist() == [29.0, 29.5]
+
+
+def test_string_and_missing_values(store):
+    store.insert(_document(0, **{'1': '21.5'}), 'm1', 1)
+    store.insert(_document(1, **{'1': 22.0, '211': 99.0}), 'm1', 1)
+    store.insert(_document(2, **{'1': 'n/a'}), 'm1', 1)
+    columns = MissionQuery(store.readings).find(mission='m1')
+    assert columns['1'][:2].tolist() == [21.5, 22.0]
+    assert np.isnan(columns['1'][2])
+    # A parameter that shows up mid-stream is NaN before it
+    assert np.isnan(columns['211'][0]) and columns['211'][1] == 99.0
+
+
+def test_legacy_collection():
+    collection = mongomock.MongoClient().missions['mission-1']
+    collection.insert_many([dict(_document(i), metadata={'asvid': 3}) for i in range(4)])
+    columns = MissionQuery(collection, asv_field='metadata.asvid', mission_field=None).find(asvid=3)
+    assert len(columns['timestamp']) == 4
+    with pytest.raises(ValueError):
+        MissionQuery(collection, mission_field=None).find(mission='m1')
+
+
+def test_to_dataframe(query):
+    frame = query.to_dataframe(query.find(mission='m2'))
+    assert frame.index.name == 'timestamp'
+    assert len(frame) == 1
+
+
+def test_geometry_filters(query):
+    sent = []
+    query.find = lambda start=None, end=None, **options: sent.append(query._filter(start, end, **options))
+    query.within_radius((25.9, -80.1), 500, mission='m1')
+    query.within_polygon([(25.0, -80.0), (26.0, -80.0), (26.0, -81.0)])
+    radius, polygon = (filter['location']['$geoWithin'] for filter in sent)
+    assert radius['$centerSphere'][0] == [-80.1, 25.9]
+    assert radius['$centerSphere'][1] == pytest.approx(500 / 6371009.0)
+    assert sent[0]['meta.mission'] == 'm1'
+    ring = polygon['$geometry']['coordinates'][0]
+    assert ring[0] == ring[-1] == [-80.0, 25.0]
+
+
+def test_ensure_indexes(query):
+    query.ensure_indexes(backfill=False)
+    keys = [index['key'] for index in query.collection.index_information().values()]
+    assert [('location', '2dsphere')] in keys
+    assert [('meta.mission', 1), ('timestamp', 1)] in keys
+
+
+def test_ensure_indexes_skips_refused_backfill(query):
+    def refuse(*args, **kwargs):
+        raise OperationFailure("Cannot perform a non-multi update on a time-series collection")
+    query.collection.update_many = refuse
+    query.ensure_indexes()
+    assert any(index['key'] == [('location', '2dsphere')] for index in query.collection.index_information().values())
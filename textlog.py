@@ -0,0 +1,220 @@
+import csv
+import gzip
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+# fsync policies
+FSYNC_NONE = 'none'
+FSYNC_INTERVAL = 'interval'
+FSYNC_EVERY_N = 'every_n'
+
+
+class RotatingTextFile():
+    """
+    Buffered text file split into numbered segments.
+
+    Writes go through a large userspace buffer and reach the card when the
+    buffer is full, on rotation and on close, plus whatever the fsync policy
+    asks for:
+        FSYNC_NONE      leave it to the OS
+        FSYNC_INTERVAL  flush and fsync at most every fsync_interval seconds
+        FSYNC_EVERY_N   flush and fsync every fsync_every records
+    Segments are named <root>.<number><ext> (mission.0000.csv, ...). A new
+    segment is started when the current one reaches max_bytes or is older
+    than max_age seconds; closed segments are gzipped on a background thread.
+
+    Parameters:
+        filename: Base name, e.g. 'mission.ndjson'.
+        header: Function returning the text written at the start of every segment, or None.
+        buffer_size: Userspace buffer in bytes.
+        fsync_policy: FSYNC_NONE, FSYNC_INTERVAL or FSYNC_EVERY_N.
+        fsync_interval: Seconds between fsyncs with FSYNC_INTERVAL.
+        fsync_every: Records between fsyncs with FSYNC_EVERY_N.
+        max_bytes: Segment size limit, None for no limit.
+        max_age: Segment age limit in seconds, None for no limit.
+        compress: gzip closed segments.
+    """
+
+    def __init__(self, filename, header=None, buffer_size=64 * 1024, fsync_policy=FSYNC_INTERVAL,
+                 fsync_interval=5.0, fsync_every=100, max_bytes=None, max_age=None, compress=True):
+        if fsync_policy not in (FSYNC_NONE, FSYNC_INTERVAL, FSYNC_EVERY_N):
+            raise ValueError(f"Unknown fsync policy {fsync_policy}")
+        self.root, self.ext = os.path.splitext(filename)
+        self.header = header
+        self.buffer_size = buffer_size
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.fsync_every = fsync_every
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.records = 0
+        self.fsyncs = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+        self._last_fsync = time.monotonic()
+        self._compress_queue = queue.Queue()
+        self._compressor = None
+        if compress:
+            self._compressor = threading.Thread(target=self._compress_loop, name='log-gzip', daemon=True)
+            self._compressor.start()
+
+        existing = self._segment_numbers()
+        self.segment = existing[-1] + 1 if existing else 0
+        if compress:
+            # Segments left uncompressed by an earlier run
+            for number in existing:
+                if os.path.exists(self.segment_path(number)):
+                    self._compress_queue.put(self.segment_path(number))
+        self._open_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def segment_path(self, number):
+        return f"{self.root}.{number:04d}{self.ext}"
+
+    def _segment_numbers(self):
+        directory = os.path.dirname(self.root) or '.'
+        pattern = re.compile(re.escape(os.path.basename(self.root)) + r'\.(\d{4,})' + re.escape(self.ext) + r'(\.gz)?$')
+        numbers = set()
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if match:
+                numbers.add(int(match.group(1)))
+        return sorted(numbers)
+
+    def _open_segment(self):
+        self.path = self.segment_path(self.segment)
+        self._file = open(self.path, 'w', buffering=self.buffer_size, newline='')
+        self._opened = time.monotonic()
+        if self.header:
+            self._file.write(self.header())
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_fsync = time.monotonic()
+        self.fsyncs += 1
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        if self.compress:
+            self._compress_queue.put(self.path)
+        self.segment += 1
+        self._open_segment()
+
+    def write(self, text):
+        """Write one record (text ending with a newline)."""
+        with self._lock:
+            now = time.monotonic()
+            if (self.max_bytes is not None and self._file.tell() >= self.max_bytes) or \
+                    (self.max_age is not None and now - self._opened >= self.max_age):
+                self._rotate()
+            self._file.write(text)
+            self.records += 1
+            self._unsynced += 1
+            if self.fsync_policy == FSYNC_EVERY_N and self._unsynced >= self.fsync_every:
+                self._sync()
+            elif self.fsync_policy == FSYNC_INTERVAL and now - self._last_fsync >= self.fsync_interval:
+                self._sync()
+
+    def flush(self):
+        """Flush and fsync the current segment."""
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+
+    def _compress_loop(self):
+        while True:
+            path = self._compress_queue.get()
+            if path is None:
+                return
+            try:
+                with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(path + '.gz.tmp', path + '.gz')
+                os.remove(path)
+            except OSError as e:
+                print(f"Could not compress {path} - {e}")
+
+    def close(self):
+        """Close the current segment (left uncompressed) and wait for the compressor."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._sync()
+            self._file.close()
+            self._file = None
+        if self._compressor is not None:
+            self._compress_queue.put(None)
+            self._compressor.join()
+
+
+class NdjsonWriter(RotatingTextFile):
+    """One JSON document per line. Takes the RotatingTextFile options."""
+
+    def write_record(self, record):
+        self.write(json.dumps(record, default=str) + '\n')
+
+
+class CsvWriter(RotatingTextFile):
+    """
+    Flat CSV with a header line in every segment.
+
+    Parameters:
+        filename: Base name, e.g. 'mission.csv'.
+        columns: (header, path) pairs, path being the key or tuple of keys of
+            the value in a record, e.g. ('Temp (C)', ('exodata', '1')).
+        **options: RotatingTextFile options.
+    """
+
+    def __init__(self, filename, columns, **options):
+        self.columns = [(column, (column,)) if isinstance(column, str) else
+                        (column[0], column[1] if isinstance(column[1], tuple) else (column[1],))
+                        for column in columns]
+        self._row = _RowBuffer()
+        self._csv = csv.writer(self._row)
+        super().__init__(filename, header=self._header, **options)
+
+    def _header(self):
+        self._csv.writerow([name for name, _ in self.columns])
+        return self._row.take()
+
+    def write_record(self, record):
+        row = []
+        for _, path in self.columns:
+            value = record
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            row.append('' if value is None else value)
+        with self._lock:
+            self._csv.writerow(row)
+            text = self._row.take()
+        self.write(text)
+
+
+class _RowBuffer():
+    """File-like target for csv.writer that hands back one row at a time."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, text):
+        self._parts.append(text)
+
+    def take(self):
+        text = ''.join(self._parts)
+        self._parts = []
+        return text
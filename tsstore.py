@@ -0,0 +1,155 @@
+import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+TIME_FIELD = 'timestamp'
+META_FIELD = 'meta'
+
+
+def clean_identity(value):
+    """
+    Sonde serial number as plain text.
+
+    Older missions stored str(bytes) such as "b'23G106182 ...\\r\\n'", this turns
+    bytes and those strings back into the stripped text.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    value = str(value)
+    if len(value) >= 3 and value[0] == 'b' and value[1] in "'\"" and value[-1] == value[1]:
+        value = value[2:-1].replace('\\r', '').replace('\\n', '')
+    return value.strip()
+
+
+class TimeSeriesStore():
+    """
+    Readings of every mission and vessel in one MongoDB time-series collection.
+
+    Readings use 'timestamp' as time field and {'asvid', 'mission'} as meta
+    field, so MongoDB groups the readings of one vessel and mission into
+    compressed buckets. The sonde serial numbers and parameter list are kept
+    once per mission and vessel in the missions collection instead of in every
+    reading. Collections and indexes are created when missing.
+
+    Time-series collections do not enforce a unique _id, so a batch that is
+    sent twice (e.g. a crash between an upload and its ack) would be stored
+    twice. Batches are therefore written with insert_many() of this class,
+    which skips the readings that are already stored: pass the store instead
+    of store.readings to SpoolUploader, BatchedDBWriter or the Aggregator.
+
+    Parameters:
+        db: pymongo Database.
+        readings: Name of the time-series collection.
+        missions: Name of the mission metadata collection.
+        granularity: 'seconds', 'minutes' or 'hours', the usual interval between readings.
+        expire_after: Seconds after which readings are deleted, None to keep them.
+        create: Call ensure_collections() right away.
+    """
+
+    def __init__(self, db, readings='readings', missions='missions', granularity='seconds', expire_after=None,
+                 create=True):
+        self.db = db
+        self.granularity = granularity
+        self.expire_after = expire_after
+        self.readings = db[readings]
+        self.missions = db[missions]
+        if create:
+            self.ensure_collections()
+
+    def ensure_collections(self):
+        """Create the time-series collection and the indexes if they do not exist."""
+        if self.readings.name not in self.db.list_collection_names():
+            options = {'timeseries': {'timeField': TIME_FIELD, 'metaField': META_FIELD,
+                                      'granularity': self.granularity}}
+            if self.expire_after is not None:
+                options['expireAfterSeconds'] = self.expire_after
+            try:
+                self.db.create_collection(self.readings.name, **options)
+            except CollectionInvalid:
+                # Created by another vessel in the meantime
+                pass
+            except OperationFailure as e:
+                print(f"Could not create time-series collection {self.readings.name}, "
+                      f"using a regular collection - {e}")
+        self.readings.create_index([(META_FIELD + '.mission', ASCENDING), (TIME_FIELD, ASCENDING)])
+        self.readings.create_index([(META_FIELD + '.asvid', ASCENDING), (TIME_FIELD, ASCENDING)])
+        self.missions.create_index([('mission', ASCENDING), ('asvid', ASCENDING)], unique=True)
+        self.missions.create_index([('started', ASCENDING)])
+
+    def register_mission(self, mission, asvid, sn=None, ssn=None, params=None, param_names=None, **extra):
+        """
+        Store the metadata of a mission for one vessel.
+
+        Calling it again for the same mission and vessel updates the sonde
+        fields and keeps the original start time.
+        """
+        fields = {
+            'sn': clean_identity(sn),
+            'ssn': clean_identity(ssn),
+            'params': [int(code) for code in params] if params is not None else None,
+            'param_names': list(param_names) if param_names is not None else None,
+        }
+        fields.update(extra)
+        self.missions.update_one(
+            {'mission': mission, 'asvid': asvid},
+            {'$set': fields, '$setOnInsert': {'started': datetime.datetime.now()}},
+            upsert=True)
+
+    def mission(self, mission, asvid):
+        """Metadata document of a mission and vessel, or None."""
+        return self.missions.find_one({'mission': mission, 'asvid': asvid}, {'_id': 0})
+
+    def reading(self, document, mission, asvid):
+        """
+        Turn a run.py document into a time-series reading.
+
+        The date/time strings and the per-record sonde metadata are dropped, and
+        a GeoJSON location is added for geospatial queries.
+        """
+        reading = {
+            TIME_FIELD: document['timestamp'],
+            META_FIELD: {'asvid': asvid, 'mission': mission},
+            'exodata': document['exodata'],
+        }
+        latitude = document.get('latitude')
+        longitude = document.get('longitude')
+        if latitude is not None and longitude is not None:
+            reading['latitude'] = latitude
+            reading['longitude'] = longitude
+            reading['location'] = {'type': 'Point', 'coordinates': [longitude, latitude]}
+        if document.get('sonde_timestamp') is not None:
+            reading['sonde_timestamp'] = document['sonde_timestamp']
+        return reading
+
+    def insert_many(self, documents, ordered=False):
+        """
+        Store the readings of a batch whose _id is not in the collection yet.
+
+        Readings without an _id get one, so a batch that is retried keeps its
+        ids. The lookup is limited to the time range of the batch, which keeps
+        it to a few buckets. This is only safe with one writer per stream, as
+        with a spool and its uploader.
+
+        Returns:
+            Number of readings inserted.
+        """
+        batch = {}
+        for document in documents:
+            batch.setdefault(document.setdefault('_id', ObjectId()), document)
+        if not batch:
+            return 0
+        times = [document[TIME_FIELD] for document in batch.values()]
+        query = {'_id': {'$in': list(batch)}, TIME_FIELD: {'$gte': min(times), '$lte': max(times)}}
+        for stored in self.readings.find(query, {'_id': 1}):
+            batch.pop(stored['_id'], None)
+        if batch:
+            self.readings.insert_many(list(batch.values()), ordered=ordered)
+        return len(batch)
+
+    def insert(self, document, mission, asvid):
+        """Store one run.py document right away (no batching)."""
+        self.readings.insert_one(self.reading(document, mission, asvid))
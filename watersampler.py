@@ -6,6 +6,154 @@ import tkinter as tk
 from tkinter import filedialog
 import shutil
 import os
+import collections
+import threading
+from concurrent.futures import Future
+
+import geodesy
+import metrics
+from samplepoints import SampleCoordinateStore, SamplePointIndex, read_coordinates
+
+I2C_WRITE = metrics.histogram('sampler_i2c_seconds', 'Time to switch the pump motors over I2C')
+I2C_ERRORS = metrics.counter('sampler_i2c_errors_total', 'Failed I2C writes to the pump board')
+PUMP_LATENCY = metrics.histogram('sampler_pump_latency_seconds', 'Time from a sample request to the pump starting')
+PUMP_REJECTED = metrics.counter('sampler_pump_rejected_total', 'Sample requests rejected because the pump was busy')
+
+class PumpBusyError(RuntimeError):
+    """Set on the Future of a request the PumpScheduler rejected because the pump is busy."""
+
+
+class PumpScheduler():
+    """
+    Runs pump cycles without blocking the caller.
+
+    submit() switches the motor on right away on the caller's thread when no
+    pump is running, and a timer thread switches it off after the duration,
+    so the acquisition loop only pays for the I2C writes. Requests that come
+    in while a bottle is filling are queued (at most max_pending) and start
+    when the running one ends. Every request gets a Future that resolves to
+    the motor index once the motor is off.
+
+    The delay between submit() and the motor switching on is kept in
+    last_latency / max_latency; requests that would wait longer than
+    max_wait seconds are rejected instead of queued.
+    """
+
+    def __init__(self, controller, max_pending=10, max_wait=60.0):
+        self.controller = controller
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.started = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._active = None
+        self._timer = None
+
+    def submit(self, index, duration, callback=None):
+        """
+        Run motor index for duration seconds as soon as the pump is free.
+
+        callback, if given, is called with the Future when the motor is off.
+        """
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        job = (index, duration, future, time.monotonic())
+        failed = []
+        with self._lock:
+            queued_time = sum(pending[1] for pending in self._pending)
+            if self._active is not None:
+                queued_time += max(0.0, self._active[1] - (time.monotonic() - self._active[3]))
+            if len(self._pending) >= self.max_pending or (self._active is not None and queued_time > self.max_wait):
+                self.rejected += 1
+                PUMP_REJECTED.inc()
+                failed.append((future, PumpBusyError(f"Pump busy, motor {index + 1} request rejected")))
+            else:
+                self._pending.append(job)
+                if self._active is None:
+                    self._start_next(failed)
+        self._fail(failed)
+        return future
+
+    def _fail(self, failed):
+        # Done callbacks may submit again, so futures are only failed once the lock is released
+        for future, error in failed:
+            future.set_exception(error)
+
+    def _start_next(self, failed):
+        # Called with the lock held; requests that cannot start are added to failed
+        while self._pending:
+            index, duration, future, requested = self._pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                self.controller._motor_on(index)
+            except OSError as e:
+                failed.append((future, e))
+                continue
+            break
+        else:
+            self._active = None
+            return
+        started = time.monotonic()
+        self.last_latency = started - requested
+        PUMP_LATENCY.record(self.last_latency)
+        self.max_latency = max(self.max_latency, self.last_latency)
+        self.started += 1
+        self._active = (index, duration, future, started)
+        self._timer = threading.Timer(duration, self._finish)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _finish(self):
+        with self._lock:
+            if self._active is None:
+                return  # Cancelled
+            index, duration, future, started = self._active
+            self._active = None
+            try:
+                self.controller._motor_off()
+                error = None
+            except OSError as e:
+                error = e
+        # Callbacks run outside the lock so they can submit again
+        if error:
+            future.set_exception(error)
+        else:
+            print(f"Motor {index + 1} deactivated after {duration} seconds.")
+            future.set_result(index)
+        failed = []
+        with self._lock:
+            if self._active is None:
+                self._start_next(failed)
+        self._fail(failed)
+
+    def busy(self):
+        with self._lock:
+            return self._active is not None or bool(self._pending)
+
+    def cancel_all(self):
+        """Drop queued requests and switch off the running motor now."""
+        cancelled = []
+        failed = []
+        try:
+            with self._lock:
+                while self._pending:
+                    cancelled.append(self._pending.popleft()[2])
+                if self._active is not None:
+                    self._timer.cancel()
+                    failed.append((self._active[2], RuntimeError("Pump cycle cancelled")))
+                    self._active = None
+                    self.controller._motor_off()
+        finally:
+            # Callbacks run outside the lock so they can submit again
+            for future in cancelled:
+                future.cancel()
+            self._fail(failed)
+
 
 class WaterSamplerController():
     def __init__(self, i2c_bus=1, device_address=0x20):
@@ -44,11 +192,13 @@ class WaterSamplerController():
         self.samplingtime = 10          #Time it takes to take a sample
         self.timebetweensamples = 300   #Time between samples when seuqnatial sampling is chosen
         self.threshold_meters = 5   #Distance between refrence and coordinate for taking a sample [m]
+        self.coordinate_stores = {}  #Sampling coordinates per file, loaded once
+        self.scheduler = PumpScheduler(self)
         
     def activate_next_motor(self, duration=None):
         self.current_motor_index += 1
         if duration==None:
-            duration= self.samplingtine
+            duration= self.samplingtime
         
         if self.current_motor_index >= len(self.motors):
             print("All motors have been activated.")
@@ -63,26 +213,62 @@ class WaterSamplerController():
         index = motor_number - 1
         self._activate_motor(index, duration)
             
-    def _activate_motor(self, index, duration):
-        
+    def _motor_on(self, index):
         byte_a, byte_b = self.motors[index]
         
         # Send data to PORTA and PORTB separately
-        self.bus.write_byte_data(self.address, 0x02, byte_a) # Write to GPIOA
-        self.bus.write_byte_data(self.address, 0x03, byte_b) # Write to GPIOB
+        self._write_ports(byte_a, byte_b)
         
         print(f"Motor {index + 1} activated.")
+
+    def _motor_off(self):
+        # Deactivate all motors
+        self._write_ports(0x00, 0x00)
+
+    def _write_ports(self, byte_a, byte_b):
+        start = time.monotonic()
+        try:
+            self.bus.write_byte_data(self.address, 0x02, byte_a) # Write to GPIOA
+            self.bus.write_byte_data(self.address, 0x03, byte_b) # Write to GPIOB
+        except OSError:
+            I2C_ERRORS.inc()
+            raise
+        finally:
+            I2C_WRITE.since(start)
+
+    def _activate_motor(self, index, duration):
+        
+        self._motor_on(index)
         
         # Wait for the specified duration
         time.sleep(duration)
         
-        # Deactivate all motors
-        self.bus.write_byte_data(self.address, 0x02, 0x00) # Clear GPIOA
-        self.bus.write_byte_data(self.address, 0x03, 0x00) # Clear GPIOB
+        self._motor_off()
         
         print(f"Motor {index + 1} deactivated after {duration} seconds.")
+
+    def activate_next_motor_async(self, duration=None, callback=None):
+        """
+        Like activate_next_motor, but returns a Future right away instead of
+        waiting for the bottle to fill. Returns None when all motors were used.
+        A request the scheduler rejects does not use up a bottle.
+        """
+        index = self.current_motor_index + 1
+        if duration==None:
+            duration= self.samplingtime
+
+        if index >= len(self.motors):
+            self.current_motor_index = index
+            print("All motors have been activated.")
+            return None
+
+        future = self.scheduler.submit(index, duration, callback)
+        if not (future.done() and isinstance(future.exception(), PumpBusyError)):
+            self.current_motor_index = index
+        return future
         
     def stop(self):
+        self.scheduler.cancel_all()
         self.bus.write_byte_data(self.address, 0x02, 0x00) # Clear GPIOA
         self.bus.write_byte_data(self.address, 0x03, 0x00) # Clear GPIOB
         print(f"All Motors  deactivated.")
@@ -125,21 +311,7 @@ class WaterSamplerController():
         return R * c
 
     def read_coordinates_from_file(self, filename):
-        coords = []
-        with open(filename, 'r') as file:
-            for line in file:
-                #print(line)
-                line = line.strip()
-                if line:  # ignore empty lines
-                    parts = line.split(',')
-                    if len(parts) == 2:
-                        try:
-                            lat = float(parts[0].strip())
-                            lon = float(parts[1].strip())
-                            coords.append((lat, lon))
-                        except ValueError:
-                            print(f"Skipping invalid line: {line}")
-        return coords
+        return read_coordinates(filename)
 
     def write_coordinates_to_file(self, filename, coords):
         with open(filename, 'w') as file:
@@ -147,11 +319,16 @@ class WaterSamplerController():
                 file.write(f"{lat},{lon}\n")
 
     def check_and_remove_closest(self, reference_coord, coord_list):
+        # coord_list can also be a SamplePointIndex, which avoids checking every point
+        if isinstance(coord_list, SamplePointIndex):
+            found = coord_list.pop_nearest(reference_coord, self.threshold_meters)
+            return (1 if found else 0), coord_list
         if not coord_list:
             return 0, coord_list
 
-        distances = [self.haversine(reference_coord, coord) for coord in coord_list]
-        min_index = distances.index(min(distances))
+        # Same as self.haversine, for the whole list at once (in km)
+        distances = geodesy.haversine(coord_list, reference_coord, radius=6371000.0) / 1000.0
+        min_index = int(distances.argmin())
         min_distance = distances[min_index]
 
         if min_distance < (self.threshold_meters / 1000.0):
@@ -196,21 +373,58 @@ class WaterSamplerController():
         print(updated_coords)
         print("Sample taken")
             
-    def sample_from_gps(self, filename, reference):
-        coords = self.read_coordinates_from_file(filename)   #Read coordinates
-        if coords:
-            #print(coords)
+    def get_coordinate_store(self, filename):
+        # Coordinates are read once; taken points are kept in filename + '.journal'
+        store = self.coordinate_stores.get(filename)
+        if store is None:
+            store = SampleCoordinateStore(filename)
+            self.coordinate_stores[filename] = store
+        return store
+
+    def sample_and_log_async(self, filename, add_data="", updated_coords=(0,0)):
+        """
+        Same log lines as sample_and_log, but the pump runs on the scheduler and
+        the 'motor off' lines are written when it finishes. Nothing is logged
+        for a request that does not start or queue.
+
+        Returns:
+            Future of the pump cycle, or None when the scheduler rejected the
+            request or all motors were used.
+        """
+        motor_index = self.current_motor_index + 2
+        future = self.activate_next_motor_async(duration=self.samplingtime)
+        if future is None:
+            return None
+        if future.done() and (future.cancelled() or future.exception() is not None):
+            print(f"Sample {motor_index} not started: {'cancelled' if future.cancelled() else future.exception()}")
+            return None
+        self.save_txt(log_file=filename, motor_index=motor_index, motor_state=1)
+        self.save_txt(log_file=filename, motor_index=motor_index, motor_state="exo: "+add_data)
+
+        def done(future):
+            if future.cancelled() or future.exception():
+                print(f"Sample {motor_index} failed: {'cancelled' if future.cancelled() else future.exception()}")
+                return
+            self.save_txt(log_file=filename, motor_index=motor_index, motor_state=0)
+            self.save_txt(log_file=filename, motor_index=motor_index + 1, motor_state=f"coords: {updated_coords}")
+            print(updated_coords)
+            print("Sample taken")
+
+        # Added after the start lines, so a short cycle cannot log its end first
+        future.add_done_callback(done)
+        if future.running():
+            print(f"Pump on {self.scheduler.last_latency * 1000:.1f} ms after the trigger")
+        elif not future.done():
+            print("Pump busy, sample queued")
+        return future
+
+    def sample_from_gps(self, filename, reference, log_file='log.txt'):
+        store = self.get_coordinate_store(filename)
+        if len(store):
             print(f"\nProcessing reference: {reference}")
-            take_sample, updated_coords = self.check_and_remove_closest(reference, coords) #Take sample and update coordinates' list
-            if take_sample:
-                #self.save_txt(seld.current_motor_index + 2, motor_state=1)
-                #self.activate_next_motor(duration=self.samplingtime)
-                #self.save_txt(self.current_motor_index + 1, motor_state=0)
-                #self.write_coordinates_to_file(filename, updated_coords)
-                #print("take sample =", take_sample)
-                #print(updated_coords)
-                #print("Sample taken")
-                sample_and_log (filename=filename)
+            found = store.take_nearest(reference, self.threshold_meters) #Take sample and update coordinates' list
+            if found:
+                self.sample_and_log(log_file, updated_coords=reference)
             #else:
             #    print("Reference NOT FOUND in sampling coordinates")
         else: